@@ -1,7 +1,8 @@
 from django.contrib import admin
 
 from core.models import Newsletter, SubscriptionToNewsletter, Message, Visitor, VisitSurvey, EventLog, EmailTemplate, \
-    NewsletterDeliveryRecord, EmailSettings, MessageLog
+    NewsletterDeliveryRecord, EmailSettings, MessageLog, Campaign, CampaignShard, NewsletterRelay, DeadLetter
+from core.logic_email import replay_dead_letters
 from simple_newsletter.admin_utils import ExportCsvMixin, ExportRawDataCsvMixin, ExportExcelMixin
 from django.utils.translation import gettext as _
 
@@ -27,10 +28,16 @@ class NewsletterShortNameFilter(admin.SimpleListFilter):
         return queryset
 
 
+class NewsletterRelayInline(admin.TabularInline):
+    model = NewsletterRelay
+    extra = 0
+
+
 @admin.register(Newsletter)
 class NewsletterAdmin(admin.ModelAdmin, ExportCsvMixin, ExportRawDataCsvMixin):
+    inlines = [NewsletterRelayInline]
     list_display = ('id', 'short_name', 'name', 'from_email', 'enabled',
-                    'allows_subscription',
+                    'allows_subscription', 'sending_share',
                     'created_at',
                     )
     search_fields = ('id', 'short_name', 'name',)
@@ -81,6 +88,7 @@ class MessageAdmin(admin.ModelAdmin, ExportCsvMixin, ExportRawDataCsvMixin):
                     'processed',
                     'processed_at',
                     'to_be_processed_at',
+                    'dispatched_at',
                     'web_view_counter',
                     'email_view_counter',
                     'created_at',
@@ -119,13 +127,15 @@ class EmailTemplateAdmin(admin.ModelAdmin):
 
 @admin.register(NewsletterDeliveryRecord)
 class NewsletterDeliveryRecordAdmin(admin.ModelAdmin):
-    list_display = ('id', 'message', 'subscriber', 'sent_at')
+    list_display = ('id', 'message', 'subscriber', 'status', 'smtp_code', 'smtp_response', 'attempts', 'queued_at',
+                    'sent_at')
+    list_filter = ['status']
     # list_filter = [ 'name']
 
 
 @admin.register(EmailSettings)
 class EmailSettingsAdmin(admin.ModelAdmin):
-    list_display = ('id', 'name', 'host', 'port', 'use_tls', 'username',)
+    list_display = ('id', 'name', 'host', 'port', 'use_tls', 'username', 'rate_limit', 'rate_limit_burst',)
                     # 'email_host', 'email_port', 'email_host_user', 'email_host_password',
                     # 'email_use_tls', 'email_use_ssl', 'email_timeout',
                     # 'email_ssl_keyfile', 'email_ssl_certfile', 'email_ssl_password',
@@ -141,3 +151,33 @@ class MessageLogAdmin(admin.ModelAdmin, ExportExcelMixin):
     list_filter = [ 'created_at', 'original_uri']
 
     actions = ["export_as_excel"]
+
+
+class CampaignShardInline(admin.TabularInline):
+    model = CampaignShard
+    extra = 0
+    readonly_fields = ('index', 'start_subscriber_id', 'end_subscriber_id', 'status', 'last_subscriber_id',
+                       'enqueued_count', 'lease_owner', 'lease_expires_at', 'heartbeat_at', 'completed_at')
+
+
+@admin.register(Campaign)
+class CampaignAdmin(admin.ModelAdmin):
+    inlines = [CampaignShardInline]
+    list_display = ('id', 'message', 'status', 'engine', 'audience_size', 'enqueued_count', 'last_subscriber_id',
+                    'created_at', 'completed_at', 'last_digest_at')
+    list_filter = ['status', 'engine']
+
+
+@admin.register(DeadLetter)
+class DeadLetterAdmin(admin.ModelAdmin):
+    list_display = ('id', 'created_at', 'recipient', 'message', 'error_class', 'smtp_code', 'attempts', 'error',
+                    'replayed_at')
+    list_filter = ['error_class', 'smtp_code', 'replayed_at']
+    search_fields = ('recipient', 'error')
+
+    actions = ["replay"]
+
+    @admin.action(description="Replay the selected emails")
+    def replay(self, request, queryset):
+        replayed = replay_dead_letters(queryset)
+        self.message_user(request, f"{replayed} emails enqueued again")
@@ -0,0 +1,221 @@
+import asyncio
+import base64
+import re
+import smtplib
+import ssl
+
+from django.core.mail.utils import DNS_NAME
+
+
+# line endings of the message are normalized to CRLF, and lines starting with a period are escaped (RFC 5321 4.5.2)
+BARE_EOL_RE = re.compile(rb'\r\n|\n|\r')
+LEADING_PERIOD_RE = re.compile(rb'^\.', re.MULTILINE)
+
+
+def quote_message_data(message_bytes):
+    """Returns the message as sent after the DATA command, terminated by <CRLF>.<CRLF>."""
+    data = LEADING_PERIOD_RE.sub(b'..', BARE_EOL_RE.sub(b'\r\n', message_bytes))
+    if not data.endswith(b'\r\n'):
+        data += b'\r\n'
+    return data + b'.\r\n'
+
+
+class AsyncSMTPClient:
+    """
+    Minimal asyncio SMTP client, used by the AsyncSender engine (see core/logic_async_sender.py) to keep
+    many SMTP sessions open in a single process.
+
+    When the relay advertises PIPELINING, MAIL FROM, RCPT TO and DATA are sent together and the replies
+    are read afterwards, saving two round trips for each message.
+    Errors are raised as the smtplib exceptions, so that they are classified by classify_smtp_error.
+    STARTTLS (use_tls) requires Python 3.11 or later (asyncio.StreamWriter.start_tls).
+    """
+
+    def __init__(self, host, port, username=None, password=None, use_tls=False, use_ssl=False, timeout=30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+
+        self.reader = None
+        self.writer = None
+        self.extensions = {}
+        self.messages_sent = 0
+        # True while the content of a message is being transmitted: if the session fails, the relay may have
+        # accepted the message
+        self.data_started = False
+
+    @property
+    def is_connected(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+    @property
+    def supports_pipelining(self):
+        return 'pipelining' in self.extensions
+
+    async def connect(self):
+        ssl_context = ssl.create_default_context() if self.use_ssl else None
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port, ssl=ssl_context), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise smtplib.SMTPConnectError(-1, f"{self.host}:{self.port} - {e}".encode())
+
+        code, text = await self.read_reply()
+        if code != 220:
+            await self.close()
+            raise smtplib.SMTPConnectError(code, text)
+
+        await self.ehlo()
+
+        if self.use_tls:
+            if 'starttls' not in self.extensions:
+                raise smtplib.SMTPNotSupportedError("STARTTLS extension not supported by server.")
+            if not hasattr(self.writer, 'start_tls'):
+                await self.close()
+                raise smtplib.SMTPNotSupportedError("STARTTLS requires Python 3.11 or later in the async sender")
+            await self.command("STARTTLS", expected=(220,))
+            await self.writer.start_tls(ssl.create_default_context())
+            await self.ehlo()
+
+        if self.username and self.password:
+            await self.login()
+
+    async def read_reply(self):
+        """Reads a (possibly multiline) reply; returns (code, text)."""
+        lines = []
+        while True:
+            try:
+                line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+            except asyncio.TimeoutError:
+                await self.close()
+                raise smtplib.SMTPServerDisconnected("Timeout reading the reply of the server")
+
+            if not line:
+                await self.close()
+                raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+
+            try:
+                code = int(line[:3])
+            except ValueError:
+                await self.close()
+                raise smtplib.SMTPServerDisconnected(f"Invalid reply: {line!r}")
+
+            lines.append(line[4:].strip())
+            if line[3:4] != b'-':
+                return code, b'\n'.join(lines)
+
+    async def write(self, data):
+        try:
+            self.writer.write(data)
+            await asyncio.wait_for(self.writer.drain(), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            await self.close()
+            raise smtplib.SMTPServerDisconnected(f"Error writing to the server: {e}")
+
+    async def command(self, line, expected=(250,)):
+        await self.write(line.encode('ascii') + b'\r\n')
+        code, text = await self.read_reply()
+        if code not in expected:
+            raise smtplib.SMTPResponseException(code, text)
+        return code, text
+
+    async def ehlo(self):
+        code, text = await self.command(f"EHLO {DNS_NAME}")
+        self.extensions = {}
+        for line in text.decode('latin-1').split('\n')[1:]:
+            keyword, _, parameters = line.partition(' ')
+            self.extensions[keyword.lower()] = parameters.strip()
+
+    async def login(self):
+        mechanisms = self.extensions.get('auth', '').upper().split()
+        if 'PLAIN' in mechanisms:
+            credentials = base64.b64encode(f"\0{self.username}\0{self.password}".encode()).decode('ascii')
+            await self.command(f"AUTH PLAIN {credentials}", expected=(235,))
+        elif 'LOGIN' in mechanisms:
+            await self.command("AUTH LOGIN", expected=(334,))
+            await self.command(base64.b64encode(self.username.encode()).decode('ascii'), expected=(334,))
+            await self.command(base64.b64encode(self.password.encode()).decode('ascii'), expected=(235,))
+        else:
+            raise smtplib.SMTPNotSupportedError("No suitable authentication method found.")
+
+    async def send_message(self, from_addr, recipients, message_bytes):
+        """
+        Sends a message (bytes with the headers) to the recipients.
+
+        Returns:
+        tuple: (code, text) of the reply of the server to the message, and the dictionary of the refused
+               recipients, as returned by smtplib.SMTP.sendmail.
+        """
+        self.data_started = False
+        envelope = [f"MAIL FROM:<{from_addr}>"] + [f"RCPT TO:<{recipient}>" for recipient in recipients] + ["DATA"]
+
+        if self.supports_pipelining:
+            await self.write(b''.join(line.encode('ascii') + b'\r\n' for line in envelope))
+            replies = [await self.read_reply() for _ in envelope]
+        else:
+            replies = []
+            for line in envelope:
+                await self.write(line.encode('ascii') + b'\r\n')
+                replies.append(await self.read_reply())
+                if replies[0][0] != 250 or (line == envelope[-2] and
+                                            all(code not in (250, 251) for code, _ in replies[1:])):
+                    break
+
+        mail_reply, rcpt_replies = replies[0], replies[1:len(recipients) + 1]
+        data_reply = replies[len(recipients) + 1] if len(replies) == len(envelope) else None
+
+        refused = {recipient: reply for recipient, reply in zip(recipients, rcpt_replies) if reply[0] not in (250, 251)}
+
+        error = None
+        if mail_reply[0] != 250:
+            error = smtplib.SMTPSenderRefused(mail_reply[0], mail_reply[1], from_addr)
+        elif len(refused) == len(recipients):
+            error = smtplib.SMTPRecipientsRefused(refused)
+        elif data_reply is None or data_reply[0] != 354:
+            error = smtplib.SMTPDataError(*(data_reply or (-1, b"DATA not sent")))
+
+        if error is not None:
+            if data_reply is not None and data_reply[0] == 354:
+                # the server has accepted DATA anyway: send an empty message, which is then discarded
+                await self.write(b'.\r\n')
+                await self.read_reply()
+            await self.reset()
+            raise error
+
+        self.data_started = True
+        await self.write(quote_message_data(message_bytes))
+        code, text = await self.read_reply()
+        self.data_started = False
+        if code != 250:
+            await self.reset()
+            raise smtplib.SMTPDataError(code, text)
+
+        self.messages_sent += 1
+        return (code, text), refused
+
+    async def reset(self):
+        try:
+            await self.command("RSET")
+        except smtplib.SMTPException:
+            await self.close()
+
+    async def quit(self):
+        if self.is_connected:
+            try:
+                await self.command("QUIT", expected=(221,))
+            except smtplib.SMTPException:
+                pass
+        await self.close()
+
+    async def close(self):
+        if self.writer is not None:
+            writer, self.writer, self.reader = self.writer, None, None
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (OSError, ssl.SSLError):
+                pass
@@ -1,6 +1,8 @@
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import connection
+from django.db.models import Exists, OuterRef
 from django.utils import timezone
-from .models import EventLog, SubscriptionToNewsletter, NewsletterDeliveryRecord, Message
+from .models import EventLog, SubscriptionToNewsletter, NewsletterDeliveryRecord, Message, DeadLetter, Visitor
 
 
 def create_event_log(event_type, event_title, event_data, event_target=None):
@@ -31,6 +33,25 @@ def create_event_log(event_type, event_title, event_data, event_target=None):
         return None
 
 
+def create_event_logs(events):
+    """
+    Creates EventLog instances in bulk, with a single query.
+
+    Args:
+    events (list): List of dictionaries with the keys event_type, event_title, event_data and
+                   (optionally) event_target, as the arguments of create_event_log.
+
+    Returns:
+    list: The created EventLog instances.
+    """
+    now = timezone.now()
+    try:
+        return EventLog.objects.bulk_create([EventLog(created_at=now, **event) for event in events])
+    except Exception as e:
+        print(e)
+        return []
+
+
 def find_subscriber_by_email_and_newsletter(email, newsletter__id):
     """
     Finds a subscriber by email and newsletter.
@@ -80,6 +101,42 @@ def has_message_been_sent_to_subscriber(email, message_id):
         return False
 
 
+def get_subscribers_pending_delivery(message):
+    """
+    Returns the subscribers of the message's newsletter that still have to receive the message.
+
+    The audience is computed with a single anti-join query: confirmed and subscribed rows
+    with no NewsletterDeliveryRecord for the message (whatever its status: queued, sent or failed).
+    As in has_message_been_sent_to_subscriber, deliveries are matched by email address (multiple
+    subscriptions with the same email are allowed), and when the same email appears more than once
+    only the subscription with the lowest id is returned.
+
+    Args:
+    message (Message): The message to be sent.
+
+    Returns:
+    QuerySet: SubscriptionToNewsletter instances ordered by id.
+    """
+    eligible = (SubscriptionToNewsletter.objects
+                .filter(newsletter_id=message.newsletter_id)
+                .filter(email__isnull=False)
+                .filter(subscription_confirmed=True)
+                .filter(subscribed=True))
+
+    already_delivered = NewsletterDeliveryRecord.objects.filter(
+        message_id=message.id,
+        subscriber__newsletter_id=message.newsletter_id,
+        subscriber__email=OuterRef('email')
+    )
+
+    duplicated_email = eligible.filter(email=OuterRef('email'), id__lt=OuterRef('id'))
+
+    return (eligible
+            .exclude(Exists(already_delivered))
+            .exclude(Exists(duplicated_email))
+            .order_by('id'))
+
+
 def register_message_delivery(message_id, subscriber_id):
     """
     Registers that a message has been sent to a subscriber.
@@ -89,20 +146,134 @@ def register_message_delivery(message_id, subscriber_id):
     subscriber_id (int): The ID of the subscriber.
 
     Returns:
-    NewsletterDeliveryRecord: The created record of the message delivery.
+    NewsletterDeliveryRecord: The record of the message delivery.
+    """
+    return record_delivery_outcomes(message_id, [{
+        'subscriber_id': subscriber_id,
+        'status': NewsletterDeliveryRecord.SENT,
+    }])[0]
+
+
+def register_message_deliveries(message_id, subscriber_ids):
+    """
+    Registers that a message has been enqueued for a list of subscribers (status QUEUED), with a single query.
+    Subscribers that already have a record for the message are left untouched.
+
+    Args:
+    message_id (int): The ID of the message.
+    subscriber_ids (list): The IDs of the subscribers.
+
+    Returns:
+    list: The NewsletterDeliveryRecord instances.
+    """
+    return NewsletterDeliveryRecord.objects.bulk_create([
+        NewsletterDeliveryRecord(message_id=message_id, subscriber_id=subscriber_id,
+                                 status=NewsletterDeliveryRecord.QUEUED)
+        for subscriber_id in subscriber_ids
+    ], ignore_conflicts=True)
+
+
+def record_delivery_outcomes(message_id, outcomes):
     """
-    # Retrieve the Message and SubscriptionToNewsletter instances
-    message = Message.objects.get(id=message_id)
-    subscriber = SubscriptionToNewsletter.objects.get(id=subscriber_id)
+    Writes the outcome of the sending of a message to the delivery ledger, with a single upsert.
+
+    Args:
+    message_id (int): The ID of the message.
+    outcomes (list): List of dictionaries with the keys subscriber_id, status (NewsletterDeliveryRecord.SENT or
+                     FAILED) and, optionally, smtp_code and smtp_response (the reply of the relay).
 
-    # Create a new NewsletterDeliveryRecord instance
-    delivery_record = NewsletterDeliveryRecord(
-        message=message,
-        subscriber=subscriber,
-        sent_at=timezone.now()
+    Returns:
+    list: The NewsletterDeliveryRecord instances.
+    """
+    now = timezone.now()
+    records = [
+        NewsletterDeliveryRecord(
+            message_id=message_id,
+            subscriber_id=outcome['subscriber_id'],
+            status=outcome['status'],
+            smtp_code=outcome.get('smtp_code'),
+            smtp_response=outcome.get('smtp_response'),
+            sent_at=now if outcome['status'] == NewsletterDeliveryRecord.SENT else None,
+            updated_at=now,
+        )
+        for outcome in outcomes
+    ]
+    # MySQL (INSERT ... ON DUPLICATE KEY UPDATE) does not accept the conflict target: the unique key is implied
+    unique_fields = ['message', 'subscriber'] if connection.features.supports_update_conflicts_with_target else None
+    return NewsletterDeliveryRecord.objects.bulk_create(
+        records,
+        update_conflicts=True,
+        unique_fields=unique_fields,
+        update_fields=['status', 'smtp_code', 'smtp_response', 'sent_at', 'updated_at'],
     )
 
-    # Save the record to the database
-    delivery_record.save()
 
-    return delivery_record
+def record_already_sent_deliveries(message_id, subscriber_ids):
+    """
+    Marks as SENT the rows of the delivery ledger of the emails sent by a previous delivery of a task
+    that could not record their outcome (e.g. the worker died after sending); the rows already SENT keep
+    the reply of the relay.
+
+    Returns:
+    int: The number of updated rows.
+    """
+    now = timezone.now()
+    return (NewsletterDeliveryRecord.objects
+            .filter(message_id=message_id, subscriber_id__in=subscriber_ids)
+            .exclude(status=NewsletterDeliveryRecord.SENT)
+            .update(status=NewsletterDeliveryRecord.SENT, sent_at=now, updated_at=now))
+
+
+def create_dead_letters(dead_letters):
+    """
+    Stores the emails that could not be delivered (after the retries), with a single query.
+
+    Args:
+    dead_letters (list): List of dictionaries with the fields of DeadLetter (recipient, error, error_class and,
+                         optionally, smtp_code, attempts, message_id, subscriber_id, task_kwargs).
+
+    Returns:
+    list: The created DeadLetter instances.
+    """
+    try:
+        return DeadLetter.objects.bulk_create([DeadLetter(**dead_letter) for dead_letter in dead_letters])
+    except Exception as e:
+        print(e)
+        return []
+
+
+def record_visitor_emails(visitors, subject, template=None, failed=None):
+    """
+    Marks the visitors as email_sent, except the failed ones, and logs the outcome for each visitor in EventLog.
+    The failed visitors are left with email_sent False, so they are sent again by the next SendEmailToVisitors.
+
+    Args:
+    visitors (list): The Visitor instances the email has been sent to.
+    subject (str): The subject of the email.
+    template (str, optional): The name of the EmailTemplate of the email.
+    failed (dict, optional): The errors of the visitors not reached, {email address: error}.
+
+    Returns:
+    int: The number of visitors marked as email_sent.
+    """
+    failed = failed or {}
+    sent_ids = [visitor.id for visitor in visitors if visitor.email_address not in failed]
+
+    Visitor.objects.filter(id__in=sent_ids).update(email_sent=True, email_sent_at=timezone.now())
+
+    create_event_logs([
+        {
+            'event_type': "EMAIL_SENT",
+            'event_title': f"Email sent to visitor - subject: {subject}",
+            'event_data': f"Visitor: {visitor.email_address} - template: {template}",
+            'event_target': visitor.email_address,
+        } if visitor.email_address not in failed else {
+            'event_type': "EMAIL_FAILED",
+            'event_title': f"Email not sent to visitor - subject: {subject}",
+            'event_data': f"Visitor: {visitor.email_address} - template: {template} - "
+                          f"error: {failed[visitor.email_address]}",
+            'event_target': visitor.email_address,
+        } for visitor in visitors
+    ])
+
+    return len(sent_ids)
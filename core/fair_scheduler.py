@@ -0,0 +1,75 @@
+from django.db.models import Count, Q, Exists, OuterRef
+from django.utils import timezone
+
+from core.models import NewsletterDeliveryRecord, Campaign, Message
+
+
+def allocate_fair_shares(demands, weights, capacity):
+    """
+    Splits capacity among the campaigns in proportion to their weights (weighted max-min fairness): a campaign
+    never gets more than its demand, and what it leaves is split among the others.
+
+    Args:
+    demands (dict): {key: number of items waiting}.
+    weights (dict): {key: weight} (default 1).
+    capacity (int): Number of items to allocate.
+
+    Returns:
+    dict: {key: number of items allocated}; the total is min(capacity, sum of the demands).
+    """
+    allocation = {key: 0 for key in demands}
+    active = sorted(key for key, demand in demands.items() if demand > 0)
+    remaining = capacity
+
+    while active and remaining > 0:
+        total_weight = sum(max(weights.get(key, 1), 1) for key in active)
+        available = remaining
+        for key in active:
+            share = max(available * max(weights.get(key, 1), 1) // total_weight, 1)
+            granted = min(share, demands[key] - allocation[key], remaining)
+            allocation[key] += granted
+            remaining -= granted
+            if not remaining:
+                break
+        active = [key for key in active if allocation[key] < demands[key]]
+
+    return allocation
+
+
+def get_campaign_queue_depths(engine=Campaign.ASYNC):
+    """
+    Returns the queue depth of each message being sent by the campaigns of the engine, from the delivery ledger.
+
+    Returns:
+    list: Dictionaries with the keys message_id, newsletter_id, newsletter (short name), sending_share,
+          due (QUEUED rows to send now), scheduled (QUEUED rows waiting for a retry) and sending (rows claimed
+          by a sender), ordered by message id.
+    """
+    now = timezone.now()
+    due = Q(status=NewsletterDeliveryRecord.QUEUED) & (Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now))
+
+    depths = (NewsletterDeliveryRecord.objects
+              .filter(status__in=[NewsletterDeliveryRecord.QUEUED, NewsletterDeliveryRecord.SENDING])
+              .filter(Exists(Campaign.objects.filter(message_id=OuterRef('message_id'), engine=engine)))
+              .values('message_id')
+              .annotate(due=Count('id', filter=due),
+                        queued=Count('id', filter=Q(status=NewsletterDeliveryRecord.QUEUED)),
+                        sending=Count('id', filter=Q(status=NewsletterDeliveryRecord.SENDING)))
+              .order_by('message_id'))
+    depths = list(depths)
+
+    newsletters = {
+        message['id']: message for message in
+        Message.objects.filter(id__in=[depth['message_id'] for depth in depths])
+        .values('id', 'newsletter_id', 'newsletter__short_name', 'newsletter__sending_share')
+    }
+
+    return [{
+        'message_id': depth['message_id'],
+        'newsletter_id': newsletters[depth['message_id']]['newsletter_id'],
+        'newsletter': newsletters[depth['message_id']]['newsletter__short_name'],
+        'sending_share': newsletters[depth['message_id']]['newsletter__sending_share'],
+        'due': depth['due'],
+        'scheduled': depth['queued'] - depth['due'],
+        'sending': depth['sending'],
+    } for depth in depths]
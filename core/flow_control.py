@@ -0,0 +1,148 @@
+import os
+import time
+
+from django.conf import settings
+
+_broker_clients = {}
+
+
+def get_task_queue(task_name):
+    """Returns the celery queue of the task, as routed by CELERY_TASK_ROUTES (default: celery)."""
+    route = getattr(settings, 'CELERY_TASK_ROUTES', {}).get(task_name) or {}
+    return route.get('queue', 'celery')
+
+
+def get_broker_client():
+    """
+    Returns a redis client connected to the celery broker, or None if the length of the queues cannot be
+    measured (the broker is not redis, or the tasks are executed eagerly, e.g. in the tests).
+    The client is created once for each process.
+    """
+    url = getattr(settings, 'CELERY_BROKER_URL', None)
+    if not url or not url.startswith(('redis://', 'rediss://')) or getattr(settings, 'CELERY_TASK_ALWAYS_EAGER', False):
+        return None
+
+    key = (os.getpid(), url)
+    if key not in _broker_clients:
+        import redis
+        _broker_clients[key] = redis.Redis.from_url(url, socket_timeout=5, socket_connect_timeout=5)
+    return _broker_clients[key]
+
+
+def get_queue_length(queue):
+    """
+    Returns the number of tasks waiting in the queue of the broker (the redis transport of celery keeps each
+    queue in a list with the name of the queue; the tasks reserved by the workers are not in the list),
+    or None if it cannot be measured.
+    """
+    client = get_broker_client()
+    if client is None:
+        return None
+    try:
+        return client.llen(queue)
+    except Exception as e:
+        print(f"get_queue_length - broker not available: {e}")
+        return None
+
+
+class EnqueueFlowControl:
+    """
+    Backpressure for the producer of a campaign (SendNewsletter): keeps at most max_queued tasks waiting in the
+    queue of the broker, so that the memory of the broker is bounded on huge campaigns, while the workers always
+    find tasks to consume.
+
+    The producer calls enqueued() after each task. The length of the queue is measured only when the estimate
+    (last measured length + tasks enqueued since) reaches max_queued; then the producer waits until the workers
+    have drained the queue to half of max_queued. The completion rate of the workers is derived from the
+    measurements (tasks enqueued - growth of the queue, over time) and reported every report_interval seconds,
+    with the enqueue rate.
+    When the length of the queue cannot be measured the producer is not throttled.
+    If the heartbeat returns False (e.g. the lease of the shard has been lost) the producer stops waiting and
+    stopped is set: the caller must stop enqueuing.
+    """
+
+    def __init__(self, task_name, max_queued=None, poll_interval=None, report_interval=None, heartbeat=None,
+                 queue_length=None, clock=time.monotonic, sleep=time.sleep):
+        self.queue = get_task_queue(task_name)
+        self.max_queued = max_queued or getattr(settings, 'ENQUEUE_MAX_QUEUED_TASKS', 2000)
+        self.poll_interval = poll_interval or getattr(settings, 'ENQUEUE_POLL_SECONDS', 0.5)
+        self.report_interval = report_interval or getattr(settings, 'ENQUEUE_REPORT_SECONDS', 10)
+        self.heartbeat = heartbeat  # called while waiting, e.g. to renew the lease of the campaign shard
+        self.stopped = False
+        self._queue_length = queue_length or get_queue_length
+        self._clock = clock
+        self._sleep = sleep
+
+        self.started_at = self._clock()
+        self.tasks = 0
+        self.emails = 0
+        self.waited = 0.0
+        self.completion_rate = None  # tasks/s consumed by the workers
+
+        self.measurable = True
+        self._last_length = 0
+        self._last_sample = (self.started_at, 0, None)  # (time, tasks enqueued, queue length)
+        self._last_report = self.started_at
+
+    def measure(self):
+        """Measures the length of the queue and updates the completion rate of the workers."""
+        length = self._queue_length(self.queue)
+        if length is None:
+            if self.measurable:
+                print(f"Flow control - the length of the queue {self.queue} cannot be measured: not throttled")
+            self.measurable = False
+            return None
+
+        now = self._clock()
+        sample_time, sample_tasks, sample_length = self._last_sample
+        if sample_length is not None and now > sample_time:
+            completed = sample_length + (self.tasks - sample_tasks) - length
+            rate = max(completed, 0) / (now - sample_time)
+            # smoothed, the workers complete the tasks in bursts
+            self.completion_rate = rate if self.completion_rate is None else 0.7 * self.completion_rate + 0.3 * rate
+        self._last_sample = (now, self.tasks, length)
+        self._last_length = length
+        return length
+
+    def enqueued(self, emails=1, tasks=1):
+        """Records the tasks (with the given number of emails) sent to the broker; waits if the queue is full."""
+        self.tasks += tasks
+        self.emails += emails
+
+        if self.measurable and self._last_length + self.tasks - self._last_sample[1] >= self.max_queued:
+            self.wait()
+
+        if self._clock() - self._last_report >= self.report_interval:
+            self.report()
+
+    def wait(self):
+        """Waits until the workers have drained the queue to half of max_queued."""
+        start = self._clock()
+        last_heartbeat = start
+
+        length = self.measure()
+        while length is not None and length > self.max_queued // 2:
+            self._sleep(self.poll_interval)
+            length = self.measure()
+
+            now = self._clock()
+            if now - self._last_report >= self.report_interval:
+                self.report()
+            if self.heartbeat and now - last_heartbeat >= self.report_interval:
+                last_heartbeat = now
+                if self.heartbeat() is False:
+                    print(f"Flow control - stopped while waiting for the queue {self.queue}")
+                    self.stopped = True
+                    break
+
+        self.waited += self._clock() - start
+
+    def report(self):
+        """Prints the live rates of the producer and of the workers."""
+        now = self._clock()
+        self._last_report = now
+        elapsed = max(now - self.started_at, 1e-9)
+        completion = f"{self.completion_rate:.1f} tasks/s" if self.completion_rate is not None else "n/a"
+        print(f"Flow control - queue {self.queue}: {self._last_length} waiting (max {self.max_queued}) - "
+              f"enqueued {self.tasks} tasks, {self.emails} emails ({self.emails / elapsed:.1f} emails/s) - "
+              f"workers: {completion} - throttled for {self.waited:.1f}s")
@@ -1,4 +1,24 @@
-from bs4 import BeautifulSoup
+import hashlib
+import html
+import re
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+# tokens of the html document: only <a> and <img> start tags are rewritten, the other tokens are copied as they are
+HTML_TOKEN_RE = re.compile(r"""
+    <!--.*?-->                                                          # comment
+  | <(?P<raw_text>script|style)\b.*?</(?P=raw_text)\s*>                 # elements whose content is not html
+  | <(?P<tag>a|img)(?=[\s/>])(?P<attributes>(?:[^>"']|"[^"]*"|'[^']*')*)>  # start tags to rewrite
+  | <[a-zA-Z][^\s/>]*(?:[^>"']|"[^"]*"|'[^']*')*>                       # any other start tag
+""", re.IGNORECASE | re.DOTALL | re.VERBOSE)
+
+HTML_ATTRIBUTE_RE = re.compile(r"""
+    (?P<name>[^\s/>"'=]+)
+    (?:\s*=\s*(?P<value>"[^"]*"|'[^']*'|[^\s"'>]+))?
+""", re.VERBOSE)
 
 
 def ensure_correct_base_url(base_url):
@@ -8,14 +28,142 @@ def ensure_correct_base_url(base_url):
     return base_url
 
 
-def make_urls_absolute(html_content, base_url, set_a_target=None):
+def _quoted(value, quote='"'):
+    return f'{quote}{html.escape(value, quote=True)}{quote}'
+
+
+def _rewrite_start_tag(tag, attributes, base_url, set_a_target):
+    """Returns the attributes of an <a> or <img> start tag with absolute URLs and the optional target."""
+    url_attribute = 'src' if tag == 'img' else 'href'
+    rewrite_target = tag == 'a' and set_a_target
+
+    pieces = []
+    position = 0
+    has_target = False
+
+    for attribute in HTML_ATTRIBUTE_RE.finditer(attributes):
+        name = attribute.group('name').lower()
+        value = attribute.group('value')
+
+        if name == url_attribute and value is not None:
+            quote = value[0] if value[0] in '"\'' else ''
+            raw_value = value[1:-1] if quote else value
+            if not html.unescape(raw_value).startswith('/'):
+                continue
+            quote = quote or '"'
+            replacement = f'{quote}{html.escape(base_url, quote=True)}{raw_value}{quote}'
+            start, end = attribute.span('value')
+        elif name == 'target' and rewrite_target:
+            has_target = True
+            if value is None:
+                replacement = f'{attribute.group("name")}={_quoted(set_a_target)}'
+                start, end = attribute.span()
+            else:
+                replacement = _quoted(set_a_target, value[0] if value[0] in '"\'' else '"')
+                start, end = attribute.span('value')
+        else:
+            continue
+
+        pieces.append(attributes[position:start])
+        pieces.append(replacement)
+        position = end
+
+    pieces.append(attributes[position:])
+    attributes = ''.join(pieces)
+
+    if rewrite_target and not has_target:
+        stripped = attributes.rstrip()
+        self_closing = stripped.endswith('/')
+        if self_closing:
+            stripped = stripped[:-1].rstrip()
+        attributes = f'{stripped} target={_quoted(set_a_target)}' + (' /' if self_closing else '')
+
+    return attributes
+
+
+def rewrite_urls(html_content, base_url, set_a_target=None):
+    """
+    Streaming rewriter behind make_urls_absolute: the html is tokenized and only the src of <img> tags,
+    the href and the target of <a> tags are rewritten; the rest of the document is copied unchanged.
+    """
+    base_url = ensure_correct_base_url(base_url)
+
+    def replace(match):
+        tag = match.group('tag')
+        if not tag:
+            return match.group(0)
+        tag = tag.lower()
+        attributes = _rewrite_start_tag(tag, match.group('attributes'), base_url, set_a_target)
+        return f'<{match.group("tag")}{attributes}>'
+
+    return HTML_TOKEN_RE.sub(replace, html_content)
+
+
+class RewrittenHtmlCache:
+    """
+    LRU cache of rewritten html, keyed by the hash of the content, the base url and the target.
+    Only for content rendered once and rewritten many times (e.g. the skeleton of a newsletter, the content
+    of a message): the documents rendered for each recipient would only evict the others.
+    """
+
+    def __init__(self, max_size=None):
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._documents = OrderedDict()
+
+    @property
+    def max_size(self):
+        return self._max_size or getattr(settings, 'HTML_URL_REWRITE_CACHE_SIZE', 128)
+
+    def get_or_rewrite(self, html_content, base_url, set_a_target=None):
+        digest = hashlib.blake2b(html_content.encode('utf-8'), digest_size=20).digest()
+        key = (digest, base_url, set_a_target)
+
+        with self._lock:
+            rewritten = self._documents.get(key)
+            if rewritten is not None:
+                self._documents.move_to_end(key)
+                return rewritten
+
+        rewritten = rewrite_urls(html_content, base_url, set_a_target)
+
+        with self._lock:
+            self._documents[key] = rewritten
+            while len(self._documents) > self.max_size:
+                self._documents.popitem(last=False)
+
+        return rewritten
+
+    def clear(self):
+        with self._lock:
+            self._documents.clear()
+
+
+rewritten_html_cache = RewrittenHtmlCache()
+
+
+def make_urls_absolute(html_content, base_url, set_a_target=None, cache=True):
     """
     Make all URLs in the html_content absolute by prepending the base_url and optionally set target attribute for <a> tags.
     :param html_content: HTML content as a string.
     :param base_url: The base URL to prepend.
     :param set_a_target: Optional target attribute value for <a> tags. example: "_blank"
+    :param cache: Whether to keep the result in rewritten_html_cache; False for content rendered for a single
+                  recipient, which is never rewritten again.
     :return: Updated HTML content with absolute URLs and optional target attributes.
     """
+    if not cache:
+        return rewrite_urls(str(html_content), base_url, set_a_target)
+    return rewritten_html_cache.get_or_rewrite(str(html_content), base_url, set_a_target)
+
+
+def make_urls_absolute_beautifulsoup(html_content, base_url, set_a_target=None):
+    """
+    Previous implementation of make_urls_absolute, which parses and serializes the whole document;
+    kept as the reference for the Benchmark command.
+    """
+    from bs4 import BeautifulSoup
+
     soup = BeautifulSoup(html_content, 'html.parser')
 
     base_url = ensure_correct_base_url(base_url)
@@ -0,0 +1,563 @@
+import asyncio
+import os
+import smtplib
+import socket
+import time
+import uuid
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.mail.message import sanitize_address
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Q, F
+from django.utils import timezone
+
+from core.async_smtp import AsyncSMTPClient
+from core.business_logic import record_delivery_outcomes, create_event_logs, create_dead_letters
+from core.fair_scheduler import allocate_fair_shares, get_campaign_queue_depths
+from core.logic_email import classify_smtp_error, get_retry_countdown, email_connection_pool, PERMANENT, \
+    SESSION_PRESERVING_ERRORS, DeliveryUncertainError
+from core.logic_newsletter import get_message_for_sending, newsletter_skeleton_cache
+from core.logic_notifications import get_bulk_bcc
+from core.models import NewsletterDeliveryRecord, Campaign, EventLog
+from core.rate_limit import acquire_email_settings_slot_async, acquire_domain_slot_async
+from core.recipient_domains import get_email_domain, get_domain_limits, interleave_by_domain
+from core.relays import get_newsletter_relays, order_relays, relay_health
+from core.send_guard import get_newsletter_send_key, reserve_send, mark_sent, release_send, ALREADY_SENT, \
+    IN_PROGRESS
+
+
+def release_stale_claims(timeout=None):
+    """
+    Puts back in the queue the rows claimed by a sender that has not recorded their outcome, and has stopped
+    renewing its claims (e.g. it was killed), see renew_claims.
+
+    Returns:
+    int: The number of released rows.
+    """
+    timeout = timeout or getattr(settings, 'ASYNC_SENDER_CLAIM_TIMEOUT_SECONDS', 600)
+    return NewsletterDeliveryRecord.objects.filter(
+        status=NewsletterDeliveryRecord.SENDING,
+        claimed_at__lt=timezone.now() - timedelta(seconds=timeout),
+    ).update(status=NewsletterDeliveryRecord.QUEUED, claimed_by=None, claimed_at=None)
+
+
+def renew_claims(sender_id):
+    """
+    Renews the claims of a running sender (claimed_at of its SENDING rows), so that the rows it still holds
+    (queued in memory or in flight, e.g. slowed down by the rate limits) are not released by release_stale_claims.
+
+    Returns:
+    int: The number of renewed rows.
+    """
+    return NewsletterDeliveryRecord.objects.filter(
+        status=NewsletterDeliveryRecord.SENDING, claimed_by=sender_id,
+    ).update(claimed_at=timezone.now())
+
+
+def release_claims(record_ids):
+    """Puts back in the queue rows claimed but not sent (e.g. when the sender is stopped)."""
+    return NewsletterDeliveryRecord.objects.filter(
+        id__in=record_ids, status=NewsletterDeliveryRecord.SENDING,
+    ).update(status=NewsletterDeliveryRecord.QUEUED, claimed_by=None, claimed_at=None)
+
+
+def plan_fair_claim(limit):
+    """
+    Splits the rows to claim among the messages being sent, so that a small campaign is not queued behind
+    a big one: each newsletter gets a part of limit proportional to its sending_share (and the messages of
+    a newsletter share its part equally); what a campaign cannot use goes to the others.
+
+    Returns:
+    dict: {message id: number of rows to claim}.
+    """
+    depths = get_campaign_queue_depths(Campaign.ASYNC)
+
+    newsletters = {}
+    for depth in depths:
+        newsletters.setdefault(depth['newsletter_id'], []).append(depth)
+
+    newsletter_shares = allocate_fair_shares(
+        {newsletter: sum(depth['due'] for depth in messages) for newsletter, messages in newsletters.items()},
+        {newsletter: messages[0]['sending_share'] for newsletter, messages in newsletters.items()},
+        limit,
+    )
+
+    plan = {}
+    for newsletter, messages in newsletters.items():
+        plan.update(allocate_fair_shares({depth['message_id']: depth['due'] for depth in messages}, {},
+                                         newsletter_shares[newsletter]))
+    return {message_id: rows for message_id, rows in plan.items() if rows}
+
+
+def claim_async_deliveries(sender_id, limit):
+    """
+    Claims up to limit QUEUED rows of the delivery ledger that belong to campaigns of the ASYNC engine,
+    shared fairly among the campaigns (see plan_fair_claim).
+
+    The delivery ledger is the outbox of the ASYNC campaigns: on databases that support it (PostgreSQL, MySQL 8)
+    the rows are locked with SELECT ... FOR UPDATE SKIP LOCKED, so senders on any number of nodes claim
+    disjoint batches without waiting for each other. Elsewhere (e.g. SQLite in the tests) the claim is
+    a conditional update (QUEUED -> SENDING): several senders never claim the same row, but a sender
+    may get fewer rows than the limit when another one claims them first.
+
+    Args:
+    sender_id (str): Identifier of the sender process, written to claimed_by.
+    limit (int): Maximum number of rows to claim.
+
+    Returns:
+    list: The claimed NewsletterDeliveryRecord instances (with subscriber), ordered by message and id.
+    """
+    now = timezone.now()
+
+    plan = plan_fair_claim(limit)
+    if not plan:
+        return []
+
+    due_records = (NewsletterDeliveryRecord.objects
+                   .filter(status=NewsletterDeliveryRecord.QUEUED)
+                   .filter(Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now))
+                   .order_by('id'))
+
+    with transaction.atomic():
+        if connection.features.has_select_for_update_skip_locked:
+            due_records = due_records.select_for_update(skip_locked=True)
+
+        candidates = []
+        for message_id, rows in plan.items():
+            candidates.extend(due_records.filter(message_id=message_id).values_list('id', flat=True)[:rows])
+        if not candidates:
+            return []
+
+        NewsletterDeliveryRecord.objects.filter(
+            id__in=candidates, status=NewsletterDeliveryRecord.QUEUED,
+        ).update(status=NewsletterDeliveryRecord.SENDING, claimed_by=sender_id, claimed_at=now,
+                 attempts=F('attempts') + 1)
+
+    return list(NewsletterDeliveryRecord.objects
+                .filter(id__in=candidates, status=NewsletterDeliveryRecord.SENDING, claimed_by=sender_id)
+                .select_related('subscriber')
+                .order_by('message_id', 'id'))
+
+
+def get_relay_settings(email_settings_id):
+    """
+    Returns the arguments of AsyncSMTPClient for the relay, and its EmailSettings dictionary
+    (None for the default connection defined in settings.py) for the rate limit.
+    """
+    if email_settings_id is None:
+        return {
+            'host': settings.EMAIL_HOST,
+            'port': settings.EMAIL_PORT,
+            'username': settings.EMAIL_HOST_USER,
+            'password': settings.EMAIL_HOST_PASSWORD,
+            'use_tls': settings.EMAIL_USE_TLS,
+            'use_ssl': settings.EMAIL_USE_SSL,
+        }, None
+
+    email_settings = email_connection_pool.get_email_settings(email_settings_id)
+    return {
+        'host': email_settings['host'],
+        'port': email_settings['port'],
+        'username': email_settings['username'],
+        'password': email_settings['password'],
+        'use_tls': email_settings['use_tls'],
+    }, email_settings
+
+
+def build_delivery_jobs(records):
+    """
+    Renders the emails of the claimed rows.
+
+    Returns:
+    tuple: (jobs, outcomes): the jobs to send, and the outcomes of the rows that could not be rendered.
+    """
+    jobs = []
+    outcomes = []
+    messages = {}
+    bcc = get_bulk_bcc()
+
+    for record in records:
+        if record.message_id not in messages:
+            message = get_message_for_sending(record.message_id)
+            newsletter = message.newsletter
+            relays = get_newsletter_relays(newsletter)
+            messages[record.message_id] = {
+                'message': message,
+                'skeleton': newsletter_skeleton_cache.get(message),
+                'relays': relays,
+                'relay_settings': {relay[0]: get_relay_settings(relay[0]) for relay in relays},
+                'event_title': f"newsletter {newsletter.short_name} message id: {message.id} -  subject: {message.subject}",
+            }
+        context = messages[record.message_id]
+
+        job = {
+            'record_id': record.id,
+            'message_id': record.message_id,
+            'subscriber_id': record.subscriber_id,
+            'recipient': record.subscriber.email,
+            'attempts': record.attempts,
+            'event_title': context['event_title'],
+            'relays': context['relays'],
+            'relay_settings': context['relay_settings'],
+        }
+
+        try:
+            email = context['skeleton'].create_email(record.subscriber, bcc)
+
+            encoding = email.encoding or settings.DEFAULT_CHARSET
+            job['from_email'] = sanitize_address(email.from_email, encoding)
+            job['recipients'] = [sanitize_address(address, encoding) for address in email.recipients()]
+            job['message_bytes'] = email.message().as_bytes(linesep='\r\n')
+            # the envelope is sent as ascii
+            if not all(address.isascii() for address in [job['from_email']] + job['recipients']):
+                raise ValueError("the envelope addresses must be ascii")
+        except Exception as e:
+            print(f"build_delivery_jobs - message {record.message_id} not rendered for {record.subscriber.email}: {e}")
+            outcomes.append(make_outcome(job, error=e))
+            continue
+
+        jobs.append(job)
+
+    return jobs, outcomes
+
+
+def make_outcome(job, reply=None, error=None, in_progress=False):
+    """
+    Returns the outcome of a job, as recorded by record_async_outcomes; with in_progress, the email is being sent
+    by another sender (see core/send_guard.py) and the row is checked again later.
+    """
+    outcome = {key: job[key] for key in ('record_id', 'message_id', 'subscriber_id', 'recipient', 'attempts',
+                                         'event_title')}
+    if in_progress:
+        outcome.update({
+            'status': NewsletterDeliveryRecord.QUEUED,
+            'smtp_code': None,
+            'smtp_response': "being sent by another sender",
+        })
+    elif error is None:
+        code, text = reply
+        outcome.update({
+            'status': NewsletterDeliveryRecord.SENT,
+            'smtp_code': code,
+            'smtp_response': text.decode('utf-8', 'replace') if isinstance(text, bytes) else text,
+        })
+    else:
+        error_class, smtp_code = classify_smtp_error(error)
+        outcome.update({
+            'status': NewsletterDeliveryRecord.FAILED,
+            'smtp_code': smtp_code,
+            'smtp_response': str(error),
+            'error_class': error_class,
+            # the relay may have accepted the message, see DeliveryUncertainError
+            'uncertain': isinstance(error, DeliveryUncertainError),
+        })
+    return outcome
+
+
+def record_async_outcomes(outcomes, sender_id=None):
+    """
+    Writes the outcomes of the sending to the delivery ledger (one upsert for each message) and to EventLog.
+    Transient and throttling errors are put back in the queue, with a backoff, up to EMAIL_RETRY_MAX_ATTEMPTS;
+    the other errors go to the DeadLetter store.
+    With sender_id, only the outcomes of the rows still claimed by the sender are written: a row released in the
+    meantime belongs to the sender that has claimed it again.
+    """
+    max_attempts = getattr(settings, 'EMAIL_RETRY_MAX_ATTEMPTS', 5)
+    now = timezone.now()
+
+    if sender_id is not None:
+        claimed = NewsletterDeliveryRecord.objects.filter(status=NewsletterDeliveryRecord.SENDING, claimed_by=sender_id)
+        held = set(claimed.filter(id__in=[outcome['record_id'] for outcome in outcomes]).values_list('id', flat=True))
+        if len(held) < len(outcomes):
+            print(f"record_async_outcomes - {len(outcomes) - len(held)} rows no longer claimed by {sender_id}, "
+                  f"outcomes not recorded")
+        outcomes = [outcome for outcome in outcomes if outcome['record_id'] in held]
+    else:
+        claimed = NewsletterDeliveryRecord.objects.all()
+
+    ledger = {}
+    events = []
+    dead_letters = []
+
+    for outcome in outcomes:
+        if outcome['status'] == NewsletterDeliveryRecord.QUEUED:
+            # checked again when the reservation of the other sender expires; not counted as an attempt
+            claimed.filter(id=outcome['record_id']).update(
+                status=NewsletterDeliveryRecord.QUEUED, attempts=F('attempts') - 1, claimed_by=None, claimed_at=None,
+                next_attempt_at=now + timedelta(seconds=getattr(settings, 'SEND_GUARD_RESERVATION_SECONDS', 600)))
+            continue
+        elif outcome['status'] == NewsletterDeliveryRecord.SENT:
+            events.append({
+                'event_type': EventLog.EMAIL_SENT,
+                'event_title': f"Newsletter email sent to subscriber - {outcome['event_title']}",
+                'event_data': f"subscriber: {outcome['recipient']} - {outcome['smtp_code']} {outcome['smtp_response']}",
+                'event_target': outcome['recipient'],
+            })
+        elif outcome['error_class'] != PERMANENT and outcome['attempts'] < max_attempts:
+            countdown = get_retry_countdown(outcome['attempts'] - 1, outcome['error_class'])
+            claimed.filter(id=outcome['record_id']).update(
+                status=NewsletterDeliveryRecord.QUEUED, next_attempt_at=now + timedelta(seconds=countdown),
+                smtp_code=outcome['smtp_code'], smtp_response=outcome['smtp_response'],
+                claimed_by=None, claimed_at=None)
+            continue
+        else:
+            events.append({
+                'event_type': EventLog.EMAIL_FAILED,
+                'event_title': f"Newsletter email not sent to subscriber - {outcome['event_title']}",
+                'event_data': f"subscriber: {outcome['recipient']} - {outcome['error_class']} {outcome['smtp_code']}"
+                              f" - error: {outcome['smtp_response']}",
+                'event_target': outcome['recipient'],
+            })
+            dead_letters.append({
+                'message_id': outcome['message_id'],
+                'subscriber_id': outcome['subscriber_id'],
+                'recipient': outcome['recipient'],
+                'error_class': outcome['error_class'],
+                'smtp_code': outcome['smtp_code'],
+                'error': outcome['smtp_response'],
+                'attempts': outcome['attempts'],
+            })
+
+        ledger.setdefault(outcome['message_id'], []).append({
+            'subscriber_id': outcome['subscriber_id'],
+            'status': outcome['status'],
+            'smtp_code': outcome['smtp_code'],
+            'smtp_response': outcome['smtp_response'],
+        })
+
+    for message_id, message_outcomes in ledger.items():
+        record_delivery_outcomes(message_id, message_outcomes)
+
+    if dead_letters:
+        create_dead_letters(dead_letters)
+
+    create_event_logs(events)
+
+
+class AsyncSender:
+    """
+    Delivery engine that sends the emails of the ASYNC campaigns (see SendNewsletter --engine async)
+    from a single process, keeping many SMTP sessions in flight with asyncio.
+
+    The engine claims QUEUED rows of the delivery ledger, renders them (see build_delivery_jobs) and puts them
+    in a queue consumed by `sessions` coroutines, each one holding its own SMTP connection to the relays
+    of the newsletter. The outcomes are written to the ledger in bulk, every poll_interval seconds, and the claims
+    of the rows still held are renewed as often. Each email is guarded by its idempotency key (see
+    core/send_guard.py), reserved before the DATA command.
+    The jobs are interleaved by recipient domain, and the sessions sending to the same domain are bounded
+    by its concurrency (see EMAIL_DOMAIN_LIMITS).
+    """
+
+    def __init__(self, sessions=None, batch_size=None, poll_interval=None):
+        self.sessions = sessions or getattr(settings, 'ASYNC_SENDER_SESSIONS', 50)
+        self.batch_size = batch_size or getattr(settings, 'ASYNC_SENDER_BATCH_SIZE', 500)
+        self.poll_interval = poll_interval or getattr(settings, 'ASYNC_SENDER_POLL_SECONDS', 2)
+        self.sender_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        # the claims of the senders that stopped are released periodically, not only at startup
+        self.release_interval = getattr(settings, 'ASYNC_SENDER_CLAIM_TIMEOUT_SECONDS', 600) / 10
+        self.last_release = None
+
+        self.jobs = None
+        self.domain_semaphores = {}
+        self.outcomes = []
+        self.sent = 0
+        self.failed = 0
+
+    def release_stale_claims(self):
+        if self.last_release is not None and time.monotonic() - self.last_release < self.release_interval:
+            return
+        self.last_release = time.monotonic()
+        released = release_stale_claims()
+        if released:
+            print(f"AsyncSender {self.sender_id} - released {released} stale claims")
+
+    def claim_jobs(self):
+        close_old_connections()
+        self.release_stale_claims()
+        records = claim_async_deliveries(self.sender_id, self.batch_size)
+        jobs, outcomes = build_delivery_jobs(records)
+        self.outcomes.extend(outcomes)
+        return interleave_by_domain(jobs, lambda job: job['recipients'][0])
+
+    async def claim(self):
+        """Claims a batch of rows and queues their jobs; returns the number of claimed rows."""
+        jobs = await sync_to_async(self.claim_jobs)()
+        for job in jobs:
+            self.jobs.put_nowait(job)
+        return len(jobs)
+
+    async def flush_outcomes(self):
+        outcomes, self.outcomes = self.outcomes, []
+        if outcomes:
+            await sync_to_async(record_async_outcomes)(outcomes, self.sender_id)
+            self.sent += sum(1 for outcome in outcomes if outcome['status'] == NewsletterDeliveryRecord.SENT)
+            self.failed += sum(1 for outcome in outcomes if outcome['status'] == NewsletterDeliveryRecord.FAILED)
+            print(f"AsyncSender {self.sender_id} - sent: {self.sent} failed: {self.failed} queued: {self.jobs.qsize()}")
+
+    async def heartbeat(self):
+        """Renews the claims of the rows held by the sender every poll_interval seconds, until cancelled."""
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            await sync_to_async(renew_claims)(self.sender_id)
+
+    async def run(self, until_idle=False):
+        """
+        Sends the queued emails until stopped (or, if until_idle is True, until there is nothing left to send).
+
+        Returns:
+        tuple: The number of emails sent and failed.
+        """
+        self.jobs = asyncio.Queue()
+
+        workers = [asyncio.create_task(self.session_worker()) for _ in range(self.sessions)]
+        # also while waiting for the queue to be drained
+        heartbeat = asyncio.create_task(self.heartbeat())
+        last_flush = time.monotonic()
+
+        try:
+            while True:
+                claimed = await self.claim() if self.jobs.qsize() < self.batch_size else 0
+
+                if until_idle and not claimed:
+                    await self.jobs.join()
+                    await self.flush_outcomes()
+                    if not await self.claim():
+                        break
+                elif not claimed:
+                    # nothing to claim, or enough jobs queued
+                    await asyncio.sleep(self.poll_interval if self.jobs.empty() else 0.05)
+                else:
+                    await asyncio.sleep(0)
+
+                if time.monotonic() - last_flush >= self.poll_interval:
+                    await self.flush_outcomes()
+                    last_flush = time.monotonic()
+        finally:
+            # give back the jobs not yet started, let the sessions finish the messages in flight
+            pending = []
+            while not self.jobs.empty():
+                job = self.jobs.get_nowait()
+                self.jobs.task_done()
+                pending.append(job['record_id'])
+            if pending:
+                await sync_to_async(release_claims)(pending)
+
+            for _ in workers:
+                self.jobs.put_nowait(None)
+            await asyncio.gather(*workers, return_exceptions=True)
+            heartbeat.cancel()
+            await asyncio.gather(heartbeat, return_exceptions=True)
+            await self.flush_outcomes()
+
+        return self.sent, self.failed
+
+    async def session_worker(self):
+        """Sends the queued jobs, one at a time, keeping an SMTP session open for each relay."""
+        clients = {}
+        try:
+            while True:
+                job = await self.jobs.get()
+                try:
+                    if job is None:
+                        return
+                    # awaited first: flush_outcomes may swap the list in the meantime
+                    outcome = await self.send_job(job, clients)
+                    self.outcomes.append(outcome)
+                finally:
+                    self.jobs.task_done()
+        finally:
+            for client in clients.values():
+                await client.quit()
+
+    async def send_job(self, job, clients):
+        """Sends the email of the job if its idempotency key can be reserved; returns the outcome."""
+        send_key = get_newsletter_send_key(job['message_id'], job['subscriber_id'])
+        state, token = await asyncio.to_thread(reserve_send, send_key)
+        if state == ALREADY_SENT:
+            # sent by a previous claim of the row, whose outcome has not been recorded
+            return make_outcome(job, reply=(None, "already sent"))
+        if state == IN_PROGRESS:
+            return make_outcome(job, in_progress=True)
+
+        outcome = await self.deliver_to_domain(job, clients)
+        if outcome['status'] == NewsletterDeliveryRecord.SENT:
+            await asyncio.to_thread(mark_sent, send_key)
+        elif not outcome['uncertain']:
+            await asyncio.to_thread(release_send, send_key, token)
+        return outcome
+
+    def get_domain_semaphore(self, domain):
+        """Returns the semaphore bounding the sessions sending to the domain (None if unbounded)."""
+        if domain not in self.domain_semaphores:
+            concurrency = get_domain_limits(domain)['concurrency']
+            self.domain_semaphores[domain] = asyncio.Semaphore(concurrency) if concurrency else None
+        return self.domain_semaphores[domain]
+
+    async def deliver_to_domain(self, job, clients):
+        """Sends the email of the job within the concurrency and the rate limit of the recipient domain."""
+        domain = get_email_domain(job['recipients'][0])
+        semaphore = self.get_domain_semaphore(domain)
+
+        if semaphore is None:
+            await acquire_domain_slot_async(domain)
+            return await self.deliver(job, clients)
+
+        async with semaphore:
+            await acquire_domain_slot_async(domain)
+            return await self.deliver(job, clients)
+
+    async def deliver(self, job, clients):
+        """
+        Sends the email of the job through one of the relays, with failover; returns the outcome.
+        The email fails over to the next relay only if the failure happened before its content was transmitted.
+        """
+        max_messages = getattr(settings, 'EMAIL_POOL_MAX_MESSAGES_PER_CONNECTION', 100)
+        last_error = None
+
+        # the health of the relays is shared through redis: its calls run in a thread, not in the event loop
+        for email_settings_id in await asyncio.to_thread(order_relays, job['relays']):
+            connection_settings, email_settings = job['relay_settings'][email_settings_id]
+            client = clients.get(email_settings_id)
+            try:
+                # the time spent waiting for the rate limit does not count as latency of the relay
+                await acquire_email_settings_slot_async(email_settings, len(job['recipients']))
+                start = time.monotonic()
+
+                if client is None or not client.is_connected or client.messages_sent >= max_messages:
+                    if client is not None:
+                        await client.quit()
+                    client = clients[email_settings_id] = AsyncSMTPClient(**connection_settings)
+                    await client.connect()
+
+                reply, refused = await client.send_message(job['from_email'], job['recipients'],
+                                                           job['message_bytes'])
+            except SESSION_PRESERVING_ERRORS as e:
+                # the relay is working: the error concerns the message
+                return make_outcome(job, error=e)
+            except Exception as e:
+                print(f"AsyncSender - relay {email_settings_id} failed: {e}")
+                await asyncio.to_thread(relay_health.record_failure, email_settings_id, str(e))
+                data_started = client is not None and client.data_started
+                if client is not None:
+                    await client.close()
+                clients.pop(email_settings_id, None)
+                if data_started:
+                    # the relay may have accepted the message: not sent through another relay
+                    return make_outcome(job, error=DeliveryUncertainError(
+                        f"relay {email_settings_id} failed after DATA: {e}"))
+                last_error = e
+                continue
+
+            await asyncio.to_thread(relay_health.record_success, email_settings_id, time.monotonic() - start)
+
+            to_address = job['recipients'][0]
+            if to_address in refused:
+                # only the BCC recipients have been accepted
+                return make_outcome(job, error=smtplib.SMTPRecipientsRefused({to_address: refused[to_address]}))
+
+            return make_outcome(job, reply=reply)
+
+        return make_outcome(job, error=last_error)
+
@@ -0,0 +1,745 @@
+import multiprocessing
+import os
+import socket
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Exists, F, Max, OuterRef, Q
+from django.utils import timezone
+
+from core.business_logic import get_subscribers_pending_delivery, create_event_log, register_message_deliveries
+from core.flow_control import EnqueueFlowControl
+from core.logic_notifications import get_bulk_bcc, send_campaign_sample
+from core.models import Campaign, CampaignShard, Message, NewsletterDeliveryRecord
+from core.recipient_domains import interleave_by_domain, plan_domain_batches
+
+
+# the delivery ledger rows of the emails sent one by one are written in slices of this size, right before
+# their tasks are enqueued
+ENQUEUE_SLICE_SIZE = 100
+
+
+def start_or_resume_campaign(message, save=True, engine=Campaign.CELERY, min_shards=1):
+    """
+    Returns the running campaign of the message, or starts a new one with a snapshot of the audience.
+
+    Args:
+    message (Message): The message to send.
+    save (bool): If False, the campaign is not saved to the database (see SendNewsletter --nosave).
+    engine (str): Campaign.CELERY or Campaign.ASYNC, for a new campaign (a resumed campaign keeps its engine).
+    min_shards (int): Split the audience in at least this number of shards (e.g. one for each parallel run).
+
+    Returns:
+    Campaign: The campaign; campaign.id is None if it has not been saved.
+    """
+    if not save:
+        campaign = new_campaign(message, engine)
+        print(f"Starting {campaign}")
+        return campaign
+
+    with transaction.atomic():
+        # concurrent runs start the campaign of the message one at a time: the others wait for the lock
+        # and resume the campaign (MySQL does not support the partial unique_running_campaign_per_message)
+        Message.objects.select_for_update().filter(id=message.id).exists()
+
+        campaign = Campaign.objects.filter(message=message, status=Campaign.RUNNING).order_by('-id').first()
+        if campaign:
+            print(f"Resuming {campaign}")
+            campaign.message = message
+        else:
+            campaign = new_campaign(message, engine)
+            campaign.save()
+            print(f"Starting {campaign}")
+
+        create_campaign_shards(campaign, min_shards=min_shards)
+
+    return campaign
+
+
+def new_campaign(message, engine):
+    """Returns a new (not saved) campaign of the message, with a snapshot of its audience."""
+    audience = get_subscribers_pending_delivery(message)
+    snapshot = audience.aggregate(max_id=Max('id'))
+
+    return Campaign(
+        message=message,
+        engine=engine,
+        audience_max_subscriber_id=snapshot['max_id'] or 0,
+        audience_size=audience.count(),
+    )
+
+
+def create_campaign_shards(campaign, shard_size=None, min_shards=1):
+    """
+    Splits the audience of the campaign still to be processed in shards of CAMPAIGN_SHARD_SIZE subscriber ids
+    (see CampaignShard), or smaller ones if needed to get min_shards shards; concurrent calls create the same
+    shards once. The shards of a resumed campaign are not changed, see split_campaign_shards.
+    """
+    if campaign.shards.exists():
+        return
+
+    shard_size = shard_size or getattr(settings, 'CAMPAIGN_SHARD_SIZE', 50000)
+    span = campaign.audience_max_subscriber_id - campaign.last_subscriber_id
+    shard_size = max(min(shard_size, -(-span // max(min_shards, 1))), 1)
+    start_ids = list(range(campaign.last_subscriber_id, campaign.audience_max_subscriber_id, shard_size))
+
+    CampaignShard.objects.bulk_create([
+        CampaignShard(
+            campaign=campaign,
+            index=index,
+            start_subscriber_id=start_id,
+            end_subscriber_id=min(start_id + shard_size, campaign.audience_max_subscriber_id),
+            last_subscriber_id=start_id,
+        ) for index, start_id in enumerate(start_ids or [campaign.last_subscriber_id])
+    ], ignore_conflicts=True)
+
+
+def split_campaign_shards(campaign, min_shards):
+    """
+    Splits in halves the remaining subscriber ids (after the cursor) of the running shards of the campaign that
+    are not leased, largest first, until the campaign has min_shards running shards or no shard can be split
+    (e.g. a campaign resumed with more --workers than its shards).
+    The shards are locked while they are split: a run cannot take the lease of a shard before its new end
+    is committed. The new shards take the next indexes: do not split the shards of a campaign run with
+    --shard, the runs of the other slots may have already finished.
+
+    Returns:
+    int: The number of running shards.
+    """
+    with transaction.atomic():
+        # concurrent runs split the shards one at a time, see start_or_resume_campaign
+        Message.objects.select_for_update().filter(id=campaign.message_id).exists()
+        return _split_campaign_shards(campaign, min_shards)
+
+
+def _split_campaign_shards(campaign, min_shards):
+    running = campaign.shards.filter(status=CampaignShard.RUNNING).count()
+    if running >= min_shards:
+        return running
+
+    now = timezone.now()
+    available = Q(status=CampaignShard.RUNNING) & (Q(lease_owner__isnull=True) | Q(lease_expires_at__lt=now))
+    shards = list(campaign.shards.select_for_update().filter(available).order_by('index'))
+    original_ends = {shard.id: shard.end_subscriber_id for shard in shards}
+    next_index = campaign.shards.aggregate(max_index=Max('index'))['max_index'] + 1
+    new_shards = []
+
+    while running < min_shards and shards:
+        shard = max(shards, key=lambda shard: shard.end_subscriber_id - shard.last_subscriber_id)
+        if shard.end_subscriber_id - shard.last_subscriber_id < 2:
+            break
+        middle = (shard.last_subscriber_id + shard.end_subscriber_id) // 2
+        new_shard = CampaignShard(
+            campaign=campaign,
+            index=next_index,
+            start_subscriber_id=middle,
+            end_subscriber_id=shard.end_subscriber_id,
+            last_subscriber_id=middle,
+        )
+        shard.end_subscriber_id = middle
+        shards.append(new_shard)
+        new_shards.append(new_shard)
+        next_index += 1
+        running += 1
+
+    for shard in shards:
+        if shard.id and shard.end_subscriber_id != original_ends[shard.id]:
+            CampaignShard.objects.filter(id=shard.id).update(end_subscriber_id=shard.end_subscriber_id)
+    CampaignShard.objects.bulk_create(new_shards)
+
+    if new_shards:
+        print(f"Split the shards of {campaign}: {len(new_shards)} new shards")
+    return running
+
+
+def get_lease_owner():
+    """Identifies the process taking the leases of the campaign shards."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def get_lease_expiry(now=None):
+    return (now or timezone.now()) + timedelta(seconds=getattr(settings, 'CAMPAIGN_LEASE_SECONDS', 300))
+
+
+def claim_campaign_shard(campaign, lease_owner, partition=None):
+    """
+    Takes the lease of the first shard of the campaign that is not leased, or whose lease has expired
+    (the run processing it has died): only one of the concurrent callers gets each shard.
+    With a partition (slot, count), only the shards whose index % count == slot are taken.
+
+    Returns:
+    CampaignShard: The leased shard, or None if there are no shards left to process.
+    """
+    now = timezone.now()
+    available = Q(status=CampaignShard.RUNNING) & (Q(lease_owner__isnull=True) | Q(lease_expires_at__lt=now))
+
+    for shard in campaign.shards.filter(available).order_by('index'):
+        if partition and shard.index % partition[1] != partition[0]:
+            continue
+        claimed = CampaignShard.objects.filter(available, id=shard.id).update(
+            lease_owner=lease_owner,
+            lease_expires_at=get_lease_expiry(now),
+            heartbeat_at=now,
+        )
+        if claimed:
+            if shard.lease_owner:
+                print(f"Taking over {shard} from {shard.lease_owner} (lease expired at {shard.lease_expires_at})")
+            # the cursor may have been moved by the previous owner in the meantime
+            shard.refresh_from_db()
+            return shard
+
+    return None
+
+
+def release_campaign_shard(shard, completed=False):
+    """Gives back the lease of the shard, so that another run can resume it; completed shards are not resumed."""
+    if not shard.id:
+        return
+
+    update = {'lease_owner': None, 'lease_expires_at': None}
+    if completed:
+        update.update(status=CampaignShard.COMPLETED, completed_at=timezone.now())
+
+    CampaignShard.objects.filter(id=shard.id, lease_owner=shard.lease_owner).update(**update)
+
+
+def renew_campaign_shard_lease(shard):
+    """
+    Renews the lease of the shard while the run is not advancing its cursor (e.g. waiting for the workers).
+
+    Returns:
+    bool: False if the lease has been lost.
+    """
+    if not shard or not shard.id:
+        return True
+    now = timezone.now()
+    return bool(CampaignShard.objects.filter(id=shard.id, lease_owner=shard.lease_owner).update(
+        heartbeat_at=now, lease_expires_at=get_lease_expiry(now)))
+
+
+def iter_campaign_shards(campaign, lease_owner, partition=None):
+    """
+    Yields the shards of the campaign leased by lease_owner, one at a time, until none is left.
+    With a partition (slot, count), only the shards of the slot (see claim_campaign_shard).
+    """
+    if not campaign.id:
+        # the campaign is not saved (SendNewsletter --nosave): the whole audience (or the id range
+        # of the slot), without leases
+        slot, count = partition or (0, 1)
+        span = campaign.audience_max_subscriber_id - campaign.last_subscriber_id
+        start_id = campaign.last_subscriber_id + span * slot // count
+        yield CampaignShard(campaign=campaign, index=slot, start_subscriber_id=start_id,
+                            end_subscriber_id=campaign.last_subscriber_id + span * (slot + 1) // count,
+                            last_subscriber_id=start_id)
+        return
+
+    while (shard := claim_campaign_shard(campaign, lease_owner, partition)) is not None:
+        yield shard
+
+
+def iter_audience(campaign, chunk_size=None, ids_only=False, with_email=False, shard=None):
+    """
+    Streams the audience of the campaign still to be processed, in chunks, with keyset pagination
+    from the campaign cursor (or the cursor of the shard): memory does not depend on the size of the newsletter.
+
+    Args:
+    campaign (Campaign): The campaign.
+    chunk_size (int, optional): Subscribers in each chunk; default CAMPAIGN_AUDIENCE_CHUNK_SIZE.
+    ids_only (bool): If True, each chunk is a list of subscriber ids, otherwise of SubscriptionToNewsletter.
+    with_email (bool): If True, each chunk is a list of (subscriber id, email) tuples.
+    shard (CampaignShard, optional): Only the subscribers of the shard, from its cursor.
+
+    Yields:
+    list: The next chunk of subscribers (or subscriber ids, or tuples), ordered by id.
+    """
+    chunk_size = chunk_size or getattr(settings, 'CAMPAIGN_AUDIENCE_CHUNK_SIZE', 1000)
+    last_id = shard.last_subscriber_id if shard else campaign.last_subscriber_id
+    max_id = shard.end_subscriber_id if shard else campaign.audience_max_subscriber_id
+
+    audience = get_subscribers_pending_delivery(campaign.message).filter(id__lte=max_id)
+
+    while True:
+        page = audience.filter(id__gt=last_id)[:chunk_size]
+        if with_email:
+            chunk = list(page.values_list('id', 'email'))
+        elif ids_only:
+            chunk = list(page.values_list('id', flat=True))
+        else:
+            chunk = list(page)
+        if not chunk:
+            return
+
+        last_id = chunk[-1][0] if with_email else chunk[-1] if ids_only else chunk[-1].id
+        yield chunk
+
+
+def advance_campaign(campaign, last_subscriber_id, enqueued, shard=None):
+    """
+    Moves the cursor of the campaign (or of its shard) after the processed subscribers and updates the counters.
+    The lease of the shard is renewed (heartbeat).
+
+    Returns:
+    bool: False if the lease of the shard has been lost (it expired and another run took the shard over):
+          the caller must stop processing the shard.
+    """
+    now = timezone.now()
+    campaign.enqueued_count += enqueued
+
+    if shard is None:
+        campaign.last_subscriber_id = last_subscriber_id
+        if campaign.id:
+            Campaign.objects.filter(id=campaign.id).update(
+                last_subscriber_id=last_subscriber_id,
+                enqueued_count=F('enqueued_count') + enqueued,
+                updated_at=now,
+            )
+        return True
+
+    shard.last_subscriber_id = last_subscriber_id
+    shard.enqueued_count += enqueued
+
+    if not shard.id:
+        return True
+
+    Campaign.objects.filter(id=campaign.id).update(enqueued_count=F('enqueued_count') + enqueued, updated_at=now)
+
+    renewed = CampaignShard.objects.filter(id=shard.id, lease_owner=shard.lease_owner).update(
+        last_subscriber_id=last_subscriber_id,
+        enqueued_count=F('enqueued_count') + enqueued,
+        heartbeat_at=now,
+        lease_expires_at=get_lease_expiry(now),
+    )
+    if not renewed:
+        print(f"The lease of {shard} has been lost: another run is processing it")
+    return bool(renewed)
+
+
+def complete_campaign(campaign):
+    campaign.status = Campaign.COMPLETED
+    campaign.completed_at = timezone.now()
+
+    if campaign.id:
+        campaign.save(update_fields=['status', 'completed_at', 'updated_at'])
+
+    print(f"Completed {campaign}")
+
+
+def check_message_can_be_sent(message):
+    """Returns the reason why the message cannot be sent, or None if it can be sent."""
+    newsletter = message.newsletter
+    if not newsletter:
+        return "no newsletter instance found"
+
+    if not newsletter.enabled:
+        return "newsletter is not enabled to send messages"
+
+    if not newsletter.template:
+        return "no template instance found"
+
+    return None
+
+
+def run_campaign(message, number=None, batch_size=None, nosave=False, oksend=True, engine=Campaign.CELERY,
+                 partition=None):
+    """
+    Sends the message to the subscribers of its newsletter that have not yet received it.
+
+    Args:
+    message (Message): The message, see get_message_for_sending.
+    number (int, optional): Maximum number of emails to send in this run; None means all the audience.
+    batch_size (int, optional): If set, the audience is sent in chunks of subscriber ids, each one
+                                rendered and sent by a celery worker; otherwise each email has its own task.
+    nosave (bool): Do not save the results to the database.
+    oksend (bool): Send the emails.
+    engine (str): Campaign.CELERY (celery tasks) or Campaign.ASYNC (the audience is written to the delivery
+                  ledger, and sent by the RunAsyncSender command).
+    partition (tuple, optional): (slot, count): only the shards of the slot, see SendNewsletter --shard.
+
+    Returns:
+    int: The number of emails sent (enqueued).
+    """
+    if error := check_message_can_be_sent(message):
+        print(f"Error: {error}")
+        return 0
+
+    newsletter = message.newsletter
+
+    print(f"message: {message}")
+    print(f"newsletter: {newsletter}")
+    print(f"template: {newsletter.template}")
+
+    # the audience (subscribed subscribers that have not yet received the message) is streamed
+    # in chunks from the cursor of the campaign; an interrupted campaign is resumed
+    campaign = start_or_resume_campaign(message, save=not nosave, engine=engine,
+                                        min_shards=partition[1] if partition else 1)
+
+    print(f"Subscribers not yet reached by the message: {campaign.audience_size - campaign.enqueued_count}")
+
+    if oksend and not nosave:
+        # the notification recipients get a sample copy and a periodic digest, not a copy of every email
+        send_campaign_sample(campaign)
+
+        if campaign.engine == Campaign.CELERY and (partition is None or partition[0] == 0):
+            requeue_stale_deliveries(campaign, batch_size)
+
+    # the audience is split in shards: concurrent runs of the campaign (e.g. on several hosts) lease
+    # different shards, instead of sending the same emails
+    counter = 0
+    finished = True
+
+    for shard in iter_campaign_shards(campaign, get_lease_owner(), partition):
+        print(f"Processing {shard} from subscriber id {shard.last_subscriber_id}")
+        remaining = None if number is None else number - counter
+        shard_finished = False
+        try:
+            if campaign.engine == Campaign.ASYNC:
+                shard_counter, shard_finished = enqueue_for_async_sender(campaign, remaining, nosave, shard)
+            elif batch_size:
+                shard_counter, shard_finished = enqueue_in_batches(campaign, batch_size, remaining, nosave, oksend,
+                                                                   shard)
+            else:
+                shard_counter, shard_finished = enqueue_one_by_one(campaign, remaining, nosave, oksend, shard)
+        finally:
+            release_campaign_shard(shard, completed=shard_finished)
+
+        counter += shard_counter
+        if not shard_finished:
+            finished = False
+            break
+
+    print(f"Sent {counter} messages")
+
+    if campaign.id:
+        # the shards leased by the other runs may still be in progress
+        finished = not campaign.shards.filter(status=CampaignShard.RUNNING).exists()
+
+    if finished:
+        complete_campaign(campaign)
+    else:
+        print("The campaign is not completed, run the command again to resume it "
+              "(or wait for the other runs processing its shards)")
+
+    # a scheduled message whose campaign is not completed stays due: the dispatcher resumes it when it stops
+    # making progress (see find_due_messages)
+    if finished and not nosave:
+        message.processed = True
+        message.processed_at = timezone.now()
+        message.save()
+
+    return counter
+
+
+def run_campaign_partition(message_id, **kwargs):
+    """Runs the campaign of the message in a worker process of run_campaign_in_processes."""
+    from core.logic_newsletter import get_message_for_sending
+
+    return run_campaign(get_message_for_sending(message_id), **kwargs)
+
+
+def run_campaign_in_processes(message, workers, partition=None, number=None, nosave=False, oksend=True,
+                              engine=Campaign.CELERY, **kwargs):
+    """
+    Runs the campaign of the message in a pool of worker processes (see SendNewsletter --workers): each process
+    takes the shards of its own slot, so paging the audience, writing the delivery ledger and enqueueing
+    the emails run on several cores at the same time.
+
+    Args:
+    message (Message): The message, see get_message_for_sending.
+    workers (int): Number of processes.
+    partition (tuple, optional): (slot, count) of this run (see SendNewsletter --shard), split among the workers.
+    number (int, optional): Maximum number of emails to send, split among the workers.
+    The other arguments are the ones of run_campaign.
+
+    Returns:
+    int: The number of emails sent (enqueued).
+    """
+    if error := check_message_can_be_sent(message):
+        print(f"Error: {error}")
+        return 0
+
+    slot, count = partition or (0, 1)
+    if number is not None:
+        workers = max(min(workers, number), 1)
+
+    if not nosave:
+        # the campaign and its shards are created once, before the workers lease the shards
+        campaign = start_or_resume_campaign(message, engine=engine, min_shards=count * workers)
+        if oksend:
+            send_campaign_sample(campaign)
+
+        # a resumed campaign may have fewer shards than workers
+        if count == 1:
+            split_campaign_shards(campaign, workers)
+        shards = sum(1 for index in campaign.shards.filter(status=CampaignShard.RUNNING).values_list('index', flat=True)
+                     if index % count == slot)
+        if shards < workers:
+            print(f"Warning: {shards} shards to process in slot {slot}/{count}, "
+                  f"running {max(shards, 1)} worker processes instead of {workers}")
+            workers = max(shards, 1)
+
+    # the worker processes open their own connections to the database
+    connections.close_all()
+
+    runs = []
+    for worker in range(workers):
+        worker_number = None if number is None else number // workers + (1 if worker < number % workers else 0)
+        runs.append(dict(number=worker_number, nosave=nosave, oksend=oksend, engine=engine,
+                         partition=(slot + count * worker, count * workers), **kwargs))
+
+    print(f"Running {workers} worker processes, slot {slot}/{count}")
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as executor:
+        futures = [executor.submit(run_campaign_partition, message.id, **run) for run in runs]
+        counter = sum(future.result() for future in futures)
+
+    print(f"Sent {counter} messages with {workers} worker processes")
+    return counter
+
+
+def enqueue_one_by_one(campaign, number, nosave, oksend, shard=None):
+    """
+    Send each email with its own celery task; the task only carries the message and subscriber ids,
+    the email is rendered by the worker.
+    """
+    from core.tasks import send_newsletter_email_task
+
+    message_instance = campaign.message
+    bcc = get_bulk_bcc()
+    flow_control = EnqueueFlowControl('core.tasks.send_newsletter_email_task',
+                                      heartbeat=lambda: renew_campaign_shard_lease(shard))
+
+    counter = 0
+
+    for chunk in iter_audience(campaign, with_email=True, shard=shard):
+        if number is not None:
+            chunk = chunk[:number - counter]
+
+        # the recipients of the same domain are spread over the chunk, instead of arriving in a burst
+        recipients = interleave_by_domain(chunk, lambda recipient: recipient[1])
+
+        for start in range(0, len(recipients), ENQUEUE_SLICE_SIZE):
+            subscriber_ids = [subscriber_id for subscriber_id, _ in recipients[start:start + ENQUEUE_SLICE_SIZE]]
+
+            if not nosave:
+                # the delivery ledger is written (QUEUED) right before the tasks are enqueued, the workers record
+                # the outcome: the rows excluded from the audience of a resumed run are the ones enqueued
+                register_message_deliveries(message_instance.id, subscriber_ids)
+
+            if oksend:
+                for subscriber_id in subscriber_ids:
+                    # the outcome is recorded in the delivery ledger and in EventLog by the worker
+                    send_newsletter_email_task.delay(message_instance.id, subscriber_id, bcc=bcc)
+
+                    print(f"Message enqueued for subscriber id {subscriber_id}")
+
+                # no sleep here: the rate limits of the relay and of the recipient domain are enforced
+                # by the celery workers when sending; the producer only waits when the queue is full,
+                # after the tasks of the rows written have been enqueued
+                flow_control.enqueued(len(subscriber_ids), tasks=len(subscriber_ids))
+                if flow_control.stopped:
+                    return counter + start + len(subscriber_ids), False
+
+        counter += len(chunk)
+        if not advance_campaign(campaign, chunk[-1][0], len(chunk), shard):
+            return counter, False
+
+        if number is not None and counter >= number:
+            return counter, False
+
+    return counter, True
+
+
+def enqueue_in_batches(campaign, batch_size, number, nosave, oksend, shard=None):
+    """
+    Fan the audience out in chunks of subscriber ids; the celery workers render and send each chunk.
+    The chunks are grouped by recipient domain, and the chunks of the different domains are interleaved
+    (see plan_domain_batches).
+    """
+    from core.tasks import send_newsletter_batch_task
+
+    message_instance = campaign.message
+    bcc = get_bulk_bcc()
+    flow_control = EnqueueFlowControl('core.tasks.send_newsletter_batch_task',
+                                      heartbeat=lambda: renew_campaign_shard_lease(shard))
+
+    counter = 0
+
+    for recipients in iter_audience(campaign, with_email=True, shard=shard):
+        if number is not None:
+            recipients = recipients[:number - counter]
+
+        enqueued = 0
+        for chunk in plan_domain_batches(recipients, batch_size):
+            if not nosave:
+                # the delivery ledger is written (QUEUED) right before the task of the chunk is enqueued
+                register_message_deliveries(message_instance.id, chunk)
+
+            if oksend:
+                # the outcome of each recipient is recorded in the delivery ledger and in EventLog by the worker
+                send_newsletter_batch_task.delay(message_instance.id, chunk, bcc=bcc)
+                print(f"Enqueued batch of {len(chunk)} recipients (subscriber ids {chunk[0]}-{chunk[-1]})")
+                enqueued += len(chunk)
+                flow_control.enqueued(len(chunk))
+                if flow_control.stopped:
+                    return counter + enqueued, False
+
+        counter += len(recipients)
+        if not advance_campaign(campaign, recipients[-1][0], len(recipients), shard):
+            return counter, False
+
+        if number is not None and counter >= number:
+            return counter, False
+
+    return counter, True
+
+
+def requeue_stale_deliveries(campaign, batch_size=None):
+    """
+    Enqueues again the emails of the message still QUEUED in the delivery ledger CAMPAIGN_REQUEUE_AFTER_SECONDS
+    after their row was written: the run was killed between the row and the task, or the broker has lost the task.
+    They are not part of the audience of the campaign any more (see get_subscribers_pending_delivery).
+    An email sent in the meantime by its first task is not sent twice, see core/send_guard.py.
+
+    Args:
+    campaign (Campaign): The campaign of the message (celery engine).
+    batch_size (int, optional): As in run_campaign: chunks of subscriber ids, or a task for each email.
+
+    Returns:
+    int: The number of emails enqueued again.
+    """
+    from core.tasks import send_newsletter_batch_task, send_newsletter_email_task
+
+    message_id = campaign.message.id
+    stale = timezone.now() - timedelta(seconds=getattr(settings, 'CAMPAIGN_REQUEUE_AFTER_SECONDS', 3 * 3600))
+    stale_records = NewsletterDeliveryRecord.objects.filter(message_id=message_id,
+                                                             status=NewsletterDeliveryRecord.QUEUED,
+                                                             updated_at__lt=stale)
+    subscriber_ids = list(stale_records.order_by('subscriber_id').values_list('subscriber_id', flat=True))
+    if not subscriber_ids:
+        return 0
+
+    bcc = get_bulk_bcc()
+    slice_size = batch_size or ENQUEUE_SLICE_SIZE
+    for start in range(0, len(subscriber_ids), slice_size):
+        chunk = subscriber_ids[start:start + slice_size]
+        # the rows are enqueued again only once every CAMPAIGN_REQUEUE_AFTER_SECONDS
+        stale_records.filter(subscriber_id__in=chunk).update(updated_at=timezone.now())
+        if batch_size:
+            send_newsletter_batch_task.delay(message_id, chunk, bcc=bcc)
+        else:
+            for subscriber_id in chunk:
+                send_newsletter_email_task.delay(message_id, subscriber_id, bcc=bcc)
+
+    print(f"Enqueued again {len(subscriber_ids)} recipients queued before {stale} and not yet sent")
+    return len(subscriber_ids)
+
+
+def enqueue_for_async_sender(campaign, number, nosave, shard=None):
+    """
+    Write the audience to the delivery ledger (QUEUED), in bulk: the ledger is the outbox claimed by the
+    AsyncSender engines (RunAsyncSender command), so the queued emails do not depend on the memory of the broker.
+    """
+    if nosave:
+        print("The async sender only sends the emails written to the delivery ledger: nothing to do with --nosave")
+        return 0, False
+
+    message_instance = campaign.message
+
+    counter = 0
+
+    for subscriber_ids in iter_audience(campaign, ids_only=True, shard=shard):
+        if number is not None:
+            subscriber_ids = subscriber_ids[:number - counter]
+
+        # the rows of the outbox and the cursor of the campaign are written together: a run killed in between
+        # resumes from a cursor that matches the rows already queued
+        with transaction.atomic():
+            register_message_deliveries(message_instance.id, subscriber_ids)
+            advanced = advance_campaign(campaign, subscriber_ids[-1], len(subscriber_ids), shard)
+        print(f"Queued {len(subscriber_ids)} recipients (subscriber ids {subscriber_ids[0]}-{subscriber_ids[-1]})")
+
+        counter += len(subscriber_ids)
+        if not advanced:
+            return counter, False
+
+        if number is not None and counter >= number:
+            return counter, False
+
+    return counter, True
+
+
+def find_due_messages(now=None):
+    """
+    Returns the messages scheduled (to_be_processed_at) up to now and not yet dispatched, and the messages
+    dispatched more than SCHEDULED_DISPATCH_TIMEOUT_SECONDS ago whose campaign is not making progress
+    (e.g. run_campaign_task has been lost by the broker, or its worker has died): they are dispatched again,
+    and their campaign is resumed.
+
+    Returns:
+    list: (message id, dispatched_at) tuples, see claim_message_for_dispatch.
+    """
+    now = now or timezone.now()
+    stale = now - timedelta(seconds=getattr(settings, 'SCHEDULED_DISPATCH_TIMEOUT_SECONDS', 1800))
+
+    # a campaign that has moved its cursor, or whose shards are leased, is still being processed
+    active_campaigns = Campaign.objects.filter(message_id=OuterRef('id'), status=Campaign.RUNNING).filter(
+        Q(updated_at__gte=stale) | Q(shards__lease_expires_at__gt=now))
+
+    return list(Message.objects
+                .filter(processed=False, to_be_processed_at__lte=now)
+                .filter(Q(dispatched_at__isnull=True) | Q(dispatched_at__lt=stale))
+                .filter(newsletter__enabled=True)
+                .exclude(Exists(active_campaigns))
+                .order_by('to_be_processed_at')
+                .values_list('id', 'dispatched_at'))
+
+
+def claim_message_for_dispatch(message_id, dispatched_at=None):
+    """
+    Atomically claims a due message: only one dispatcher (among several scheduler instances) succeeds.
+
+    Args:
+    message_id (int): The ID of the message.
+    dispatched_at (datetime, optional): The dispatched_at of the message when it was found due
+                                        (None if it has never been dispatched).
+
+    Returns:
+    bool: True if the message has been claimed by the caller.
+    """
+    return Message.objects.filter(
+        id=message_id, processed=False, dispatched_at=dispatched_at
+    ).update(dispatched_at=timezone.now()) == 1
+
+
+def dispatch_scheduled_messages(start_campaign):
+    """
+    Claims the messages that are due and starts their campaign.
+
+    Args:
+    start_campaign (callable): Called with the id of each claimed message (e.g. run_campaign_task.delay).
+
+    Returns:
+    list: The ids of the dispatched messages.
+    """
+    dispatched = []
+
+    for message_id, dispatched_at in find_due_messages():
+        if not claim_message_for_dispatch(message_id, dispatched_at):
+            continue
+
+        if dispatched_at:
+            print(f"dispatch_scheduled_messages - dispatching again message {message_id}, "
+                  f"dispatched at {dispatched_at} and not progressing")
+        print(f"dispatch_scheduled_messages - dispatching message {message_id}")
+        create_event_log(
+            event_type="MESSAGE_DISPATCHED",
+            event_title=f"Scheduled message dispatched - message id: {message_id}",
+            event_data=f"message: {message_id}",
+        )
+        start_campaign(message_id)
+        dispatched.append(message_id)
+
+    return dispatched
@@ -1,9 +1,19 @@
-from django.core.mail import EmailMessage
+import os
+import random
+import re
+import smtplib
+import threading
+import time
+from contextlib import contextmanager
+
+from django.core.mail import EmailMessage, get_connection
 from django.conf import settings
 from django.core.mail.backends.smtp import EmailBackend
 from django.utils import timezone
 
+from core.mime_utils import PreEncodedEmailMessage, get_mime_skeleton
 from core.models import Message, EmailSettings
+from core.rate_limit import acquire_email_settings_slot
 
 
 def send_message(msg: Message):
@@ -28,9 +38,490 @@ def send_message(msg: Message):
         print("Message has already been sent.")
 
 
-def send_custom_email(sender_email, recipient_email, subject, html_content, bcc=None, email_settings_id=None):
+# errors returned by the relay for a single message: smtplib resets the session, which can be reused
+SESSION_PRESERVING_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError)
+
+
+class DeliveryUncertainError(smtplib.SMTPServerDisconnected):
+    """
+    The session failed after the message had reached the DATA command, before the reply of the relay: the relay
+    may have accepted the message. It must not be sent through another relay, and its idempotency key is not
+    released (see core/send_guard.py): any retry waits until the reservation expires.
+    """
+
+# classification of the sending errors
+TRANSIENT = "TRANSIENT"  # retry with exponential backoff (4xx replies, connection errors)
+THROTTLED = "THROTTLED"  # the relay asks to slow down: retry later, with a longer backoff
+PERMANENT = "PERMANENT"  # do not retry (5xx replies, invalid messages)
+
+# replies of the relays that ask to slow down; "try again later" is in most of the 4xx replies, it is not a signal
+THROTTLING_REPLY_RE = re.compile(r"\brate[ -]?limit|\bthrottl|\btoo many\b|\bslow down\b", re.IGNORECASE)
+
+
+def get_smtp_error_reply(exc):
+    """Returns the (code, text) of the SMTP reply that caused the exception, or (None, str(exc))."""
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        # all the recipients have been refused: consider the reply with the lowest code (4xx before 5xx)
+        replies = sorted(exc.recipients.values(), key=lambda reply: reply[0])
+        if replies:
+            code, text = replies[0]
+            return code, text.decode('utf-8', 'replace') if isinstance(text, bytes) else str(text)
+        return None, str(exc)
+
+    if isinstance(exc, smtplib.SMTPResponseException):
+        text = exc.smtp_error
+        return exc.smtp_code, text.decode('utf-8', 'replace') if isinstance(text, bytes) else str(text)
+
+    return None, str(exc)
+
+
+def classify_smtp_error(exc):
+    """
+    Classifies a sending error as TRANSIENT, THROTTLED or PERMANENT.
+
+    Returns:
+    tuple: (error_class, smtp_code); smtp_code is None if the error is not an SMTP reply.
+    """
+    code, text = get_smtp_error_reply(exc)
+
+    if code is not None and 400 <= code < 500:
+        if code == 421 or THROTTLING_REPLY_RE.search(text):
+            return THROTTLED, code
+        return TRANSIENT, code
+
+    if code is not None and 500 <= code < 600:
+        return PERMANENT, code
+
+    if isinstance(exc, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, ConnectionError, TimeoutError)):
+        return TRANSIENT, code
+
+    if isinstance(exc, OSError) and not isinstance(exc, smtplib.SMTPException):
+        # network errors (e.g. connection reset, host unreachable)
+        return TRANSIENT, code
+
+    return PERMANENT, code
+
+
+def get_retry_countdown(retries, error_class):
+    """
+    Seconds to wait before the next attempt: exponential backoff with full jitter (uniform between 0 and the
+    backoff, so that the failures of a burst are not retried together), longer when the relay is throttling.
+    """
+    if error_class == THROTTLED:
+        base = getattr(settings, 'EMAIL_RETRY_THROTTLED_BASE_SECONDS', 30)
+    else:
+        base = getattr(settings, 'EMAIL_RETRY_BASE_SECONDS', 2)
+    cap = getattr(settings, 'EMAIL_RETRY_MAX_SECONDS', 600)
+
+    return random.uniform(0, min(cap, base * 2 ** retries))
+
+
+class _DataReplyMixin:
+    """
+    Keeps the reply of the relay to the last DATA command (e.g. 250 2.0.0 Ok: queued as 4BC3F2)
+    and the recipients refused in the last transaction.
+    Counts the DATA commands sent in the session: once a message has reached DATA, the relay may have accepted it
+    even if the session is dropped before the reply.
+    """
+
+    last_data_reply = None
+    last_refused = None
+    data_commands = 0
+
+    def data(self, msg):
+        self.data_commands += 1
+        self.last_data_reply = super().data(msg)
+        return self.last_data_reply
+
+    def sendmail(self, *args, **kwargs):
+        self.last_refused = {}
+        self.last_refused = super().sendmail(*args, **kwargs)
+        return self.last_refused
+
+
+class ReplyRecordingSMTP(_DataReplyMixin, smtplib.SMTP):
+    pass
+
+
+class ReplyRecordingSMTP_SSL(_DataReplyMixin, smtplib.SMTP_SSL):
+    pass
+
+
+class ReplyRecordingEmailBackend(EmailBackend):
+    """
+    SMTP email backend that stores the reply of the relay to each message in email_message.smtp_reply,
+    and the refused recipients in email_message.smtp_refused.
+    """
+
+    @property
+    def connection_class(self):
+        return ReplyRecordingSMTP_SSL if self.use_ssl else ReplyRecordingSMTP
+
+    def _send(self, email_message):
+        sent = super()._send(email_message)
+        if sent and self.connection is not None:
+            email_message.smtp_reply = getattr(self.connection, 'last_data_reply', None)
+            email_message.smtp_refused = getattr(self.connection, 'last_refused', None) or {}
+        return sent
+
+
+def get_smtp_reply(email_message):
+    """Returns the (code, text) of the reply of the relay to the email message, or (None, None) if not known."""
+    reply = getattr(email_message, 'smtp_reply', None)
+    if not reply:
+        return None, None
+    code, text = reply
+    return code, text.decode('utf-8', 'replace') if isinstance(text, bytes) else str(text)
+
+
+def get_refused_recipients(email_message):
+    """
+    Returns the recipients of the email message refused by the relay (the message has been sent to the others),
+    as a dictionary {address: (code, text)}.
+    """
+    return {
+        address: (code, text.decode('utf-8', 'replace') if isinstance(text, bytes) else str(text))
+        for address, (code, text) in (getattr(email_message, 'smtp_refused', None) or {}).items()
+    }
+
+
+def count_recipients(email_messages):
+    """
+    Returns the number of recipients of the email messages (To, Cc and Bcc), the unit of the rate limits of the
+    relays: an envelope email to 50 recipients counts as 50 emails.
+    """
+    return sum(max(1, len(email_message.recipients())) for email_message in email_messages)
+
+
+class PooledConnection:
+    """An open email backend connection, together with the data needed to decide when to recycle it."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.messages_sent = 0
+        self.last_used = None
+
+    def is_open(self):
+        return getattr(self.backend, 'connection', None) is not None
+
+    def is_alive(self):
+        """Health check of an idle SMTP session with the NOOP command."""
+        smtp_connection = getattr(self.backend, 'connection', None)
+        if smtp_connection is None:
+            # not an SMTP backend (e.g. locmem or console backend): nothing to check
+            return True
+        try:
+            status, _ = smtp_connection.noop()
+        except (smtplib.SMTPException, OSError):
+            return False
+        return status == 250
+
+    def close(self):
+        try:
+            self.backend.close()
+        except Exception as e:
+            print(f"PooledConnection.close - Exception: {e}")
+        self.messages_sent = 0
+        self.last_used = None
+
+
+class EmailConnectionPool:
+    """
+    Per-process pool of persistent email connections, one for each EmailSettings instance
+    (key None is used for the default connection defined in settings.py).
+
+    Connections are kept open across celery tasks, health-checked with NOOP when they have been idle,
+    reopened when the relay closes them and recycled after EMAIL_POOL_MAX_MESSAGES_PER_CONNECTION messages.
+    """
+
+    def __init__(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._connections = {}
+        self._email_settings = {}
+
+    def _check_pid(self):
+        # connections opened before a fork (e.g. by the celery parent process) must not be shared
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._connections = {}
+            self._email_settings = {}
+
+    def get_email_settings(self, email_settings_id):
+        """Returns the EmailSettings dictionary for the given id, cached for EMAIL_POOL_SETTINGS_TTL_SECONDS."""
+        ttl = getattr(settings, 'EMAIL_POOL_SETTINGS_TTL_SECONDS', 300)
+        cached = self._email_settings.get(email_settings_id)
+        if cached and time.monotonic() - cached[0] < ttl:
+            return cached[1]
+
+        email_settings = EmailSettings.objects.get(id=email_settings_id).to_dict()
+        self._email_settings[email_settings_id] = (time.monotonic(), email_settings)
+        return email_settings
+
+    def _create_backend(self, email_settings_id):
+        if email_settings_id is None:
+            if settings.EMAIL_BACKEND == 'django.core.mail.backends.smtp.EmailBackend':
+                return get_connection('core.logic_email.ReplyRecordingEmailBackend')
+            return get_connection()
+
+        email_settings = self.get_email_settings(email_settings_id)
+        return ReplyRecordingEmailBackend(
+            host=email_settings['host'],
+            port=email_settings['port'],
+            username=email_settings['username'],
+            password=email_settings['password'],
+            use_tls=email_settings['use_tls']
+        )
+
+    def _get_pooled_connection(self, email_settings_id):
+        with self._lock:
+            self._check_pid()
+            pooled_connection = self._connections.get(email_settings_id)
+            if pooled_connection is None:
+                pooled_connection = PooledConnection(self._create_backend(email_settings_id))
+                self._connections[email_settings_id] = pooled_connection
+            return pooled_connection
+
+    def _prepare(self, pooled_connection):
+        """Makes sure that the pooled connection is open and usable."""
+        max_messages = getattr(settings, 'EMAIL_POOL_MAX_MESSAGES_PER_CONNECTION', 100)
+        noop_after = getattr(settings, 'EMAIL_POOL_NOOP_AFTER_SECONDS', 30)
+
+        if pooled_connection.is_open():
+            if pooled_connection.messages_sent >= max_messages:
+                print(f"EmailConnectionPool - recycling connection after {pooled_connection.messages_sent} messages")
+                pooled_connection.close()
+            elif (pooled_connection.last_used is not None
+                  and time.monotonic() - pooled_connection.last_used > noop_after
+                  and not pooled_connection.is_alive()):
+                print("EmailConnectionPool - connection closed by the relay, reconnecting")
+                pooled_connection.close()
+
+        if not pooled_connection.is_open():
+            pooled_connection.backend.open()
+
+    @contextmanager
+    def connection(self, email_settings_id=None):
+        """
+        Context manager that yields an open email backend for the given EmailSettings id.
+        The connection stays open when the context exits, and is reused by the next caller.
+        The caller must respect the rate limit of the relay, see throttle().
+        """
+        pooled_connection = self._get_pooled_connection(email_settings_id)
+        with pooled_connection.lock:
+            self._prepare(pooled_connection)
+            try:
+                yield pooled_connection.backend
+            except SESSION_PRESERVING_ERRORS:
+                raise
+            except Exception:
+                # the state of the SMTP session is unknown, do not reuse it
+                pooled_connection.close()
+                raise
+            finally:
+                pooled_connection.last_used = time.monotonic()
+
+    def throttle(self, email_settings_id, messages=1):
+        """
+        Waits until the rate limit of the relay (shared by all the workers) allows sending the messages;
+        messages is the number of recipients, see count_recipients.
+        """
+        email_settings = self.get_email_settings(email_settings_id) if email_settings_id is not None else None
+        return acquire_email_settings_slot(email_settings, messages)
+
+    def send_messages(self, email_messages, email_settings_id=None, throttle=True, results=None):
+        """
+        Sends the email messages over the pooled connection for the given EmailSettings id,
+        respecting the rate limit of the relay (unless throttle is False: the caller has already waited).
+        If the relay has dropped the session before any message has reached the DATA command (e.g. an idle session
+        closed by the relay after the NOOP check), the connection is reopened and the sending retried once;
+        otherwise the error is raised, a message accepted by the relay is never sent twice: if the session has failed
+        after a message has reached DATA, the error is a DeliveryUncertainError.
+
+        Args:
+        email_messages (list): The EmailMessage instances.
+        email_settings_id (int, optional): The EmailSettings id (None: the default connection).
+        throttle (bool): Whether to wait for the rate limit of the relay.
+        results (list, optional): If given, the errors concerning a single message (SESSION_PRESERVING_ERRORS,
+            e.g. a refused recipient) do not stop the sending: for each message, in order, None (sent) or the
+            exception is appended to results. If an error is raised, the messages after the ones in results
+            have not been transmitted to the relay (a DeliveryUncertainError is also appended to results).
+
+        Returns:
+        int: The number of messages sent.
+        """
+        if throttle:
+            self.throttle(email_settings_id, count_recipients(email_messages))
+
+        first_result = len(results) if results is not None else 0
+        pooled_connection = self._get_pooled_connection(email_settings_id)
+        with pooled_connection.lock:
+            for attempt in range(2):
+                self._prepare(pooled_connection)
+                smtp_connection = getattr(pooled_connection.backend, 'connection', None)
+                data_commands = getattr(smtp_connection, 'data_commands', None)
+                try:
+                    if results is None:
+                        sent = pooled_connection.backend.send_messages(email_messages) or 0
+                    else:
+                        self._send_each(pooled_connection.backend,
+                                        email_messages[len(results) - first_result:], results)
+                        sent = results[first_result:].count(None)
+                except SESSION_PRESERVING_ERRORS:
+                    raise
+                except Exception as e:
+                    # the state of the SMTP session is unknown, do not reuse it
+                    pooled_connection.close()
+                    if isinstance(e, DeliveryUncertainError):
+                        raise
+                    reached_data = data_commands is not None and smtp_connection.data_commands != data_commands
+                    if results is None and reached_data:
+                        # the relay may have accepted the messages that have reached DATA
+                        raise DeliveryUncertainError(f"the relay has failed after DATA: {e}") from e
+                    if (attempt or data_commands is None or reached_data
+                            or not isinstance(e, smtplib.SMTPServerDisconnected)):
+                        raise
+                    print("EmailConnectionPool - relay disconnected, retrying with a new connection")
+                    continue
+                pooled_connection.messages_sent += sent
+                pooled_connection.last_used = time.monotonic()
+                return sent
+
+    @staticmethod
+    def _send_each(backend, email_messages, results):
+        """
+        Sends the messages one at a time over the open backend, appending None or the error of each to results.
+        If the session fails after a message has reached DATA, a DeliveryUncertainError is appended and raised.
+        """
+        for email_message in email_messages:
+            smtp_connection = getattr(backend, 'connection', None)
+            data_commands = getattr(smtp_connection, 'data_commands', None)
+            try:
+                backend.send_messages([email_message])
+            except SESSION_PRESERVING_ERRORS as e:
+                # smtplib has reset the session, the next messages can be sent
+                results.append(e)
+            except Exception as e:
+                if data_commands is not None and smtp_connection.data_commands != data_commands:
+                    results.append(DeliveryUncertainError(f"the relay has failed after DATA: {e}"))
+                    raise results[-1] from e
+                raise
+            else:
+                results.append(None)
+
+    def discard(self, email_settings_id):
+        """Closes the pooled connection and forgets the cached settings of the given EmailSettings id."""
+        with self._lock:
+            pooled_connection = self._connections.pop(email_settings_id, None)
+            self._email_settings.pop(email_settings_id, None)
+        if pooled_connection:
+            with pooled_connection.lock:
+                pooled_connection.close()
+
+    def close_all(self):
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections = {}
+            self._email_settings = {}
+        for pooled_connection in connections:
+            with pooled_connection.lock:
+                pooled_connection.close()
+
+
+# one pool per process (each celery worker process has its own pool)
+email_connection_pool = EmailConnectionPool()
+
+
+def create_custom_email(sender_email, recipient_email, subject, html_content, bcc=None):
+    """
+    Returns the HTML EmailMessage sent by send_custom_email.
+    The MIME encoding of the content is cached in the process (see get_mime_skeleton): when the same email
+    is sent to many recipients, only the headers of each recipient are encoded.
+    """
+    # Create the email message
+    return PreEncodedEmailMessage(
+        get_mime_skeleton(subject, sender_email, html_content or ''),
+        to=[recipient_email],  # Recipient's email
+        bcc=bcc,  # BCC recipients
+    )
+
+
+def send_email(email, email_settings_id=None, relays=None):
+    """
+    Sends the email message through the pooled connection of the given EmailSettings or, if relays is set,
+    through one of the relays (with failover to the others).
+    After the sending, the reply of the relay is available with get_smtp_reply(email).
+
+    Returns:
+    int: The number of messages sent.
+    """
+    print(f"email_settings_id: {email_settings_id} relays: {relays}")
+
+    if relays:
+        from core.relays import send_with_failover
+        send_with_failover([email], relays)
+        return 1
+
+    return email_connection_pool.send_messages([email], email_settings_id)  # Send the email
+
+
+def create_envelope_email(sender_email, recipients, subject, html_content, bcc=None):
+    """
+    Returns an HTML EmailMessage with many envelope recipients, sent with a single SMTP transaction.
+    The recipients are not in the headers (To: undisclosed-recipients), so they are hidden from each other.
+    """
+    email = EmailMessage(
+        subject,
+        html_content,
+        sender_email,
+        bcc=list(recipients) + list(bcc or []),
+        headers={'To': 'undisclosed-recipients:;'},
+    )
+    email.content_subtype = "html"
+    return email
+
+
+def split_envelope_batches(recipients, max_recipients=None, reserved=0):
+    """
+    Splits the recipients in batches of at most max_recipients (default: EMAIL_ENVELOPE_MAX_RECIPIENTS),
+    the number of RCPT commands accepted by the relay in a transaction. The first batch leaves room for
+    reserved recipients added to its envelope (e.g. the BCC copy of the notification recipients).
+    """
+    max_recipients = max(1, max_recipients or getattr(settings, 'EMAIL_ENVELOPE_MAX_RECIPIENTS', 50))
+    recipients = list(recipients)
+    if not recipients:
+        return []
+
+    first = max(1, max_recipients - reserved)
+    return [recipients[:first]] + [recipients[start:start + max_recipients]
+                                   for start in range(first, len(recipients), max_recipients)]
+
+
+def send_envelope_email(sender_email, recipients, subject, html_content, bcc=None, email_settings_id=None,
+                        relays=None):
+    """
+    Sends the same HTML email to all the recipients with a single SMTP transaction (one message, a RCPT TO
+    for each recipient); use it only when the content is not personalized.
+
+    Returns:
+    dict: The refused recipients {address: (code, text)}; the email has been sent to the other ones.
+    """
+    email = create_envelope_email(sender_email, recipients, subject, html_content, bcc)
+    try:
+        send_email(email, email_settings_id, relays)
+    except smtplib.SMTPRecipientsRefused as e:
+        # no recipient has been accepted, nothing has been sent
+        email.smtp_refused = e.recipients
+    return get_refused_recipients(email)
+
+
+def send_custom_email(sender_email, recipient_email, subject, html_content, bcc=None, email_settings_id=None,
+                      relays=None):
     """
     Send a custom HTML email to a given email address, with optional BCC.
+    The email is sent through the pooled connection of the given EmailSettings or, if relays is set,
+    through one of the relays (with failover to the others).
 
     Args:
     sender_email (str): The sender's email address.
@@ -38,30 +529,43 @@ def send_custom_email(sender_email, recipient_email, subject, html_content, bcc=
     subject (str): The subject of the email.
     html_content (str): The HTML content of the email.
     bcc (list, optional): List of email addresses to BCC.
+    email_settings_id (int, optional): The EmailSettings id; if None, the default email connection is used.
+    relays (list, optional): The relays of the newsletter, see core.relays.get_newsletter_relays.
     """
+    email = create_custom_email(sender_email, recipient_email, subject, html_content, bcc)
+    return send_email(email, email_settings_id, relays)
 
-    email_settings = EmailSettings.objects.get(id=email_settings_id) if email_settings_id else None
 
-    # Setup email backend with settings from the model
-    backend = EmailBackend(
-        host=email_settings.host,
-        port=email_settings.port,
-        username=email_settings.username,
-        password=email_settings.password,
-        use_tls=email_settings.use_tls
-    ) if email_settings else None
+def replay_dead_letters(dead_letters):
+    """
+    Enqueues again the emails of the given dead letters and marks them as replayed.
+    Newsletter emails are rendered again (grouped in a batch for each message), the other emails
+    are sent again with the arguments of their send_custom_email_task.
 
-    print(f"email_settings: {email_settings}")
-    print(f"backend: {backend}")
+    Args:
+    dead_letters (QuerySet): The DeadLetter instances to replay.
 
-    # Create the email message
-    email = EmailMessage(
-        subject,
-        html_content,
-        sender_email,  # Sender's email
-        [recipient_email],  # Recipient's email
-        bcc=bcc,  # BCC recipients
-        connection=backend  # Optional connection backend
-    )
-    email.content_subtype = "html"  # Indicate that the email content is HTML
-    email.send()  # Send the email
+    Returns:
+    int: The number of replayed emails.
+    """
+    from core.tasks import send_custom_email_task, send_newsletter_batch_task
+
+    batches = {}
+    replayed = []
+
+    for dead_letter in dead_letters.filter(replayed_at__isnull=True).order_by('id'):
+        if dead_letter.task_kwargs:
+            send_custom_email_task.apply_async(kwargs=dead_letter.task_kwargs)
+        elif dead_letter.message_id and dead_letter.subscriber_id:
+            batches.setdefault(dead_letter.message_id, []).append(dead_letter.subscriber_id)
+        else:
+            print(f"replay_dead_letters - nothing to replay for {dead_letter}")
+            continue
+        replayed.append(dead_letter.id)
+
+    for message_id, subscriber_ids in batches.items():
+        send_newsletter_batch_task.delay(message_id, subscriber_ids)
+
+    dead_letters.model.objects.filter(id__in=replayed).update(replayed_at=timezone.now())
+
+    return len(replayed)
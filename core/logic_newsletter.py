@@ -0,0 +1,397 @@
+import re
+import threading
+from collections import OrderedDict, Counter
+
+from django.conf import settings
+from django.core.mail import EmailMessage
+from django.db.models import Exists, OuterRef
+from django.template import Context, Variable, VariableDoesNotExist
+from django.template.base import render_value_in_context
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.safestring import mark_safe
+
+from core.business_logic import create_event_logs
+from core.html_utils import make_urls_absolute
+from core.logic_email import classify_smtp_error, get_smtp_reply, DeliveryUncertainError
+from core.mime_utils import MimeSkeleton, PreEncodedEmailMessage
+from core.models import Message, SubscriptionToNewsletter, EventLog, NewsletterDeliveryRecord
+from core.rate_limit import acquire_domain_slot
+from core.recipient_domains import get_email_domain, interleave_by_domain
+from core.relays import get_newsletter_relays, send_with_failover
+from core.send_guard import get_newsletter_send_key, reserve_send, mark_sent, release_send, ALREADY_SENT, \
+    IN_PROGRESS
+from core.template_utils import render_email_template, get_rnd_str
+from simple_newsletter.settings import BASE_URL
+
+
+def generate_unsubscribe_link(subscriber):
+    # Use Django's reverse to create the URL for the unsubscribe view
+    return reverse('unsubscribe', args=[str(subscriber.unsubscribe_token)])
+
+
+def generate_message_web_view(message):
+    return reverse('view_message', args=[str(message.view_token)])
+
+
+def get_sender_address(newsletter):
+    return f"{newsletter.name} <{newsletter.from_email}>" if newsletter.name else newsletter.from_email
+
+
+def get_message_for_sending(message_id):
+    """Returns the message, with newsletter, template and email settings fetched in the same query."""
+    return (Message.objects
+            .select_related('newsletter__template', 'newsletter__email_settings')
+            .get(id=message_id))
+
+
+def build_campaign_context(message):
+    """The part of the template context that is the same for all the recipients of the message."""
+    return {
+        # "newsletter": newsletter_instance,
+        "message": message,
+        "subject": message.subject,
+        "content": message.message_content,
+        "web_version_view": BASE_URL + generate_message_web_view(message),
+        "year": timezone.now().year,
+    }
+
+
+def build_newsletter_context(message, subscriber):
+    # each subscriber has a unique token
+    context = build_campaign_context(message)
+    context.update({
+        "subscriber": subscriber,
+        "rnd_str": get_rnd_str(),
+        "unsubscribe_link": BASE_URL + generate_unsubscribe_link(subscriber),
+    })
+    return context
+
+
+def render_newsletter_email(message, subscriber):
+    """
+    Renders the newsletter template of the message for the given subscriber.
+
+    Args:
+    message (Message): The message to send.
+    subscriber (SubscriptionToNewsletter): The recipient of the message.
+
+    Returns:
+    str: The HTML content of the email, with absolute URLs.
+    """
+    newsletter = message.newsletter
+
+    html_content = render_email_template(newsletter.template, context=build_newsletter_context(message, subscriber))
+
+    # the content of each recipient is unique (rnd_str, unsubscribe link): not cached
+    return make_urls_absolute(html_content, newsletter.base_url, cache=False)
+
+
+# slot markers used in the skeleton (characters of the unicode private use area, never escaped by django)
+SLOT_START = "\ue000"
+SLOT_END = "\ue001"
+
+# the parts of the context that depend on the subscriber
+PER_RECIPIENT_NAMES_RE = re.compile(r"\b(subscriber|rnd_str|unsubscribe_link)\b")
+SIMPLE_SLOT_RE = re.compile(r"^\{\{\s*(subscriber(\.\w+)*|rnd_str|unsubscribe_link)\s*}}$")
+TEMPLATE_BLOCK_RE = re.compile(r"{%.*?%}|{{.*?}}|{#.*?#}", re.DOTALL)
+SLOT_RE = re.compile(f"{SLOT_START}([^{SLOT_END}]*){SLOT_END}")
+SUBSCRIBER_SLOT_AT_URL_START_RE = re.compile(f"(?:href|src)\\s*=\\s*[\"']?{SLOT_START}subscriber", re.IGNORECASE)
+
+
+class SubscriberSlots:
+    """Stands in for the subscriber while rendering the skeleton: each attribute renders as a slot marker."""
+
+    def __init__(self, path="subscriber"):
+        self._path = path
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return SubscriberSlots(f"{self._path}.{name}")
+
+    def __str__(self):
+        return f"{SLOT_START}{self._path}{SLOT_END}"
+
+    def __html__(self):
+        return str(self)
+
+
+def can_use_skeleton(template_body):
+    """
+    Returns True if the per-recipient parts of the template (subscriber, rnd_str, unsubscribe_link)
+    are only used as plain {{ variable }} output, so that they can be replaced by slots.
+    Filters, tags, comments or includes referring to them require a full render for each recipient.
+    """
+    if "autoescape" in template_body or "{% include" in template_body or "{% extends" in template_body:
+        return False
+
+    if not BASE_URL or BASE_URL.startswith('/'):
+        # relative unsubscribe links would be rewritten by make_urls_absolute
+        return False
+
+    for block in TEMPLATE_BLOCK_RE.findall(template_body):
+        if PER_RECIPIENT_NAMES_RE.search(block) and not SIMPLE_SLOT_RE.match(block):
+            return False
+
+    return True
+
+
+class NewsletterSkeleton:
+    """
+    The newsletter email of a message, rendered once for the whole campaign.
+
+    Everything that does not depend on the subscriber is rendered (and its URLs made absolute) once;
+    the skeleton keeps slots for subscriber attributes, rnd_str and unsubscribe_link, so that
+    the email of each recipient is assembled by joining strings with the escaped values.
+    The MIME encoding of the static parts is cached as well (see create_email).
+    If the template cannot be split in this way, each email is fully rendered by render_newsletter_email.
+    """
+
+    def __init__(self, message):
+        self.message = message
+        self.parts = self._build(message)
+        self.mime_skeleton = None
+
+    @property
+    def is_static(self):
+        return self.parts is not None
+
+    @staticmethod
+    def _build(message):
+        newsletter = message.newsletter
+
+        if not can_use_skeleton(newsletter.template.body):
+            print(f"NewsletterSkeleton - template {newsletter.template} requires a full render for each recipient")
+            return None
+
+        context = build_campaign_context(message)
+        context.update({
+            "subscriber": SubscriberSlots(),
+            "rnd_str": mark_safe(f"{SLOT_START}rnd_str{SLOT_END}"),
+            "unsubscribe_link": mark_safe(f"{SLOT_START}unsubscribe_link{SLOT_END}"),
+        })
+
+        html_content = render_email_template(newsletter.template, context=context)
+        html_content = make_urls_absolute(html_content, newsletter.base_url)
+
+        if SUBSCRIBER_SLOT_AT_URL_START_RE.search(html_content):
+            # the value of a subscriber attribute used as a relative URL would be rewritten by make_urls_absolute
+            return None
+
+        # even indexes: static html; odd indexes: slot names
+        parts = SLOT_RE.split(html_content)
+        if any(SLOT_START in part or SLOT_END in part for part in parts[::2]):
+            return None
+
+        return parts
+
+    def render(self, subscriber):
+        """Returns the HTML content of the email for the given subscriber."""
+        if self.parts is None:
+            return render_newsletter_email(self.message, subscriber)
+
+        html_parts = list(self.parts)
+        html_parts[1::2] = self.render_values(subscriber)
+        return mark_safe("".join(html_parts))
+
+    def render_values(self, subscriber):
+        """Returns the escaped values of the slots of the skeleton for the given subscriber."""
+        values = {
+            "rnd_str": get_rnd_str(),
+            "unsubscribe_link": BASE_URL + generate_unsubscribe_link(subscriber),
+        }
+
+        context = Context({"subscriber": subscriber})
+
+        rendered_values = []
+        for slot in self.parts[1::2]:
+            if slot in values:
+                value = values[slot]
+            else:
+                try:
+                    value = Variable(slot).resolve(context)
+                except VariableDoesNotExist:
+                    value = ""
+            rendered_values.append(render_value_in_context(value, context))
+
+        return rendered_values
+
+    def create_email(self, subscriber, bcc=None):
+        """
+        Returns the EmailMessage for the subscriber. The headers and the static parts of the body are MIME-encoded
+        once for the message (see MimeSkeleton): only the values of the subscriber are encoded for each email.
+        """
+        if self.parts is None:
+            email = EmailMessage(self.message.subject, self.render(subscriber),
+                                 get_sender_address(self.message.newsletter), [subscriber.email], bcc=bcc)
+            email.content_subtype = "html"
+            return email
+
+        if self.mime_skeleton is None:
+            self.mime_skeleton = MimeSkeleton(self.message.subject, get_sender_address(self.message.newsletter),
+                                              self.parts[::2])
+
+        return PreEncodedEmailMessage(self.mime_skeleton, self.render_values(subscriber), [subscriber.email], bcc)
+
+
+class NewsletterSkeletonCache:
+    """
+    Process-wide LRU cache of the skeletons of the messages being sent, so that a celery worker renders
+    the parts of the message that do not depend on the subscriber once, and not for each task.
+    The key includes updated_at of the message, the newsletter and the template: an edit is never missed.
+    """
+
+    def __init__(self, max_size=None):
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._skeletons = OrderedDict()
+
+    @property
+    def max_size(self):
+        return self._max_size or getattr(settings, 'NEWSLETTER_SKELETON_CACHE_SIZE', 16)
+
+    def get(self, message):
+        """Returns the NewsletterSkeleton of the message (see get_message_for_sending), building it if needed."""
+        newsletter = message.newsletter
+        key = (message.id, message.updated_at, newsletter.updated_at, newsletter.template_id,
+               newsletter.template.updated_at)
+
+        with self._lock:
+            skeleton = self._skeletons.get(key)
+            if skeleton is not None:
+                self._skeletons.move_to_end(key)
+                return skeleton
+
+        skeleton = NewsletterSkeleton(message)
+
+        with self._lock:
+            # drop the skeletons built before the last update of the message
+            for stale_key in [k for k in self._skeletons if k[0] == message.id]:
+                del self._skeletons[stale_key]
+            self._skeletons[key] = skeleton
+            while len(self._skeletons) > self.max_size:
+                self._skeletons.popitem(last=False)
+
+        return skeleton
+
+    def clear(self):
+        with self._lock:
+            self._skeletons.clear()
+
+
+newsletter_skeleton_cache = NewsletterSkeletonCache()
+
+
+def send_newsletter_batch(message_id, subscriber_ids, bcc=None):
+    """
+    Renders and sends the message to a chunk of subscribers, with one call to the relay (a single pooled
+    connection) and one wait for the rate limit of each recipient domain.
+
+    Args:
+    message_id (int): The ID of the message.
+    subscriber_ids (list): The IDs of the subscribers (SubscriptionToNewsletter) to send the message to.
+    bcc (list, optional): List of email addresses to BCC.
+
+    Each email is guarded by its idempotency key (see core/send_guard.py): when the task is delivered again
+    (e.g. the worker died before acknowledging it), the emails already sent are not sent again.
+
+    Returns:
+    dict: 'sent' maps the id (as a string) of each subscriber reached by the message to the reply
+          of the relay (smtp_code and smtp_response), 'failed' maps the subscriber id (as a string) to a dictionary with recipient, error,
+          error_class and smtp_code (see classify_smtp_error). 'already_sent' lists the ids of the subscribers
+          reached by a previous delivery of the task, 'in_progress' the ids of the subscribers whose email
+          is being sent by another worker.
+    """
+    message = get_message_for_sending(message_id)
+    newsletter = message.newsletter
+
+    sent_deliveries = NewsletterDeliveryRecord.objects.filter(
+        message_id=message_id, subscriber_id=OuterRef('id'), status=NewsletterDeliveryRecord.SENT)
+
+    # the recipients of the same domain are spread over the batch
+    subscribers = interleave_by_domain(SubscriptionToNewsletter.objects
+                                       .filter(id__in=subscriber_ids)
+                                       .exclude(Exists(sent_deliveries))
+                                       .order_by('id'),
+                                       lambda subscriber: subscriber.email)
+
+    skeleton = newsletter_skeleton_cache.get(message)
+
+    relays = get_newsletter_relays(newsletter)
+
+    sent = {}
+    failed = {}
+    already_sent = []
+    in_progress = []
+    events = []
+
+    def record_failure(subscriber, e):
+        print(f"send_newsletter_batch - message {message_id} not sent to {subscriber.email}: {e}")
+        error_class, smtp_code = classify_smtp_error(e)
+        failed[str(subscriber.id)] = {
+            'recipient': subscriber.email,
+            'error': str(e),
+            'error_class': error_class,
+            'smtp_code': smtp_code,
+        }
+        events.append({
+            'event_type': EventLog.EMAIL_FAILED,
+            'event_title': f"Newsletter email not sent to subscriber - newsletter {newsletter.short_name} message id: {message.id} -  subject: {message.subject}",
+            'event_data': f"subscriber: {subscriber.email} - {error_class} {smtp_code} - error: {e}",
+            'event_target': subscriber.email,
+        })
+
+    reserved = []  # (subscriber, send_key, token, email)
+    for subscriber in subscribers:
+        send_key = get_newsletter_send_key(message_id, subscriber.id)
+        state, token = reserve_send(send_key)
+        if state == ALREADY_SENT:
+            already_sent.append(subscriber.id)
+            continue
+        if state == IN_PROGRESS:
+            in_progress.append(subscriber.id)
+            continue
+
+        try:
+            reserved.append((subscriber, send_key, token, skeleton.create_email(subscriber, bcc)))
+        except Exception as e:
+            release_send(send_key, token)
+            record_failure(subscriber, e)
+
+    # large providers throttle bursts: respect the rate limit of each recipient domain of the chunk
+    for domain, messages in Counter(get_email_domain(subscriber.email) for subscriber, *_ in reserved).items():
+        acquire_domain_slot(domain, messages)
+
+    # the chunk is sent with one call: a refused recipient does not stop the others
+    results = []
+    error = None
+    if reserved:
+        try:
+            send_with_failover([email for *_, email in reserved], relays, results)
+        except Exception as e:
+            # all the relays have failed: the emails without an outcome have not been sent
+            error = e
+
+    for index, (subscriber, send_key, token, email) in enumerate(reserved):
+        email_error = results[index] if index < len(results) else error
+        if email_error is not None:
+            if not isinstance(email_error, DeliveryUncertainError):
+                # the relay may have accepted an uncertain email: it is sent again only when the reservation expires
+                release_send(send_key, token)
+            record_failure(subscriber, email_error)
+            continue
+
+        mark_sent(send_key)
+        smtp_code, smtp_response = get_smtp_reply(email)
+        sent[str(subscriber.id)] = {'smtp_code': smtp_code, 'smtp_response': smtp_response}
+        events.append({
+            'event_type': EventLog.EMAIL_SENT,
+            'event_title': f"Newsletter email sent to subscriber - newsletter {newsletter.short_name} message id: {message.id} -  subject: {message.subject}",
+            'event_data': f"subscriber: {subscriber.email} - template: {newsletter.template}",
+            'event_target': subscriber.email,
+        })
+
+    create_event_logs(events)
+
+    return {'sent': sent, 'failed': failed, 'already_sent': already_sent, 'in_progress': in_progress}
@@ -0,0 +1,155 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Count
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from core.business_logic import get_subscribers_pending_delivery, create_event_log
+from core.logic_email import send_custom_email
+from core.logic_newsletter import get_sender_address, newsletter_skeleton_cache
+from core.models import Campaign, NewsletterDeliveryRecord
+from core.relays import get_newsletter_relays
+from simple_newsletter.settings import NOTIFICATION_BCC_RECIPIENTS
+
+
+def uses_campaign_digest():
+    """
+    True if the NOTIFICATION_BCC_RECIPIENTS receive a sample copy and a periodic digest of the campaigns
+    (CAMPAIGN_NOTIFICATION_MODE 'digest'), False if they are in BCC of every newsletter email ('bcc').
+    """
+    return getattr(settings, 'CAMPAIGN_NOTIFICATION_MODE', 'digest') != 'bcc'
+
+
+def get_bulk_bcc():
+    """The BCC recipients of each newsletter email of a campaign."""
+    return None if uses_campaign_digest() else NOTIFICATION_BCC_RECIPIENTS
+
+
+def send_notification_email(newsletter, subject, html_content):
+    """Sends an email to each of the NOTIFICATION_BCC_RECIPIENTS, through the relays of the newsletter."""
+    sender_address = get_sender_address(newsletter)
+    relays = get_newsletter_relays(newsletter)
+
+    for recipient in NOTIFICATION_BCC_RECIPIENTS or []:
+        try:
+            send_custom_email(sender_address, recipient, subject, html_content, relays=relays)
+        except Exception as e:
+            print(f"send_notification_email - not sent to {recipient}: {e}")
+
+
+def send_campaign_sample(campaign):
+    """
+    Sends the NOTIFICATION_BCC_RECIPIENTS a single copy of the message, as rendered for the first
+    subscriber of the audience, instead of a BCC copy of every email of the campaign.
+
+    Returns:
+    bool: True if the sample has been sent.
+    """
+    if not NOTIFICATION_BCC_RECIPIENTS or not uses_campaign_digest() or campaign.sample_sent_at:
+        return False
+
+    message = campaign.message
+
+    subscriber = (get_subscribers_pending_delivery(message)
+                  .filter(id__lte=campaign.audience_max_subscriber_id)
+                  .first())
+    if subscriber is None:
+        return False
+
+    html_content = newsletter_skeleton_cache.get(message).render(subscriber)
+
+    send_notification_email(message.newsletter, f"[sample] {message.subject}", html_content)
+
+    campaign.sample_sent_at = timezone.now()
+    if campaign.id:
+        Campaign.objects.filter(id=campaign.id).update(sample_sent_at=campaign.sample_sent_at)
+
+    print(f"Sample of {campaign} sent to {NOTIFICATION_BCC_RECIPIENTS}")
+    return True
+
+
+def get_campaign_delivery_counts(campaign):
+    """Returns the number of rows of the delivery ledger of the campaign message, for each status."""
+    counts = {status: 0 for status, _ in NewsletterDeliveryRecord.STATUS_CHOICES}
+    rows = (NewsletterDeliveryRecord.objects
+            .filter(message_id=campaign.message_id)
+            .values('status')
+            .annotate(count=Count('id')))
+    for row in rows:
+        counts[row['status']] = row['count']
+    return counts
+
+
+def send_campaign_digest(campaign, final=False, now=None):
+    """
+    Sends the NOTIFICATION_BCC_RECIPIENTS the delivery counts of the campaign and the failures
+    since the previous digest.
+    """
+    now = now or timezone.now()
+    message = campaign.message
+    max_failures = getattr(settings, 'CAMPAIGN_DIGEST_MAX_FAILURES', 50)
+
+    failures = (NewsletterDeliveryRecord.objects
+                .filter(message_id=campaign.message_id, status=NewsletterDeliveryRecord.FAILED)
+                .select_related('subscriber')
+                .order_by('-updated_at'))
+    if campaign.last_digest_at:
+        failures = failures.filter(updated_at__gt=campaign.last_digest_at)
+
+    context = {
+        'campaign': campaign,
+        'message': message,
+        'newsletter': message.newsletter,
+        'counts': get_campaign_delivery_counts(campaign),
+        'failures': list(failures[:max_failures]),
+        'failures_count': failures.count(),
+        'since': campaign.last_digest_at,
+        'final': final,
+    }
+
+    subject = f"[{'completed' if final else 'progress'}] {message.newsletter.short_name}: {message.subject}"
+    send_notification_email(message.newsletter, subject, render_to_string('campaign_digest_template.html', context))
+
+    create_event_log(
+        event_type="CAMPAIGN_DIGEST_SENT",
+        event_title=f"Campaign digest sent - message id: {message.id} - subject: {message.subject}",
+        event_data=f"campaign: {campaign.id} - counts: {context['counts']} - final: {final}",
+    )
+
+
+def send_campaign_digests(now=None):
+    """
+    Sends the digest of the campaigns in progress, every CAMPAIGN_DIGEST_INTERVAL_SECONDS, and a final digest
+    when all the emails of a completed campaign have been processed.
+
+    Returns:
+    list: The ids of the campaigns whose digest has been sent.
+    """
+    if not NOTIFICATION_BCC_RECIPIENTS or not uses_campaign_digest():
+        return []
+
+    now = now or timezone.now()
+    interval = timedelta(seconds=getattr(settings, 'CAMPAIGN_DIGEST_INTERVAL_SECONDS', 3600))
+
+    sent = []
+
+    for campaign in Campaign.objects.filter(final_digest_at__isnull=True).select_related('message__newsletter'):
+        pending = NewsletterDeliveryRecord.objects.filter(
+            message_id=campaign.message_id,
+            status__in=[NewsletterDeliveryRecord.QUEUED, NewsletterDeliveryRecord.SENDING],
+        ).exists()
+        final = campaign.status == Campaign.COMPLETED and not pending
+
+        if not final and campaign.last_digest_at and now - campaign.last_digest_at < interval:
+            continue
+
+        send_campaign_digest(campaign, final=final, now=now)
+
+        update = {'last_digest_at': now}
+        if final:
+            update['final_digest_at'] = now
+        Campaign.objects.filter(id=campaign.id).update(**update)
+        sent.append(campaign.id)
+
+    return sent
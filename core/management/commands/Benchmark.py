@@ -0,0 +1,127 @@
+import re
+import time
+import timeit
+
+from django.core.mail import EmailMessage
+from django.core.management import BaseCommand, CommandError
+
+from core.html_utils import rewrite_urls, make_urls_absolute, make_urls_absolute_beautifulsoup, rewritten_html_cache
+from core.logic_newsletter import build_campaign_context, NewsletterSkeleton, get_sender_address
+from core.mime_utils import PreEncodedEmailMessage
+from core.models import Message, SubscriptionToNewsletter
+from core.template_utils import render_email_template
+
+
+# headers that are different in each message
+VOLATILE_HEADERS_RE = re.compile(rb'^(Date|Message-ID): .*$', re.MULTILINE)
+
+
+def get_newsletter_html(message):
+    """The html of the message as sent by the newsletter (without the per-recipient values)."""
+    template = message.newsletter.template
+    if not template:
+        return message.message_content
+    return str(render_email_template(template, context=build_campaign_context(message)))
+
+
+class Command(BaseCommand):
+    """Compare the performance of the implementations used to send the newsletter, on real messages."""
+
+    def add_arguments(self, parser):
+        parser.add_argument("what", type=str, choices=["urls", "mime"],
+                            help="urls: make_urls_absolute, tokenizer vs BeautifulSoup; "
+                                 "mime: CPU time to encode each newsletter email, Django vs MimeSkeleton")
+        parser.add_argument("--message", type=int, nargs="*", default=None,
+                            help="Message instance ids (default: the last 5 messages)")
+        parser.add_argument("--repeat", type=int, default=20, help="Number of runs of each implementation")
+
+    def handle(self, *args, **options):
+        message_ids = options.get("message")
+        repeat = options.get("repeat")
+
+        if message_ids:
+            messages = Message.objects.filter(id__in=message_ids).order_by('id')
+        else:
+            messages = Message.objects.order_by('-id')[:5]
+
+        messages = list(messages.select_related('newsletter__template'))
+        if not messages:
+            raise CommandError("no messages to benchmark")
+
+        if options["what"] == "urls":
+            self.benchmark_urls(messages, repeat)
+        elif options["what"] == "mime":
+            self.benchmark_mime(messages, repeat)
+
+    @staticmethod
+    def benchmark_urls(messages, repeat):
+        from bs4 import BeautifulSoup
+
+        print(f"{'message':>8} {'size (KB)':>10} {'bs4 (ms)':>10} {'tokenizer (ms)':>15} {'cached (ms)':>12} "
+              f"{'speedup':>8}  same output")
+
+        for message in messages:
+            html_content = get_newsletter_html(message)
+            base_url = message.newsletter.base_url
+
+            expected = make_urls_absolute_beautifulsoup(html_content, base_url, set_a_target="_blank")
+            rewritten = rewrite_urls(html_content, base_url, set_a_target="_blank")
+            # the tokenizer leaves the rest of the document untouched: compare the documents as parsed by bs4
+            same_output = str(BeautifulSoup(rewritten, 'html.parser')) == expected
+
+            bs4_time = timeit.timeit(
+                lambda: make_urls_absolute_beautifulsoup(html_content, base_url, set_a_target="_blank"),
+                number=repeat) / repeat
+            tokenizer_time = timeit.timeit(
+                lambda: rewrite_urls(html_content, base_url, set_a_target="_blank"),
+                number=repeat) / repeat
+
+            rewritten_html_cache.clear()
+            make_urls_absolute(html_content, base_url, set_a_target="_blank")
+            cached_time = timeit.timeit(
+                lambda: make_urls_absolute(html_content, base_url, set_a_target="_blank"),
+                number=repeat) / repeat
+
+            print(f"{message.id:>8} {len(html_content.encode('utf-8')) / 1024:>10.1f} {bs4_time * 1000:>10.3f} "
+                  f"{tokenizer_time * 1000:>15.3f} {cached_time * 1000:>12.3f} {bs4_time / tokenizer_time:>7.1f}x  "
+                  f"{same_output}")
+
+    @staticmethod
+    def benchmark_mime(messages, repeat):
+        print(f"{'message':>8} {'size (KB)':>10} {'django (ms)':>12} {'pre-encoded (ms)':>17} {'speedup':>8}  same output")
+
+        for message in messages:
+            newsletter = message.newsletter
+            skeleton = NewsletterSkeleton(message)
+            if not skeleton.is_static:
+                print(f"{message.id:>8} the template requires a full render for each recipient: skipped")
+                continue
+
+            subscriber = (SubscriptionToNewsletter.objects.filter(newsletter=newsletter).first() or
+                          SubscriptionToNewsletter(newsletter=newsletter, email="subscriber@example.com",
+                                                   name="Name", surname="Surname"))
+            sender_address = get_sender_address(newsletter)
+
+            # the same values for both the implementations (rnd_str changes at each render)
+            values = skeleton.render_values(subscriber)
+            skeleton.create_email(subscriber)  # builds the MimeSkeleton
+            html_content = skeleton.mime_skeleton.join(values)
+
+            def encode_with_django():
+                email = EmailMessage(message.subject, html_content, sender_address, [subscriber.email])
+                email.content_subtype = "html"
+                return email.message().as_bytes(linesep='\r\n')
+
+            def encode_with_mime_skeleton():
+                email = PreEncodedEmailMessage(skeleton.mime_skeleton, values, [subscriber.email])
+                return email.message().as_bytes(linesep='\r\n')
+
+            same_output = (VOLATILE_HEADERS_RE.sub(b'', encode_with_django()) ==
+                           VOLATILE_HEADERS_RE.sub(b'', encode_with_mime_skeleton()))
+
+            django_time = timeit.timeit(encode_with_django, number=repeat, timer=time.process_time) / repeat
+            pre_encoded_time = timeit.timeit(encode_with_mime_skeleton, number=repeat,
+                                             timer=time.process_time) / repeat
+
+            print(f"{message.id:>8} {len(html_content.encode('utf-8')) / 1024:>10.1f} {django_time * 1000:>12.3f} "
+                  f"{pre_encoded_time * 1000:>17.3f} {django_time / max(pre_encoded_time, 1e-9):>7.1f}x  {same_output}")
@@ -0,0 +1,36 @@
+import time
+
+from django.core.management import BaseCommand
+
+from core.logic_campaign import dispatch_scheduled_messages
+from core.tasks import run_campaign_task
+
+
+class Command(BaseCommand):
+    """Start the campaigns of the messages whose to_be_processed_at is due.
+    Alternative to the celery beat schedule (dispatch_scheduled_messages_task); several instances can run at
+    the same time, since each message is claimed atomically.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument("--loop", action="store_true", default=False,
+                            help="Keep running, checking for due messages every --interval seconds")
+        parser.add_argument("--interval", type=int, default=60, help="Seconds between two checks (with --loop)")
+        parser.add_argument("--batch-size", type=int, default=None, required=False,
+                            help="Recipients for each celery task (default: SCHEDULED_CAMPAIGN_BATCH_SIZE)")
+
+    def handle(self, *args, **options):
+        loop = options.get("loop")
+        interval = options.get("interval")
+        batch_size = options.get("batch_size")
+
+        while True:
+            dispatched = dispatch_scheduled_messages(
+                lambda message_id: run_campaign_task.delay(message_id, batch_size=batch_size))
+
+            print(f"Dispatched {len(dispatched)} messages: {dispatched}")
+
+            if not loop:
+                break
+
+            time.sleep(interval)
@@ -0,0 +1,36 @@
+from django.core.management import BaseCommand
+from django.db.models import Count, Max
+
+from core.models import NewsletterDeliveryRecord
+
+
+class Command(BaseCommand):
+    """Removes the duplicate rows of the delivery ledger, keeping the last row of each message and subscriber.
+
+    Pre-upgrade step: the previous versions allowed duplicates, run this command before `migrate` adds the unique
+    (message, subscriber) constraint of NewsletterDeliveryRecord (unique_delivery_per_subscriber).
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", default=False,
+                            help="Only print the messages and subscribers with duplicate rows")
+
+    def handle(self, *args, **options):
+        # only the key columns are read: the other columns may not exist yet in the database being upgraded
+        duplicates = list(NewsletterDeliveryRecord.objects
+                          .values('message_id', 'subscriber_id')
+                          .annotate(rows=Count('id'), last_id=Max('id'))
+                          .filter(rows__gt=1)
+                          .order_by('message_id', 'subscriber_id'))
+
+        removed = 0
+        for duplicate in duplicates:
+            if options.get("dry_run"):
+                print(f"message {duplicate['message_id']} subscriber {duplicate['subscriber_id']}: "
+                      f"{duplicate['rows']} rows")
+                continue
+            removed += NewsletterDeliveryRecord.objects.filter(
+                message_id=duplicate['message_id'], subscriber_id=duplicate['subscriber_id'],
+            ).exclude(id=duplicate['last_id']).delete()[0]
+
+        print(f"{len(duplicates)} messages and subscribers with duplicate rows, removed {removed} rows")
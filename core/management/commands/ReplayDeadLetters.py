@@ -0,0 +1,35 @@
+from django.core.management import BaseCommand
+
+from core.logic_email import replay_dead_letters
+from core.models import DeadLetter
+
+
+class Command(BaseCommand):
+    """Enqueue again the emails in the DeadLetter store (not yet replayed).
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument("--message", type=int, default=None, required=False, help="Only the emails of this message id")
+        parser.add_argument("--error-class", type=str, default=None, required=False,
+                            choices=["TRANSIENT", "THROTTLED", "PERMANENT"], help="Only the emails with this error class")
+        parser.add_argument("--smtp-code", type=int, default=None, required=False, help="Only the emails with this SMTP reply code")
+        parser.add_argument("--dry-run", action="store_true", default=False, help="Only print the emails that would be replayed")
+
+    def handle(self, *args, **options):
+        dead_letters = DeadLetter.objects.filter(replayed_at__isnull=True)
+
+        if options.get("message"):
+            dead_letters = dead_letters.filter(message_id=options.get("message"))
+        if options.get("error_class"):
+            dead_letters = dead_letters.filter(error_class=options.get("error_class"))
+        if options.get("smtp_code"):
+            dead_letters = dead_letters.filter(smtp_code=options.get("smtp_code"))
+
+        if options.get("dry_run"):
+            for dead_letter in dead_letters.order_by('id'):
+                print(dead_letter)
+            print(f"{dead_letters.count()} emails to replay")
+            return
+
+        replayed = replay_dead_letters(dead_letters)
+        print(f"Replayed {replayed} emails")
@@ -0,0 +1,33 @@
+from asgiref.sync import async_to_sync
+from django.core.management import BaseCommand
+
+from core.logic_async_sender import AsyncSender
+
+
+class Command(BaseCommand):
+    """Send the emails of the campaigns started with SendNewsletter --engine async.
+    A single process keeps many SMTP sessions in flight (asyncio); several instances, on any number of nodes,
+    can run at the same time, since the rows of the delivery ledger (the outbox) are claimed with
+    SELECT ... FOR UPDATE SKIP LOCKED (a conditional update on databases without it).
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sessions", type=int, default=None, required=False,
+                            help="Concurrent SMTP sessions (default: ASYNC_SENDER_SESSIONS)")
+        parser.add_argument("--batch-size", type=int, default=None, required=False,
+                            help="Rows of the delivery ledger claimed at once (default: ASYNC_SENDER_BATCH_SIZE)")
+        parser.add_argument("--until-idle", action="store_true", default=False,
+                            help="Stop when there is nothing left to send, instead of waiting for new campaigns")
+
+    def handle(self, *args, **options):
+        sender = AsyncSender(sessions=options.get("sessions"), batch_size=options.get("batch_size"))
+
+        print(f"AsyncSender {sender.sender_id} - {sender.sessions} sessions")
+
+        try:
+            sent, failed = async_to_sync(sender.run)(until_idle=options.get("until_idle"))
+        except KeyboardInterrupt:
+            print("AsyncSender stopped")
+            return
+
+        print(f"AsyncSender {sender.sender_id} - sent: {sent} failed: {failed}")
@@ -3,8 +3,9 @@ from django.utils import timezone
 
 from core.business_logic import create_event_log
 from core.models import Visitor, EmailTemplate
-from core.template_utils import render_template_from_string
-from core.tasks import send_custom_email_task
+from core.logic_email import split_envelope_batches
+from core.template_utils import render_email_template
+from core.tasks import send_custom_email_task, send_visitor_emails_task
 from simple_newsletter.settings import NOTIFICATION_BCC_RECIPIENTS
 
 
@@ -12,10 +13,19 @@ class Command(BaseCommand):
     """Send a special email to all visitors.
     The email will link to a short questionnaire to gather information and
     to sign up for the newsletter.
+
+    With --envelope, the email (which is the same for all the visitors) is sent to batches of visitors
+    with a single SMTP transaction each, up to --max-recipients (EMAIL_ENVELOPE_MAX_RECIPIENTS) recipients;
+    the visitors are hidden from each other.
     """
     def add_arguments(self, parser):
         parser.add_argument("sender_email", type=str)
         parser.add_argument("--template", type=str, default=None)
+        parser.add_argument("--envelope", action="store_true",
+                            help="send one email to many visitors (one SMTP transaction for each batch)")
+        parser.add_argument("--max-recipients", type=int, default=None,
+                            help="visitors in each SMTP transaction, with --envelope "
+                                 "(default: EMAIL_ENVELOPE_MAX_RECIPIENTS)")
 
     def handle(self, *args, **options):
         sender_email = options["sender_email"]
@@ -23,13 +33,16 @@ class Command(BaseCommand):
 
         instance = EmailTemplate.objects.get(name=template)
         subject = instance.subject
-        template_content = instance.body
 
-        html_content = render_template_from_string(template_content, context={})
+        html_content = render_email_template(instance, context={})
         # get all Visitors
 
         rs = Visitor.objects.filter(email_address__isnull=False).filter(email_sent=False)
 
+        if options["envelope"]:
+            self.send_envelope_batches(rs, sender_email, subject, html_content, template, options["max_recipients"])
+            return
+
         counter = 0
 
         # for each visitor, send an email with a link to the questionnaire
@@ -61,3 +74,20 @@ class Command(BaseCommand):
 
         print(f"Sent {counter} emails")
 
+    def send_envelope_batches(self, rs, sender_email, subject, html_content, template, max_recipients):
+        """Enqueues a task for each batch of visitors; the task marks the visitors as email_sent."""
+        # NOTIFICATION_BCC_RECIPIENTS receive a copy of the first batch only, and take some of its recipients
+        batches = split_envelope_batches(rs.order_by('id').values_list('id', flat=True), max_recipients,
+                                         reserved=len(NOTIFICATION_BCC_RECIPIENTS or []))
+
+        for index, visitor_ids in enumerate(batches):
+            send_visitor_emails_task.delay(
+                sender_email,
+                visitor_ids,
+                subject,
+                html_content,
+                template=template,
+                bcc=NOTIFICATION_BCC_RECIPIENTS if index == 0 else None
+            )
+
+        print(f"Enqueued {len(batches)} emails for {sum(len(visitor_ids) for visitor_ids in batches)} visitors")
@@ -1,15 +1,21 @@
-import time
+import argparse
 
 from django.core.management import BaseCommand
-from django.utils import timezone
 
-from core.business_logic import has_message_been_sent_to_subscriber, create_event_log, register_message_delivery
-from core.html_utils import make_urls_absolute
-from core.models import EmailTemplate, Newsletter, Message, SubscriptionToNewsletter
-from core.tasks import send_custom_email_task
-from core.template_utils import render_template_from_string, get_rnd_str
-from core.views import generate_unsubscribe_link, generate_message_web_view
-from simple_newsletter.settings import NOTIFICATION_BCC_RECIPIENTS, BASE_URL
+from core.logic_campaign import run_campaign, run_campaign_in_processes
+from core.logic_newsletter import get_message_for_sending
+from core.models import Campaign
+
+
+def parse_shard(value):
+    """Parses the --shard option, "i/N" (0 <= i < N), to the partition (i, N)."""
+    try:
+        slot, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected i/N, got {value!r}")
+    if not 0 <= slot < count:
+        raise argparse.ArgumentTypeError(f"expected 0 <= i < N, got {value!r}")
+    return slot, count
 
 
 class Command(BaseCommand):
@@ -28,6 +34,22 @@ class Command(BaseCommand):
         # define an optional int argument called "--number" to the command
         parser.add_argument("--number", type=int, default=1, required=False, help="Number of messages to send")
 
+        parser.add_argument("--batch-size", type=int, default=None, required=False,
+                            help="Send the emails in chunks of this number of recipients; "
+                                 "each chunk is rendered and sent by a celery worker over one connection")
+
+        parser.add_argument("--engine", type=str, default="celery", choices=["celery", "async"],
+                            help="celery: send with celery tasks; async: write the audience to the delivery ledger "
+                                 "(a DB outbox, not the broker), the emails are sent by the RunAsyncSender command, "
+                                 "which shares its capacity fairly among the newsletters (celery does not)")
+
+        parser.add_argument("--workers", type=int, default=1, required=False,
+                            help="Prepare the campaign with this number of processes, each one processing "
+                                 "its own shards of the audience")
+        parser.add_argument("--shard", type=parse_shard, default=None, required=False,
+                            help="i/N: process only the shards i, i+N, i+2N, ... of the audience (e.g. one run on "
+                                 "each of N hosts); the runs of a campaign must use the same N")
+
     def handle(self, *args, **options):
 
         newsletter = options.get("newsletter")  # newsletter short name
@@ -39,109 +61,22 @@ class Command(BaseCommand):
 
         number = options.get("number")  # number of messages to send
 
-        # print(newsletter)
-        # print(template)
-        # print(message)
-
-        message_instance = Message.objects.get(id=message)
-
-        newsletter_instance = message_instance.newsletter
-        if not newsletter_instance:
-            print("Error: no newsletter instance found")
-            return
-
-        if not newsletter_instance.enabled:
-            print("Error: newsletter is not enabled to send messages")
-            return
-
-        # newsletter_instance = Newsletter.objects.get(short_name=newsletter)
-
-        # instance = EmailTemplate.objects.get(name=template)
-        template_instance = newsletter_instance.template
-
-        if not template_instance:
-            print("Error: no template instance found")
-            return
-
-        template_content = template_instance.body
-
-        print(f"message: {message_instance}")
-        print(f"newsletter: {newsletter_instance}")
-        print(f"template: {template_instance}")
+        batch_size = options.get("batch_size")  # number of recipients for each celery task
 
-        # get all subscribers of the newsletter that are subscribed:
-        rs = (SubscriptionToNewsletter.objects
-              .filter(newsletter=newsletter_instance)
-              .filter(email__isnull=False)
-              .filter(subscription_confirmed=True)
-              .filter(subscribed=True))
+        engine = Campaign.ASYNC if options.get("engine") == "async" else Campaign.CELERY
 
-        print(f"Subscribers: {rs.count()}")
+        workers = options.get("workers")  # number of processes
+        partition = options.get("shard")  # (i, N) from --shard i/N
 
-        counter = 0
-
-        sender_address = f"{newsletter_instance.name} <{newsletter_instance.from_email}>" if newsletter_instance.name else newsletter_instance.from_email
-        # check if the sender address is valid
-
-        # for each subscriber, send an email with a link to the questionnaire
-        for subscriber in rs:
-            # print(subscriber.email)
-
-            if has_message_been_sent_to_subscriber(subscriber.email, message_instance.id):
-                print(f"Message already sent to {subscriber.email}, skipping")
-                continue
-            else:
-                print(f"Message not yet sent to {subscriber.email}")
-
-            # each subscriber has a unique token
-            context = {
-                "subscriber": subscriber,
-                "rnd_str": get_rnd_str(),
-                # "newsletter": newsletter_instance,
-                "message": message_instance,
-                "subject": message_instance.subject,
-                "content": message_instance.message_content,
-                "unsubscribe_link": BASE_URL + generate_unsubscribe_link(subscriber),
-                "web_version_view": BASE_URL + generate_message_web_view(message_instance),
-                "year": timezone.now().year,
-            }
-
-            html_content = render_template_from_string(template_content, context=context)
-
-            html_content = make_urls_absolute(html_content, newsletter_instance.base_url)
-
-            if oksend:
-                send_custom_email_task.delay(
-                    sender_address,
-                    subscriber.email,
-                    message_instance.subject,
-                    html_content,
-                    bcc=NOTIFICATION_BCC_RECIPIENTS,
-                    email_settings_id=newsletter_instance.email_settings.id if newsletter_instance.email_settings else None
-                )
-
-                create_event_log(
-                    event_type="EMAIL_SENT",
-                    event_title=f"Newsletter email sent to subscriber - newsletter {newsletter_instance.short_name} message id: {message_instance.id} -  subject: {message_instance.subject}",
-                    event_data=f"subscriber: {subscriber.email} - template: {template_instance}",
-                    event_target=subscriber.email
-                )
-
-                print(f"Message sent to {subscriber.email}")
-
-            if not nosave:
-                register_message_delivery(message_instance.id, subscriber.id)
-
-            counter += 1
-            if counter >= number:
-                break
-
-            # sleep 1 second
-            time.sleep(1)
+        # print(newsletter)
+        # print(template)
+        # print(message)
 
-        print(f"Sent {counter} messages")
+        message_instance = get_message_for_sending(message)
 
-        if not nosave:
-            message_instance.processed = True
-            message_instance.processed_at = timezone.now()
-            message_instance.save()
+        if workers > 1:
+            run_campaign_in_processes(message_instance, workers, partition=partition, number=number,
+                                      batch_size=batch_size, nosave=nosave, oksend=oksend, engine=engine)
+        else:
+            run_campaign(message_instance, number=number, batch_size=batch_size, nosave=nosave, oksend=oksend,
+                         engine=engine, partition=partition)
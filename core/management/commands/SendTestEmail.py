@@ -3,15 +3,20 @@ from django.core.management import BaseCommand
 from django.template.loader import render_to_string
 from django.utils.html import strip_tags
 
+from core.logic_email import send_envelope_email, split_envelope_batches
 from core.models import EmailTemplate
 from core.tasks import send_custom_email_task
-from core.template_utils import render_template_from_string
+from core.template_utils import render_email_template
 
 
 class Command(BaseCommand):
     """Send a special email to all visitors.
     The email will link to a short questionnaire to gather information and
     to sign up for the newsletter.
+
+    target_email can be a comma separated list of addresses: with --envelope, the email is sent to them
+    with one SMTP transaction for each batch of EMAIL_ENVELOPE_MAX_RECIPIENTS addresses, otherwise
+    with one task for each address.
     """
 
     def add_arguments(self, parser):
@@ -22,10 +27,13 @@ class Command(BaseCommand):
 
         # parser.add_argument("--subject", type=str, nargs='?', default=None)
 
+        parser.add_argument("--envelope", action="store_true",
+                            help="send one email to many addresses (one SMTP transaction for each batch)")
+
         # add optional argument
 
     def handle(self, *args, **options):
-        target_email = options["target_email"]
+        target_emails = [email.strip() for email in options["target_email"].split(',') if email.strip()]
         sender_email = options["sender_email"]
         template = options.get("template")
         # subject = options.get("subject")
@@ -33,24 +41,31 @@ class Command(BaseCommand):
         if template:
             instance = EmailTemplate.objects.get(name=template)
             subject = instance.subject
-            template_content = instance.body
         else:
-            template_content = None
+            instance = None
 
-        if not template_content:
+        if not instance or not instance.body:
             subject = "Join Our Newsletter and Questionnaire"
             html_content = render_to_string('test_email_template.html', {'context': 'values'})
             # text_content = strip_tags(html_content)  # Create a plain-text version of the HTML email
         else:
-            html_content = render_template_from_string(template_content, context={})
+            html_content = render_email_template(instance, context={})
 
-        send_custom_email_task.delay(
-            sender_email,
-            target_email,
-            subject,
-            html_content,
-            # bcc=['']
-        )
+        if options["envelope"]:
+            for recipients in split_envelope_batches(target_emails):
+                refused = send_envelope_email(sender_email, recipients, subject, html_content)
+                for address, (code, text) in refused.items():
+                    self.stdout.write(self.style.ERROR(f"Email refused for {address}: {code} {text}"))
+                target_emails = [email for email in target_emails if email not in refused]
+        else:
+            for target_email in target_emails:
+                send_custom_email_task.delay(
+                    sender_email,
+                    target_email,
+                    subject,
+                    html_content,
+                    # bcc=['']
+                )
 
         # # Create the email message
         # email = EmailMessage(
@@ -62,4 +77,4 @@ class Command(BaseCommand):
         # email.content_subtype = "html"  # Indicate that the email content is HTML
         # email.send()
 
-        self.stdout.write(self.style.SUCCESS(f"Email sent successfully to {target_email}"))
+        self.stdout.write(self.style.SUCCESS(f"Email sent successfully to {', '.join(target_emails)}"))
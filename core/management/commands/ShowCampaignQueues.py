@@ -0,0 +1,24 @@
+from django.core.management import BaseCommand
+
+from core.fair_scheduler import get_campaign_queue_depths
+
+
+class Command(BaseCommand):
+    """Show the queue depth of each campaign being sent by the async sender (see RunAsyncSender).
+    Only the campaigns of the async engine are scheduled fairly among the newsletters (see Newsletter.sending_share);
+    the campaigns of the celery engine share the FIFO bulk queue, bounded by ENQUEUE_MAX_QUEUED_TASKS.
+    """
+
+    def handle(self, *args, **options):
+        depths = get_campaign_queue_depths()
+        if not depths:
+            print("No campaigns are sending with the async engine")
+            return
+
+        print(f"{'message':>8} {'newsletter':<20} {'share':>6} {'due':>8} {'scheduled':>10} {'sending':>8}")
+        for depth in depths:
+            print(f"{depth['message_id']:>8} {depth['newsletter']:<20} {depth['sending_share']:>6} {depth['due']:>8} "
+                  f"{depth['scheduled']:>10} {depth['sending']:>8}")
+
+        print("Campaigns of the celery engine are not listed: they share the FIFO bulk queue, "
+              "without fair scheduling")
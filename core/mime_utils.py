@@ -0,0 +1,203 @@
+import re
+from email.utils import formatdate, make_msgid
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.mail import EmailMessage
+from django.core.mail.message import DNS_NAME, RFC5322_EMAIL_LINE_LENGTH_LIMIT
+
+EOL_RE = re.compile(r'\r\n|\r|\n')
+
+# headers longer than this are folded by the email package: they are left to Django
+HEADER_MAX_LENGTH = 78
+
+# the headers generated by Django before Content-Transfer-Encoding, and after it
+LEADING_HEADERS = (b'content-type', b'mime-version')
+TRAILING_HEADERS = (b'subject', b'from')
+
+
+def encode_text(text):
+    """Returns the text encoded as the body of a utf-8 MIME part (CRLF line endings) and its line lengths."""
+    data = EOL_RE.sub('\r\n', text).encode('utf-8', errors='surrogateescape')
+    lines = data.split(b'\r\n')
+    return data, len(lines[0]), len(lines[-1]), max(map(len, lines)), len(lines) > 1
+
+
+def split_headers(header_block):
+    """Returns the {lowercase name: raw header, with its folded lines and CRLF} of a header block."""
+    headers = {}
+    name = None
+    for line in header_block.split(b'\r\n'):
+        if line[:1] in (b' ', b'\t') and name is not None:
+            headers[name] += line + b'\r\n'
+        else:
+            name = line.partition(b':')[0].strip().lower()
+            headers[name] = line + b'\r\n'
+    return headers
+
+
+class EncodedMessage:
+    """
+    The bytes of a MIME message, with the methods of email.message.Message used by the email backends
+    (and by the async sender) to serialize it.
+    """
+
+    def __init__(self, data):
+        self.data = data  # CRLF line endings
+
+    def get_charset(self):
+        return None
+
+    def as_bytes(self, unixfrom=False, linesep='\n'):
+        return self.data if linesep == '\r\n' else self.data.replace(b'\r\n', linesep.encode('ascii'))
+
+    def as_string(self, unixfrom=False, linesep='\n'):
+        return self.as_bytes(linesep=linesep).decode('utf-8', errors='surrogateescape')
+
+
+class MimeSkeleton:
+    """
+    The MIME structure of an HTML email whose body is the join of static parts and per-recipient values
+    (static_parts are the even indexes of NewsletterSkeleton.parts, the values go in the slots between them).
+
+    Django encodes the whole message for each recipient: charset, transfer encoding and header folding.
+    Here the headers that do not depend on the recipient and the static parts of the body are encoded once;
+    for each recipient only the values and the To, Date and Message-ID headers are encoded.
+    The output is the same as EmailMessage.message().as_bytes(): when the result could differ (a line
+    longer than 998 bytes, which Django sends quoted-printable, or a header that would be folded),
+    encode returns None and the message is left to Django.
+    """
+
+    def __init__(self, subject, from_email, static_parts, encoding=None):
+        self.subject = subject
+        self.from_email = from_email
+        self.static_parts = list(static_parts)
+        self.encoding = encoding or settings.DEFAULT_CHARSET
+
+        self.leading_headers, self.trailing_headers = self._encode_headers()
+        self.encoded_parts = [encode_text(part) for part in self.static_parts]
+
+        # line endings split between a static part and a value would be normalized differently
+        self.is_encodable = self.encoding == 'utf-8' and not any(
+            (index > 0 and part.startswith('\n')) or (index < len(self.static_parts) - 1 and part.endswith('\r'))
+            for index, part in enumerate(self.static_parts)
+        )
+
+    def _encode_headers(self):
+        """The headers of the message encoded by Django, before and after Content-Transfer-Encoding."""
+        email = EmailMessage(self.subject, '', self.from_email, ['to@example.invalid'])
+        email.content_subtype = "html"
+        email.encoding = self.encoding
+        header_block = email.message().as_bytes(linesep='\r\n').split(b'\r\n\r\n', 1)[0]
+        headers = split_headers(header_block)
+        return (b''.join(headers.get(name, b'') for name in LEADING_HEADERS),
+                b''.join(headers.get(name, b'') for name in TRAILING_HEADERS))
+
+    def join(self, values):
+        """Returns the HTML content of the email, with the given values in the slots."""
+        parts = [None] * (len(self.static_parts) * 2 - 1)
+        parts[::2] = self.static_parts
+        parts[1::2] = values
+        return ''.join(parts)
+
+    def encode_body(self, values):
+        """Returns the encoded body with the given values, or None if Django would encode it differently."""
+        chunks = []
+        line_length = 0
+
+        for index, encoded_part in enumerate(self.encoded_parts):
+            if index:
+                value = values[index - 1]
+                if value.startswith('\n') or value.endswith('\r'):
+                    return None
+                encoded_value = encode_text(value)
+                for data, first, last, longest, multiline in (encoded_value, encoded_part):
+                    chunks.append(data)
+                    if not multiline:
+                        line_length += first
+                    elif line_length + first > RFC5322_EMAIL_LINE_LENGTH_LIMIT \
+                            or longest > RFC5322_EMAIL_LINE_LENGTH_LIMIT:
+                        return None
+                    else:
+                        line_length = last
+                continue
+
+            data, first, last, longest, multiline = encoded_part
+            chunks.append(data)
+            if multiline and longest > RFC5322_EMAIL_LINE_LENGTH_LIMIT:
+                return None
+            line_length = last if multiline else first
+
+        if line_length > RFC5322_EMAIL_LINE_LENGTH_LIMIT:
+            return None
+        return b''.join(chunks)
+
+    def encode(self, values, to):
+        """
+        Returns the EncodedMessage for the recipients in To and the given values, or None if it must be
+        encoded by Django.
+        """
+        if not self.is_encodable or len(values) != len(self.static_parts) - 1:
+            return None
+
+        recipient_headers = []
+        for name, value in (
+            ('To', ', '.join(str(address) for address in to)),
+            ('Date', formatdate(localtime=settings.EMAIL_USE_LOCALTIME)),
+            ('Message-ID', make_msgid(domain=DNS_NAME)),
+        ):
+            header = f"{name}: {value}"
+            if len(header) > HEADER_MAX_LENGTH or not header.isascii() or '\n' in header or '\r' in header:
+                return None
+            recipient_headers.append(header.encode('ascii') + b'\r\n')
+
+        body = self.encode_body(values)
+        if body is None:
+            return None
+
+        transfer_encoding = b'7bit' if body.isascii() else b'8bit'
+
+        return EncodedMessage(
+            self.leading_headers
+            + b'Content-Transfer-Encoding: ' + transfer_encoding + b'\r\n'
+            + self.trailing_headers
+            + b''.join(recipient_headers)
+            + b'\r\n'
+            + body
+        )
+
+
+class PreEncodedEmailMessage(EmailMessage):
+    """
+    HTML EmailMessage whose MIME is assembled from a MimeSkeleton and the values of the recipient.
+    It falls back to the encoding of Django when the message has been customized (e.g. headers, cc, attachments)
+    or when the MimeSkeleton cannot encode it.
+    """
+
+    content_subtype = "html"
+
+    def __init__(self, mime_skeleton, values=(), to=None, bcc=None):
+        self.mime_skeleton = mime_skeleton
+        self.values = list(values)
+        super().__init__(mime_skeleton.subject, mime_skeleton.join(self.values), mime_skeleton.from_email,
+                         to, bcc)
+
+    def message(self):
+        mime_skeleton = self.mime_skeleton
+        if (self.content_subtype == "html" and not self.extra_headers and not self.cc and not self.reply_to
+                and not self.attachments and self.to
+                and (self.encoding or settings.DEFAULT_CHARSET) == mime_skeleton.encoding
+                and self.subject == mime_skeleton.subject and self.from_email == mime_skeleton.from_email):
+            encoded_message = mime_skeleton.encode(self.values, self.to)
+            if encoded_message is not None:
+                return encoded_message
+        return super().message()
+
+
+@lru_cache(maxsize=16)
+def get_mime_skeleton(subject, from_email, html_content):
+    """
+    Returns the MimeSkeleton of an HTML email without per-recipient values (e.g. the same email
+    sent to many visitors by a task for each one), cached in the process.
+    """
+    return MimeSkeleton(subject, from_email, [html_content])
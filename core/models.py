@@ -26,16 +26,24 @@ class EmailSettings(models.Model):
     username = models.CharField(max_length=255, blank=True, null=True)
     password = models.CharField(max_length=255, blank=True, null=True)
 
+    # token bucket shared by all the celery workers: sustained rate (emails per second; empty = no limit)
+    # and maximum number of emails sent at once after an idle period
+    rate_limit = models.FloatField(blank=True, null=True, verbose_name="Maximum emails per second")
+    rate_limit_burst = models.PositiveIntegerField(default=10, verbose_name="Maximum burst of emails")
+
     def to_dict(self):
         """
         Returns a dictionary representation of the model instance.
         """
         return {
+            'id': self.id,
             'host': self.host,
             'port': self.port,
             'use_tls': self.use_tls,
             'username': self.username,
-            'password': self.password
+            'password': self.password,
+            'rate_limit': self.rate_limit,
+            'rate_limit_burst': self.rate_limit_burst,
         }
 
     def __str__(self):
@@ -59,6 +67,11 @@ class Newsletter(models.Model):
     enabled = models.BooleanField(default=False)
     # allow users to subscribe to this newsletter through the website
     allows_subscription = models.BooleanField(default=True)
+    # share of the async sender given to this newsletter when several newsletters are sending at the same time
+    # (see core/fair_scheduler.py): a newsletter with share 2 sends twice as many emails as one with share 1.
+    # Only the campaigns of the async engine (SendNewsletter --engine async) are scheduled fairly; the campaigns
+    # of the celery engine share the FIFO bulk queue
+    sending_share = models.PositiveIntegerField(default=1)
 
     privacy_policy = RichTextField(null=True, blank=True)
 
@@ -77,6 +90,24 @@ class Newsletter(models.Model):
         return f"{self.name} ({self.short_name})"
 
 
+class NewsletterRelay(models.Model):
+    """
+    One of the SMTP relays (EmailSettings) used to send a newsletter; the emails are shared among
+    the enabled relays of the newsletter according to their weight (see core/relays.py).
+    If a newsletter has no relays, its email_settings is used.
+    """
+    newsletter = models.ForeignKey(Newsletter, on_delete=models.CASCADE, related_name="relays")
+    email_settings = models.ForeignKey(EmailSettings, on_delete=models.PROTECT, related_name="newsletter_relays")
+    weight = models.PositiveIntegerField(default=1)
+    enabled = models.BooleanField(default=True)
+
+    def __str__(self):
+        return f"{self.newsletter.short_name} - {self.email_settings} (weight {self.weight})"
+
+    class Meta:
+        unique_together = ('newsletter', 'email_settings')
+
+
 class SubscriptionToNewsletter(models.Model):
     """A subscription by a user to a newsletter."""
 
@@ -138,6 +169,13 @@ class SubscriptionToNewsletter(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # the audience of a message matches the deliveries and the duplicated subscriptions by email
+            # (see get_subscribers_pending_delivery)
+            models.Index(fields=['newsletter', 'email'], name='subscription_email_idx'),
+        ]
+
     def __str__(self):
         return f"#{self.id} {self.newsletter.name} - {self.name} {self.surname} - {self.created_at}"
 
@@ -176,6 +214,9 @@ class Message(models.Model):
 
     to_be_processed_at = models.DateTimeField(blank=True, null=True)
 
+    # set when the scheduled dispatcher claims the message (see dispatch_scheduled_messages)
+    dispatched_at = models.DateTimeField(blank=True, null=True)
+
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -183,6 +224,12 @@ class Message(models.Model):
 
     email_view_counter = models.IntegerField(default=0)
 
+    class Meta:
+        indexes = [
+            # used by the scheduled dispatcher to find the messages due to be sent
+            models.Index(fields=['processed', 'dispatched_at', 'to_be_processed_at'], name='message_due_idx'),
+        ]
+
     @staticmethod
     def search_in_message_content(substring):
         """
@@ -305,6 +352,7 @@ class VisitSurvey(models.Model):
 class EventLog(models.Model):
 
     EMAIL_SENT = "EMAIL_SENT"
+    EMAIL_FAILED = "EMAIL_FAILED"
     NEWSLETTER_SUBSCRIPTION_CONFIRMED = "NEWSLETTER_SUBSCRIPTION_CONFIRMED"
     CONFIRM_SUBSCRIPTION_EMAIL_SENT = "CONFIRM_SUBSCRIPTION_EMAIL_SENT"
     UNSUBSCRIBED = "UNSUBSCRIBED"
@@ -321,9 +369,161 @@ class EventLog(models.Model):
 
 
 class NewsletterDeliveryRecord(models.Model):
+    """
+    Delivery ledger: one row for each message and subscriber, written as QUEUED when the email is enqueued
+    and updated by the celery workers with the outcome of the sending (and the reply of the relay).
+    The AsyncSender engine claims the QUEUED rows of its campaigns (status SENDING) and sends them.
+    """
+
+    QUEUED = "QUEUED"
+    SENDING = "SENDING"
+    SENT = "SENT"
+    FAILED = "FAILED"
+
+    STATUS_CHOICES = [(QUEUED, 'Queued'), (SENDING, 'Sending'), (SENT, 'Sent'), (FAILED, 'Failed')]
+
     message = models.ForeignKey('Message', on_delete=models.CASCADE)
     subscriber = models.ForeignKey('SubscriptionToNewsletter', on_delete=models.CASCADE)
-    sent_at = models.DateTimeField(auto_now_add=True)
+
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=SENT)
+    smtp_code = models.IntegerField(blank=True, null=True)
+    smtp_response = models.TextField(blank=True, null=True)
+
+    # claims of the rows by the processes that send them (see core/logic_async_sender.py)
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(blank=True, null=True)
+    claimed_by = models.CharField(max_length=64, blank=True, null=True)
+    claimed_at = models.DateTimeField(blank=True, null=True)
+
+    queued_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            # databases upgraded from the versions that allowed duplicates: run RemoveDuplicateDeliveryRecords first
+            models.UniqueConstraint(fields=['message', 'subscriber'], name='unique_delivery_per_subscriber'),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='delivery_status_idx'),
+        ]
+
+    def __str__(self):
+        return f"Message {self.message.id} sent to {self.subscriber.email} on {self.sent_at} - {self.status}"
+
+
+class Campaign(models.Model):
+    """A run of SendNewsletter for a message; an interrupted campaign is resumed from its cursor."""
+
+    RUNNING = "RUNNING"
+    COMPLETED = "COMPLETED"
+
+    STATUS_CHOICES = [(RUNNING, 'Running'), (COMPLETED, 'Completed')]
+
+    # CELERY: the emails are sent by celery tasks; ASYNC: the emails are only written to the delivery ledger,
+    # and sent by the AsyncSender engine (RunAsyncSender command)
+    CELERY = "CELERY"
+    ASYNC = "ASYNC"
+
+    ENGINE_CHOICES = [(CELERY, 'Celery tasks'), (ASYNC, 'Async sender')]
+
+    message = models.ForeignKey(Message, on_delete=models.CASCADE)
+
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=RUNNING)
+    engine = models.CharField(max_length=20, choices=ENGINE_CHOICES, default=CELERY)
+
+    # frozen audience snapshot: subscriptions created after the start of the campaign are not part of it
+    audience_max_subscriber_id = models.BigIntegerField(default=0)
+    audience_size = models.IntegerField(default=0)
+
+    # cursor: the audience is processed by increasing subscriber id
+    last_subscriber_id = models.BigIntegerField(default=0)
+
+    enqueued_count = models.IntegerField(default=0)
+
+    # notifications to NOTIFICATION_BCC_RECIPIENTS (see core/logic_notifications.py)
+    sample_sent_at = models.DateTimeField(blank=True, null=True)
+    last_digest_at = models.DateTimeField(blank=True, null=True)
+    final_digest_at = models.DateTimeField(blank=True, null=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    completed_at = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return f"Campaign #{self.id} message {self.message_id} {self.status} - {self.enqueued_count}/{self.audience_size}"
+
+    class Meta:
+        constraints = [
+            # concurrent SendNewsletter runs of the same message share its running campaign; the runs are serialized
+            # by a lock on the message (see start_or_resume_campaign), this constraint is only enforced by the
+            # databases with partial indexes (not MySQL)
+            models.UniqueConstraint(fields=['message'], condition=models.Q(status='RUNNING'),
+                                    name='unique_running_campaign_per_message'),
+        ]
+
+
+class CampaignShard(models.Model):
+    """
+    A range of subscriber ids of the audience of a campaign, processed by one sender process at a time.
+
+    A SendNewsletter run takes a lease on a shard (lease_owner, renewed at each chunk of subscribers) before
+    enqueuing its subscribers: concurrent runs split the campaign instead of sending the same emails,
+    and the shard of a run that died is taken over when its lease expires (see core/logic_campaign.py).
+    """
+
+    RUNNING = "RUNNING"
+    COMPLETED = "COMPLETED"
+
+    STATUS_CHOICES = [(RUNNING, 'Running'), (COMPLETED, 'Completed')]
+
+    campaign = models.ForeignKey(Campaign, on_delete=models.CASCADE, related_name="shards")
+    index = models.IntegerField()
+
+    # subscriber ids in (start_subscriber_id, end_subscriber_id]
+    start_subscriber_id = models.BigIntegerField()
+    end_subscriber_id = models.BigIntegerField()
+
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=RUNNING)
+
+    # cursor: the shard is processed by increasing subscriber id
+    last_subscriber_id = models.BigIntegerField()
+    enqueued_count = models.IntegerField(default=0)
+
+    lease_owner = models.CharField(max_length=100, blank=True, null=True)
+    lease_expires_at = models.DateTimeField(blank=True, null=True)
+    heartbeat_at = models.DateTimeField(blank=True, null=True)
+
+    completed_at = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return (f"Shard {self.index} of campaign #{self.campaign_id} ({self.start_subscriber_id}, "
+                f"{self.end_subscriber_id}] {self.status}")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['campaign', 'index'], name='unique_shard_per_campaign'),
+        ]
+
+
+class DeadLetter(models.Model):
+    """An email that could not be delivered, after the retries; it can be inspected and replayed."""
+
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, blank=True, null=True)
+    subscriber = models.ForeignKey(SubscriptionToNewsletter, on_delete=models.CASCADE, blank=True, null=True)
+    recipient = models.CharField(max_length=256)
+
+    # TRANSIENT, THROTTLED or PERMANENT (see classify_smtp_error in core/logic_email.py)
+    error_class = models.CharField(max_length=20)
+    smtp_code = models.IntegerField(blank=True, null=True)
+    error = models.TextField()
+    attempts = models.IntegerField(default=1)
+
+    # arguments of send_custom_email_task, to replay emails that are not newsletter messages
+    task_kwargs = models.JSONField(blank=True, null=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    replayed_at = models.DateTimeField(blank=True, null=True)
 
     def __str__(self):
-        return f"Message {self.message.id} sent to {self.subscriber.email} on {self.sent_at}"
+        return f"DeadLetter #{self.id} {self.recipient} {self.error_class} {self.smtp_code} - {self.created_at}"
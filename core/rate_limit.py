@@ -0,0 +1,191 @@
+import asyncio
+import threading
+import time
+
+from django.conf import settings
+
+from core.recipient_domains import get_domain_limits
+from core.shared_store import get_redis_client, mark_unavailable
+
+# refill the bucket and take the requested tokens, atomically; returns the seconds to wait if there are not enough tokens
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local redis_time = redis.call('TIME')
+local now = tonumber(redis_time[1]) + tonumber(redis_time[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'timestamp')
+local tokens = tonumber(state[1]) or burst
+local timestamp = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - timestamp) * rate)
+local wait = 0
+if tokens >= requested then
+    tokens = tokens - requested
+else
+    wait = (requested - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'timestamp', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+
+class LocalTokenBucket:
+    """In-process token bucket; used when redis is not configured (e.g. tests) or not reachable."""
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def try_acquire(self, key, rate, burst, tokens=1):
+        """Takes the tokens if available and returns 0, otherwise returns the seconds to wait."""
+        with self._lock:
+            now = self._clock()
+            available, timestamp = self._buckets.get(key, (burst, now))
+            available = min(burst, available + max(0.0, now - timestamp) * rate)
+            if available >= tokens:
+                self._buckets[key] = (available - tokens, now)
+                return 0
+            self._buckets[key] = (available, now)
+            return (tokens - available) / rate
+
+
+class RedisTokenBucket:
+    """Token bucket shared by all the processes (all the celery workers) through redis."""
+
+    def __init__(self, redis_client):
+        self._script = redis_client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def try_acquire(self, key, rate, burst, tokens=1):
+        return float(self._script(keys=[f"simple_newsletter:rate_limit:{key}"], args=[rate, burst, tokens]))
+
+
+local_token_bucket = LocalTokenBucket()
+
+
+def get_token_bucket():
+    redis_client = get_redis_client()
+    return RedisTokenBucket(redis_client) if redis_client is not None else local_token_bucket
+
+
+def _try_acquire(token_bucket, key, rate, burst, tokens):
+    """Returns (token_bucket, seconds to wait); falls back to the local bucket if the shared one is not available."""
+    try:
+        return token_bucket, token_bucket.try_acquire(key, rate, burst, tokens)
+    except Exception as e:
+        print(f"rate_limit.acquire - shared token bucket not available, using the local one: {e}")
+        mark_unavailable(e)
+        return local_token_bucket, local_token_bucket.try_acquire(key, rate, burst, tokens)
+
+
+def acquire(key, rate, burst, tokens=1):
+    """
+    Blocks until the tokens are available in the bucket identified by key.
+
+    Args:
+    key (str): The bucket identifier (e.g. "email_settings:3").
+    rate (float): Sustained rate, in tokens per second. If None or 0, there is no limit.
+    burst (int): Maximum number of tokens that can be taken at once after an idle period.
+    tokens (int): Number of tokens to take; more than burst are taken in installments of burst tokens.
+
+    Returns:
+    float: The number of seconds spent waiting.
+    """
+    if not rate:
+        return 0
+
+    burst = max(1, burst or 1)
+    token_bucket = get_token_bucket()
+    waited = 0
+
+    while tokens > 0:
+        installment = min(tokens, burst)
+        token_bucket, wait = _try_acquire(token_bucket, key, rate, burst, installment)
+
+        if wait <= 0:
+            tokens -= installment
+            continue
+
+        time.sleep(wait)
+        waited += wait
+
+    return waited
+
+
+async def acquire_async(key, rate, burst, tokens=1):
+    """
+    As acquire, for asyncio code: waits without blocking the event loop.
+    The calls to redis run in a thread, so that a slow or unreachable redis does not stall the other coroutines.
+    """
+    if not rate:
+        return 0
+
+    burst = max(1, burst or 1)
+    token_bucket = get_token_bucket()
+    waited = 0
+
+    while tokens > 0:
+        installment = min(tokens, burst)
+        if token_bucket is local_token_bucket:
+            token_bucket, wait = _try_acquire(token_bucket, key, rate, burst, installment)
+        else:
+            token_bucket, wait = await asyncio.to_thread(_try_acquire, token_bucket, key, rate, burst, installment)
+
+        if wait <= 0:
+            tokens -= installment
+            continue
+
+        await asyncio.sleep(wait)
+        waited += wait
+
+    return waited
+
+
+def get_email_settings_bucket(email_settings):
+    """
+    Returns the (key, rate, burst) of the token bucket of a relay.
+
+    Args:
+    email_settings (dict): The EmailSettings.to_dict() of the relay, or None for the default connection.
+    """
+    if email_settings is None:
+        rate = getattr(settings, 'EMAIL_DEFAULT_RATE_LIMIT', None)
+        burst = getattr(settings, 'EMAIL_DEFAULT_RATE_LIMIT_BURST', 1)
+        return "email_settings:default", rate, burst
+
+    return f"email_settings:{email_settings['id']}", email_settings.get('rate_limit'), email_settings.get('rate_limit_burst')
+
+
+def acquire_email_settings_slot(email_settings, messages=1):
+    """
+    Waits for the rate limit of the relay before sending messages through it.
+
+    Args:
+    email_settings (dict): The EmailSettings.to_dict() of the relay, or None for the default connection.
+    messages (int): The number of recipients about to be sent to (the relays count each RCPT TO: an envelope
+        email takes one token for each of its recipients).
+    """
+    key, rate, burst = get_email_settings_bucket(email_settings)
+    return acquire(key, rate, burst, messages)
+
+
+async def acquire_email_settings_slot_async(email_settings, messages=1):
+    """As acquire_email_settings_slot, for asyncio code."""
+    key, rate, burst = get_email_settings_bucket(email_settings)
+    return await acquire_async(key, rate, burst, messages)
+
+
+def acquire_domain_slot(domain, messages=1):
+    """
+    Waits for the rate limit of the recipient domain (e.g. gmail.com), shared by all the workers,
+    before sending messages to it. See EMAIL_DOMAIN_LIMITS in settings.py.
+    """
+    limits = get_domain_limits(domain)
+    return acquire(f"domain:{domain}", limits['rate'], limits['burst'], messages)
+
+
+async def acquire_domain_slot_async(domain, messages=1):
+    """As acquire_domain_slot, for asyncio code."""
+    limits = get_domain_limits(domain)
+    return await acquire_async(f"domain:{domain}", limits['rate'], limits['burst'], messages)
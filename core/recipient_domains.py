@@ -0,0 +1,73 @@
+from itertools import chain, zip_longest
+
+from django.conf import settings
+
+
+def get_email_domain(email):
+    """Returns the domain of the email address, lowercase ('' if the address has no domain)."""
+    return email.rpartition('@')[2].strip().lower() if email and '@' in email else ''
+
+
+def get_domain_limits(domain):
+    """
+    Returns the limits for the recipients of the domain: a dictionary with rate (emails per second, None = no limit),
+    burst and concurrency (emails in flight at the same time, None = no limit).
+    See EMAIL_DOMAIN_LIMITS and EMAIL_DOMAIN_DEFAULT_LIMITS in settings.py.
+    """
+    limits = {'rate': None, 'burst': 10, 'concurrency': None}
+    limits.update(getattr(settings, 'EMAIL_DOMAIN_DEFAULT_LIMITS', None) or {})
+    limits.update((getattr(settings, 'EMAIL_DOMAIN_LIMITS', None) or {}).get(domain, {}))
+    return limits
+
+
+def interleave(queues):
+    """Round robin over the queues: the first item of each queue, then the second one, and so on."""
+    return [item for item in chain.from_iterable(zip_longest(*queues)) if item is not None]
+
+
+def interleave_by_domain(items, get_email):
+    """
+    Reorders the items so that the recipients of the same domain are spread over the whole list
+    (round robin over the domains) instead of arriving in a burst.
+
+    Args:
+    items (list): The items to reorder.
+    get_email (callable): Returns the recipient email address of an item.
+    """
+    groups = {}
+    for item in items:
+        groups.setdefault(get_email_domain(get_email(item)), []).append(item)
+    return interleave(list(groups.values()))
+
+
+def plan_domain_batches(recipients, batch_size):
+    """
+    Splits the recipients in batches of subscriber ids grouped by domain: each domain with at least batch_size
+    recipients has its own batches, the recipients of the other domains share mixed batches.
+    The batches of the different domains are interleaved, so that consecutive batches go to different providers.
+
+    Args:
+    recipients (list): List of (subscriber id, email) tuples.
+    batch_size (int): Maximum number of recipients in a batch.
+
+    Returns:
+    list: The batches, each one a list of subscriber ids.
+    """
+    groups = {}
+    for subscriber_id, email in recipients:
+        groups.setdefault(get_email_domain(email), []).append(subscriber_id)
+
+    queues = []
+    mixed = []
+    for subscriber_ids in groups.values():
+        if len(subscriber_ids) >= batch_size:
+            queues.append([subscriber_ids[start:start + batch_size]
+                           for start in range(0, len(subscriber_ids), batch_size)])
+        else:
+            mixed.extend(subscriber_ids)
+
+    if mixed:
+        mixed.sort()
+        queues.append([mixed[start:start + batch_size] for start in range(0, len(mixed), batch_size)])
+
+    return interleave(queues)
@@ -0,0 +1,184 @@
+import random
+import threading
+import time
+
+from django.conf import settings
+
+from core.logic_email import email_connection_pool, count_recipients, SESSION_PRESERVING_ERRORS, \
+    DeliveryUncertainError
+from core.shared_store import get_redis_client, mark_unavailable
+
+
+def get_newsletter_relays(newsletter):
+    """
+    Returns the relays of the newsletter as a list of [email_settings_id, weight];
+    if the newsletter has no enabled relays, its email_settings (None: the default connection) is the only relay.
+    """
+    relays = [[relay.email_settings_id, relay.weight]
+              for relay in newsletter.relays.filter(enabled=True, weight__gt=0).order_by('id')]
+    return relays or [[newsletter.email_settings_id, 1]]
+
+
+class RelayHealth:
+    """
+    Health of the relays: after EMAIL_RELAY_MAX_FAILURES consecutive errors, or when the average time to send
+    an email is above EMAIL_RELAY_SLOW_SECONDS, a relay is put in cooldown for EMAIL_RELAY_COOLDOWN_SECONDS
+    and its traffic goes to the other relays. The cooldown is shared by all the workers through redis
+    (SHARED_STORE_REDIS_URL), or kept in this process.
+    """
+
+    # weight of the last sample in the moving average of the send time
+    LATENCY_SMOOTHING = 0.2
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._failures = {}
+        self._latency = {}
+        self._cooldown_until = {}
+        self._shared_cooldown = {}  # {email_settings_id: (time read from the shared store, in cooldown)}
+
+    @staticmethod
+    def _redis_key(email_settings_id):
+        return f"simple_newsletter:relay_cooldown:{email_settings_id or 'default'}"
+
+    def _start_cooldown(self, email_settings_id, reason):
+        cooldown = getattr(settings, 'EMAIL_RELAY_COOLDOWN_SECONDS', 300)
+        print(f"RelayHealth - relay {email_settings_id} in cooldown for {cooldown} seconds: {reason}")
+
+        with self._lock:
+            self._cooldown_until[email_settings_id] = time.monotonic() + cooldown
+            self._failures[email_settings_id] = 0
+            self._latency.pop(email_settings_id, None)
+
+        try:
+            redis_client = get_redis_client()
+            if redis_client is not None:
+                redis_client.set(self._redis_key(email_settings_id), reason[:200], ex=cooldown)
+        except Exception as e:
+            print(f"RelayHealth - shared store not available: {e}")
+            mark_unavailable(e)
+
+    def get_relays_in_cooldown(self, email_settings_ids):
+        """
+        Returns the set of the given relays that are in cooldown, in this process or in the shared store.
+        The cooldowns of the shared store are read with one MGET for all the relays, and kept in the process
+        for EMAIL_RELAY_HEALTH_CACHE_SECONDS.
+        """
+        cache_seconds = getattr(settings, 'EMAIL_RELAY_HEALTH_CACHE_SECONDS', 5)
+        now = time.monotonic()
+
+        with self._lock:
+            in_cooldown = {email_settings_id for email_settings_id in email_settings_ids
+                           if self._cooldown_until.get(email_settings_id, 0) > now}
+            to_read = [email_settings_id for email_settings_id in email_settings_ids
+                       if email_settings_id not in in_cooldown
+                       and now - self._shared_cooldown.get(email_settings_id, (float('-inf'), False))[0] >= cache_seconds]
+
+        if to_read:
+            try:
+                redis_client = get_redis_client()
+                if redis_client is not None:
+                    values = redis_client.mget([self._redis_key(email_settings_id) for email_settings_id in to_read])
+                    with self._lock:
+                        for email_settings_id, value in zip(to_read, values):
+                            self._shared_cooldown[email_settings_id] = (now, value is not None)
+            except Exception as e:
+                print(f"RelayHealth - shared store not available: {e}")
+                mark_unavailable(e)
+
+        with self._lock:
+            return in_cooldown | {
+                email_settings_id for email_settings_id in email_settings_ids
+                if email_settings_id in self._shared_cooldown
+                and now - self._shared_cooldown[email_settings_id][0] <= cache_seconds
+                and self._shared_cooldown[email_settings_id][1]
+            }
+
+    def is_healthy(self, email_settings_id):
+        return email_settings_id not in self.get_relays_in_cooldown([email_settings_id])
+
+    def record_success(self, email_settings_id, elapsed):
+        slow_seconds = getattr(settings, 'EMAIL_RELAY_SLOW_SECONDS', 10)
+
+        with self._lock:
+            self._failures[email_settings_id] = 0
+            latency = self._latency.get(email_settings_id, elapsed)
+            latency += (elapsed - latency) * self.LATENCY_SMOOTHING
+            self._latency[email_settings_id] = latency
+
+        if latency > slow_seconds:
+            self._start_cooldown(email_settings_id, f"slow relay, {latency:.1f} seconds for each email")
+
+    def record_failure(self, email_settings_id, error):
+        max_failures = getattr(settings, 'EMAIL_RELAY_MAX_FAILURES', 3)
+
+        with self._lock:
+            failures = self._failures.get(email_settings_id, 0) + 1
+            self._failures[email_settings_id] = failures
+
+        if failures >= max_failures:
+            self._start_cooldown(email_settings_id, f"{failures} consecutive errors, last one: {error}")
+
+
+relay_health = RelayHealth()
+
+
+def order_relays(relays):
+    """
+    Returns the email_settings ids of the relays in the order in which they should be tried:
+    a weighted random order (so that the traffic is sharded by weight), healthy relays first.
+    """
+    # weighted random sampling without replacement (Efraimidis-Spirakis)
+    ordered = sorted(relays, key=lambda relay: random.random() ** (1.0 / relay[1]), reverse=True)
+    in_cooldown = relay_health.get_relays_in_cooldown([relay[0] for relay in ordered])
+    healthy = [relay[0] for relay in ordered if relay[0] not in in_cooldown]
+    return healthy + [relay[0] for relay in ordered if relay[0] in in_cooldown]
+
+
+def send_with_failover(email_messages, relays, results=None):
+    """
+    Sends the email messages through one of the relays, chosen by weight among the healthy ones;
+    if the relay fails, the next one is tried.
+
+    Args:
+    email_messages (list): The EmailMessage instances.
+    relays (list): The relays, as returned by get_newsletter_relays.
+    results (list, optional): If given, the outcome of each message is appended to it, and the errors concerning
+        a single message do not stop the sending (see EmailConnectionPool.send_messages); when a relay fails,
+        only the messages without an outcome are sent through the next one. Without results, the messages
+        fail over only if none of them has been transmitted (otherwise DeliveryUncertainError is raised).
+
+    Returns:
+    int: The email_settings id of the relay that sent the messages.
+    """
+    last_error = None
+    first_result = len(results) if results is not None else 0
+
+    for email_settings_id in order_relays(relays):
+        pending = email_messages[len(results) - first_result:] if results is not None else email_messages
+        try:
+            # the time spent waiting for the rate limit does not count as latency of the relay
+            email_connection_pool.throttle(email_settings_id, count_recipients(pending))
+            start = time.monotonic()
+            email_connection_pool.send_messages(pending, email_settings_id, throttle=False, results=results)
+        except SESSION_PRESERVING_ERRORS:
+            # the relay is working: the error concerns the message (e.g. a refused recipient)
+            raise
+        except DeliveryUncertainError as e:
+            # the relay may have accepted the message in flight: only the messages never transmitted fail over
+            print(f"send_with_failover - relay {email_settings_id} failed after DATA: {e}")
+            relay_health.record_failure(email_settings_id, str(e))
+            if results is None or len(results) - first_result == len(email_messages):
+                raise
+            last_error = e
+            continue
+        except Exception as e:
+            print(f"send_with_failover - relay {email_settings_id} failed: {e}")
+            relay_health.record_failure(email_settings_id, str(e))
+            last_error = e
+            continue
+
+        relay_health.record_success(email_settings_id, (time.monotonic() - start) / max(1, len(pending)))
+        return email_settings_id
+
+    raise last_error
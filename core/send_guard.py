@@ -0,0 +1,136 @@
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+from core.shared_store import get_redis_client, mark_unavailable
+
+# outcomes of reserve_send
+RESERVED = "RESERVED"  # the caller can send the email, then call mark_sent (or release_send if it fails)
+ALREADY_SENT = "ALREADY_SENT"  # the email has already been sent: do not send it again
+IN_PROGRESS = "IN_PROGRESS"  # another worker is sending the email (or died while sending it)
+
+SENT = "sent"
+
+# deletes the reservation only if it is still held by the caller
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def get_newsletter_send_key(message_id, subscriber_id):
+    """The idempotency key of the newsletter email of a message to a subscriber."""
+    return f"newsletter:{message_id}:{subscriber_id}"
+
+
+def get_task_send_key(task_id):
+    """The idempotency key of the email sent by a celery task: redeliveries and retries of the task share it."""
+    return f"task:{task_id}"
+
+
+class LocalSendGuard:
+    """In-process store of the idempotency keys; used when redis is not configured (e.g. tests) or not reachable."""
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._keys = {}
+
+    def _get(self, key):
+        value, expires_at = self._keys.get(key, (None, 0))
+        return value if expires_at > self._clock() else None
+
+    def reserve(self, key, token, ttl):
+        with self._lock:
+            value = self._get(key)
+            if value is None:
+                self._keys[key] = (token, self._clock() + ttl)
+            return value
+
+    def mark_sent(self, key, ttl):
+        with self._lock:
+            self._keys[key] = (SENT, self._clock() + ttl)
+
+    def release(self, key, token):
+        with self._lock:
+            if self._get(key) == token:
+                del self._keys[key]
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+
+
+class RedisSendGuard:
+    """Idempotency keys shared by all the processes (all the celery workers) through redis."""
+
+    def __init__(self, redis_client):
+        self._redis = redis_client
+        self._release_script = redis_client.register_script(RELEASE_SCRIPT)
+
+    @staticmethod
+    def _redis_key(key):
+        return f"simple_newsletter:send_guard:{key}"
+
+    def reserve(self, key, token, ttl):
+        """Sets the key (SET NX) and returns None, or returns the value of the key if it is already set."""
+        if self._redis.set(self._redis_key(key), token, nx=True, ex=ttl):
+            return None
+        value = self._redis.get(self._redis_key(key))
+        # the key has expired in the meantime: considered in progress, it is checked again later
+        return value.decode() if value is not None else ""
+
+    def mark_sent(self, key, ttl):
+        self._redis.set(self._redis_key(key), SENT, ex=ttl)
+
+    def release(self, key, token):
+        self._release_script(keys=[self._redis_key(key)], args=[token])
+
+
+local_send_guard = LocalSendGuard()
+
+
+def get_send_guard():
+    redis_client = get_redis_client()
+    return RedisSendGuard(redis_client) if redis_client is not None else local_send_guard
+
+
+def _call(method, *args):
+    """Calls the method of the shared store, falling back to the local one if the shared one is not available."""
+    send_guard = get_send_guard()
+    try:
+        return getattr(send_guard, method)(*args)
+    except Exception as e:
+        print(f"send_guard.{method} - shared store not available, using the local one: {e}")
+        mark_unavailable(e)
+        return getattr(local_send_guard, method)(*args)
+
+
+def reserve_send(key):
+    """
+    Checks the idempotency key before sending an email, and reserves it for SEND_GUARD_RESERVATION_SECONDS.
+
+    Returns:
+    tuple: (state, token): state is RESERVED, ALREADY_SENT or IN_PROGRESS; the token of the reservation
+           (None if not reserved) is needed by release_send.
+    """
+    token = uuid.uuid4().hex
+    value = _call('reserve', key, token, getattr(settings, 'SEND_GUARD_RESERVATION_SECONDS', 600))
+    if value is None:
+        return RESERVED, token
+    return (ALREADY_SENT if value == SENT else IN_PROGRESS), None
+
+
+def mark_sent(key):
+    """Records that the email has been sent (the relay has accepted it), right after the sending."""
+    _call('mark_sent', key, getattr(settings, 'SEND_GUARD_TTL_SECONDS', 7 * 24 * 3600))
+
+
+def release_send(key, token):
+    """Gives back the reservation of an email that has not been sent, so that it can be sent again."""
+    if token:
+        _call('release', key, token)
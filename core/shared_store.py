@@ -0,0 +1,39 @@
+import os
+import time
+
+from django.conf import settings
+
+_redis_clients = {}
+_unavailable_until = {}
+
+
+def get_redis_client():
+    """
+    Returns the redis client used to share state between processes (rate limits, locks, ...),
+    or None if SHARED_STORE_REDIS_URL is not set: in this case the callers use a local, in-process fallback.
+    The client is created once for each process.
+    After a failure (see mark_unavailable), None is returned for SHARED_STORE_RETRY_SECONDS, so that the callers
+    do not wait for the connection timeout at each call while redis is not reachable.
+    """
+    url = getattr(settings, 'SHARED_STORE_REDIS_URL', None)
+    if not url:
+        return None
+
+    key = (os.getpid(), url)
+    if _unavailable_until.get(key, 0) > time.monotonic():
+        return None
+    if key not in _redis_clients:
+        import redis
+        _redis_clients[key] = redis.Redis.from_url(url, socket_timeout=5, socket_connect_timeout=5)
+    return _redis_clients[key]
+
+
+def mark_unavailable(error):
+    """Records that the redis of SHARED_STORE_REDIS_URL has failed: the local fallback is used for a while."""
+    url = getattr(settings, 'SHARED_STORE_REDIS_URL', None)
+    if not url:
+        return
+
+    retry_seconds = getattr(settings, 'SHARED_STORE_RETRY_SECONDS', 30)
+    print(f"shared_store - redis not available, using the local fallback for {retry_seconds} seconds: {error}")
+    _unavailable_until[(os.getpid(), url)] = time.monotonic() + retry_seconds
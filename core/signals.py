@@ -0,0 +1,11 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from core.models import EmailTemplate
+from core.template_utils import compiled_template_cache
+
+
+@receiver(post_save, sender=EmailTemplate)
+@receiver(post_delete, sender=EmailTemplate)
+def invalidate_compiled_template(sender, instance, **kwargs):
+    compiled_template_cache.invalidate(instance.id)
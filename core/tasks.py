@@ -1,18 +1,280 @@
 from celery import shared_task
+from celery.signals import worker_process_shutdown
 from django.core.mail import send_mail
 from django.conf import settings
 from django.template.loader import render_to_string
 from django.utils import timezone
 
-from core.business_logic import create_event_log
-from core.logic_email import send_custom_email
-from core.models import SubscriptionToNewsletter, MessageLog, Message
+from core.business_logic import create_event_log, create_dead_letters, record_delivery_outcomes, record_visitor_emails, \
+    record_already_sent_deliveries
+from core.logic_campaign import run_campaign, dispatch_scheduled_messages
+from core.logic_email import send_custom_email, email_connection_pool, classify_smtp_error, get_retry_countdown, \
+    PERMANENT, create_custom_email, send_email, get_smtp_reply, send_envelope_email, DeliveryUncertainError
+from core.logic_newsletter import send_newsletter_batch, get_message_for_sending
+from core.logic_notifications import send_campaign_digests
+from core.models import SubscriptionToNewsletter, MessageLog, Message, NewsletterDeliveryRecord, Visitor
+from core.relays import get_newsletter_relays
+from core.send_guard import get_newsletter_send_key, get_task_send_key, reserve_send, mark_sent, release_send, \
+    ALREADY_SENT, IN_PROGRESS
 from simple_newsletter.settings import NOTIFICATION_BCC_RECIPIENTS
 
 
+@worker_process_shutdown.connect
+def close_pooled_email_connections(**kwargs):
+    email_connection_pool.close_all()
+
+
+@shared_task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def send_custom_email_task(self, sender_email, recipient_email, subject, html_content, bcc=None,
+                           email_settings_id=None, relays=None, message_id=None, subscriber_id=None):
+    """
+    Sends the email; transient and throttling errors are retried with exponential backoff,
+    up to EMAIL_RETRY_MAX_ATTEMPTS attempts. The emails that cannot be delivered go to the DeadLetter store.
+    message_id and subscriber_id identify the newsletter email, if this is one: its outcome is written
+    to the delivery ledger (NewsletterDeliveryRecord).
+    The email is guarded by an idempotency key (the newsletter email, or the id of the task, which is kept
+    by retries and redeliveries; see core/send_guard.py): a task delivered again is not sent twice.
+    """
+    send_key = None
+    token = None
+    if message_id and subscriber_id:
+        send_key = get_newsletter_send_key(message_id, subscriber_id)
+    elif self.request.id:
+        send_key = get_task_send_key(self.request.id)
+
+    if send_key:
+        state, token = reserve_send(send_key)
+        if state == ALREADY_SENT:
+            print(f"send_custom_email_task - email to {recipient_email} already sent ({send_key}), skipped")
+            return 0
+        if state == IN_PROGRESS:
+            countdown = getattr(settings, 'SEND_GUARD_RESERVATION_SECONDS', 600)
+            print(f"send_custom_email_task - email to {recipient_email} being sent by another worker ({send_key}), "
+                  f"checking again in {countdown} seconds")
+            raise self.retry(countdown=countdown, max_retries=getattr(settings, 'EMAIL_RETRY_MAX_ATTEMPTS', 5) - 1)
+
+    email = create_custom_email(sender_email, recipient_email, subject, html_content, bcc)
+    try:
+        sent = send_email(email, email_settings_id, relays)
+    except Exception as e:
+        if send_key and not isinstance(e, DeliveryUncertainError):
+            # kept reserved if the relay may have accepted the email, see DeliveryUncertainError
+            release_send(send_key, token)
+        error_class, smtp_code = classify_smtp_error(e)
+        attempts = self.request.retries + 1
+        max_attempts = getattr(settings, 'EMAIL_RETRY_MAX_ATTEMPTS', 5)
+
+        if error_class != PERMANENT and attempts < max_attempts:
+            countdown = get_retry_countdown(self.request.retries, error_class)
+            print(f"send_custom_email_task - {error_class} error sending to {recipient_email}, "
+                  f"attempt {attempts} of {max_attempts}, retrying in {countdown:.1f} seconds: {e}")
+            raise self.retry(exc=e, countdown=countdown, max_retries=max_attempts - 1)
+
+        print(f"send_custom_email_task - {error_class} error sending to {recipient_email}, giving up: {e}")
+        if message_id and subscriber_id:
+            record_delivery_outcomes(message_id, [{
+                'subscriber_id': subscriber_id,
+                'status': NewsletterDeliveryRecord.FAILED,
+                'smtp_code': smtp_code,
+                'smtp_response': str(e),
+            }])
+        create_dead_letters([{
+            'message_id': message_id,
+            'subscriber_id': subscriber_id,
+            'recipient': recipient_email,
+            'error_class': error_class,
+            'smtp_code': smtp_code,
+            'error': str(e),
+            'attempts': attempts,
+            'task_kwargs': {
+                'sender_email': sender_email,
+                'recipient_email': recipient_email,
+                'subject': subject,
+                'html_content': html_content,
+                'bcc': bcc,
+                'email_settings_id': email_settings_id,
+                'relays': relays,
+                'message_id': message_id,
+                'subscriber_id': subscriber_id,
+            },
+        }])
+        create_event_log(
+            event_type="EMAIL_FAILED",
+            event_title=f"Email not sent - subject: {subject}",
+            event_data=f"recipient: {recipient_email} - {error_class} {smtp_code} - attempts: {attempts} - error: {e}",
+            event_target=recipient_email
+        )
+        return 0
+
+    if send_key:
+        mark_sent(send_key)
+
+    if message_id and subscriber_id:
+        smtp_code, smtp_response = get_smtp_reply(email)
+        record_delivery_outcomes(message_id, [{
+            'subscriber_id': subscriber_id,
+            'status': NewsletterDeliveryRecord.SENT,
+            'smtp_code': smtp_code,
+            'smtp_response': smtp_response,
+        }])
+
+    return sent
+
+
+@shared_task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def send_visitor_emails_task(self, sender_email, visitor_ids, subject, html_content, template=None, bcc=None):
+    """
+    Sends the same email to a batch of visitors with a single SMTP transaction (see send_envelope_email).
+    The visitors accepted by the relay are marked as email_sent; the outcome for each visitor is logged in EventLog.
+    Errors of the whole transaction are retried as in send_custom_email_task.
+    The transaction is guarded by the idempotency key of the task, as in send_custom_email_task.
+    """
+    visitors = list(Visitor.objects.filter(id__in=visitor_ids, email_sent=False).order_by('id'))
+    if not visitors:
+        return 0
+
+    send_key = get_task_send_key(self.request.id) if self.request.id else None
+    token = None
+    if send_key:
+        state, token = reserve_send(send_key)
+        if state == ALREADY_SENT:
+            # sent by a previous delivery of this task, which died before recording the outcome
+            print(f"send_visitor_emails_task - email to {len(visitors)} visitors already sent ({send_key})")
+            return record_visitor_emails(visitors, subject, template)
+        if state == IN_PROGRESS:
+            countdown = getattr(settings, 'SEND_GUARD_RESERVATION_SECONDS', 600)
+            print(f"send_visitor_emails_task - email to {len(visitors)} visitors being sent by another worker "
+                  f"({send_key}), checking again in {countdown} seconds")
+            raise self.retry(countdown=countdown, max_retries=getattr(settings, 'EMAIL_RETRY_MAX_ATTEMPTS', 5) - 1)
+
+    try:
+        refused = send_envelope_email(sender_email, [visitor.email_address for visitor in visitors],
+                                      subject, html_content, bcc)
+        failed = {address: f"{code} {text}" for address, (code, text) in refused.items()}
+    except Exception as e:
+        if send_key and not isinstance(e, DeliveryUncertainError):
+            # kept reserved if the relay may have accepted the email, see DeliveryUncertainError
+            release_send(send_key, token)
+        error_class, smtp_code = classify_smtp_error(e)
+        attempts = self.request.retries + 1
+        max_attempts = getattr(settings, 'EMAIL_RETRY_MAX_ATTEMPTS', 5)
+
+        if error_class != PERMANENT and attempts < max_attempts:
+            countdown = get_retry_countdown(self.request.retries, error_class)
+            print(f"send_visitor_emails_task - {error_class} error sending to {len(visitors)} visitors, "
+                  f"attempt {attempts} of {max_attempts}, retrying in {countdown:.1f} seconds: {e}")
+            raise self.retry(exc=e, countdown=countdown, max_retries=max_attempts - 1)
+
+        print(f"send_visitor_emails_task - {error_class} error sending to {len(visitors)} visitors, giving up: {e}")
+        failed = {visitor.email_address: f"{error_class} {smtp_code} - {e}" for visitor in visitors}
+    else:
+        if send_key:
+            mark_sent(send_key)
+
+    sent = record_visitor_emails(visitors, subject, template, failed)
+    print(f"send_visitor_emails_task - sent: {sent} failed: {len(visitors) - sent}")
+    return sent
+
+
+@shared_task(acks_late=True, reject_on_worker_lost=True)
+def send_newsletter_batch_task(message_id, subscriber_ids, bcc=None, attempt=1):
+    """
+    Renders and sends a message to a chunk of subscribers over one connection; returns the outcome of each recipient.
+    The recipients that failed with a transient or throttling error are sent again by a new task, after a backoff;
+    permanent errors (and the recipients still failing after EMAIL_RETRY_MAX_ATTEMPTS) go to the DeadLetter store.
+    The outcome of each recipient is written to the delivery ledger with one upsert for the chunk
+    (the recipients to be retried stay QUEUED).
+    """
+    result = send_newsletter_batch(message_id, subscriber_ids, bcc)
+    print(f"send_newsletter_batch_task: message {message_id} - attempt {attempt} - "
+          f"sent: {len(result['sent'])} failed: {len(result['failed'])} "
+          f"already sent: {len(result['already_sent'])} in progress: {len(result['in_progress'])}")
+
+    if result['already_sent']:
+        # sent by a previous delivery of this task, which died before recording the outcome
+        record_already_sent_deliveries(message_id, result['already_sent'])
+
+    if result['in_progress']:
+        # being sent by another worker (or by a worker that died while sending): checked again
+        # when their reservation expires
+        send_newsletter_batch_task.apply_async((message_id, result['in_progress']),
+                                               {'bcc': bcc, 'attempt': attempt},
+                                               countdown=getattr(settings, 'SEND_GUARD_RESERVATION_SECONDS', 600))
+
+    max_attempts = getattr(settings, 'EMAIL_RETRY_MAX_ATTEMPTS', 5)
+
+    retries = {}
+    dead_letters = []
+    outcomes = [{
+        'subscriber_id': int(subscriber_id),
+        'status': NewsletterDeliveryRecord.SENT,
+        'smtp_code': reply['smtp_code'],
+        'smtp_response': reply['smtp_response'],
+    } for subscriber_id, reply in result['sent'].items()]
+
+    for subscriber_id, failure in result['failed'].items():
+        if failure['error_class'] != PERMANENT and attempt < max_attempts:
+            retries.setdefault(failure['error_class'], []).append(int(subscriber_id))
+        else:
+            outcomes.append({
+                'subscriber_id': int(subscriber_id),
+                'status': NewsletterDeliveryRecord.FAILED,
+                'smtp_code': failure['smtp_code'],
+                'smtp_response': failure['error'],
+            })
+            dead_letters.append({
+                'message_id': message_id,
+                'subscriber_id': int(subscriber_id),
+                'recipient': failure['recipient'],
+                'error_class': failure['error_class'],
+                'smtp_code': failure['smtp_code'],
+                'error': failure['error'],
+                'attempts': attempt,
+            })
+
+    for error_class, retry_ids in retries.items():
+        countdown = get_retry_countdown(attempt - 1, error_class)
+        print(f"send_newsletter_batch_task: message {message_id} - retrying {len(retry_ids)} recipients "
+              f"({error_class}) in {countdown:.1f} seconds")
+        send_newsletter_batch_task.apply_async((message_id, retry_ids),
+                                               {'bcc': bcc, 'attempt': attempt + 1},
+                                               countdown=countdown)
+
+    if outcomes:
+        record_delivery_outcomes(message_id, outcomes)
+
+    if dead_letters:
+        create_dead_letters(dead_letters)
+
+    return result
+
+
+@shared_task(acks_late=True, reject_on_worker_lost=True)
+def send_newsletter_email_task(message_id, subscriber_id, bcc=None):
+    """
+    Renders (in the worker) and sends a message to one subscriber: the task only carries ids,
+    the parts of the message common to all the recipients are rendered once by each worker process.
+    """
+    return send_newsletter_batch_task(message_id, [subscriber_id], bcc)
+
+
+@shared_task
+def run_campaign_task(message_id, batch_size=None):
+    """Sends a message to all its audience (resuming its running campaign, if any)."""
+    batch_size = batch_size or settings.SCHEDULED_CAMPAIGN_BATCH_SIZE
+    return run_campaign(get_message_for_sending(message_id), batch_size=batch_size)
+
+
+@shared_task
+def dispatch_scheduled_messages_task():
+    """Periodic task (celery beat): starts the campaigns of the messages whose to_be_processed_at is due."""
+    return dispatch_scheduled_messages(run_campaign_task.delay)
+
+
 @shared_task
-def send_custom_email_task(sender_email, recipient_email, subject, html_content, bcc=None, email_settings_id=None):
-    return send_custom_email(sender_email, recipient_email, subject, html_content, bcc, email_settings_id)
+def send_campaign_digests_task():
+    """Periodic task (celery beat): sends the delivery digest of the campaigns to NOTIFICATION_BCC_RECIPIENTS."""
+    return send_campaign_digests()
 
 
 @shared_task
@@ -71,7 +333,7 @@ def process_subscription_task(subscription_id):
                       subject,
                       html_content,
                       bcc=NOTIFICATION_BCC_RECIPIENTS,
-                      email_settings_id=newsletter_instance.email_settings.id if newsletter_instance.email_settings else None
+                      relays=get_newsletter_relays(newsletter_instance)
                       )
 
     subscription.verification_email_sent = True
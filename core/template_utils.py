@@ -1,6 +1,9 @@
 import random
 import string
+import threading
+from collections import OrderedDict
 
+from django.conf import settings
 from django.template import Context, Template
 from django.utils.safestring import mark_safe
 
@@ -18,6 +21,70 @@ def render_template_from_string(template_string, context=None):
     return mark_safe(template.render(Context(context)))
 
 
+class CompiledTemplateCache:
+    """
+    Process-wide LRU cache of compiled templates, keyed by EmailTemplate id and updated_at.
+    A template saved in another process has a new updated_at, so its stale compiled version is never used.
+    """
+
+    def __init__(self, max_size=None):
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._templates = OrderedDict()
+
+    @property
+    def max_size(self):
+        return self._max_size or getattr(settings, 'EMAIL_TEMPLATE_CACHE_SIZE', 64)
+
+    def get(self, email_template):
+        """
+        Returns the compiled django Template of the EmailTemplate instance, compiling it if needed.
+        """
+        key = (email_template.id, email_template.updated_at)
+        with self._lock:
+            template = self._templates.get(key)
+            if template is not None:
+                self._templates.move_to_end(key)
+                return template
+
+        template = Template(email_template.body)
+
+        with self._lock:
+            # drop the versions compiled before the last update of the template
+            for stale_key in [k for k in self._templates if k[0] == email_template.id]:
+                del self._templates[stale_key]
+            self._templates[key] = template
+            while len(self._templates) > self.max_size:
+                self._templates.popitem(last=False)
+
+        return template
+
+    def invalidate(self, email_template_id):
+        with self._lock:
+            for key in [k for k in self._templates if k[0] == email_template_id]:
+                del self._templates[key]
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+
+
+compiled_template_cache = CompiledTemplateCache()
+
+
+def render_email_template(email_template, context=None):
+    """
+    Renders the body of an EmailTemplate instance, using the compiled template cache.
+
+    :param email_template: The EmailTemplate instance.
+    :param context: The context dictionary to render the template with.
+    :return: The rendered template as a string.
+    """
+    context = context or {}
+    template = compiled_template_cache.get(email_template)
+    return mark_safe(template.render(Context(context)))
+
+
 def get_rnd_str(length=8):
     # Define the character pool to include a-z, A-Z, and 0-9
     char_pool = string.ascii_letters + string.digits
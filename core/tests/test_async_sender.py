@@ -0,0 +1,242 @@
+import asyncio
+import threading
+
+import pytest
+from asgiref.sync import async_to_sync
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from core import logic_async_sender
+from core.business_logic import register_message_deliveries
+from core.logic_async_sender import AsyncSender, claim_async_deliveries
+from core.logic_campaign import run_campaign
+from core.models import EmailTemplate, Newsletter, SubscriptionToNewsletter, Message, NewsletterDeliveryRecord, \
+    Campaign, DeadLetter
+from core.relays import RelayHealth
+from core.send_guard import local_send_guard, reserve_send, get_newsletter_send_key, ALREADY_SENT, IN_PROGRESS
+
+
+class AsyncSmtpSink:
+    """
+    Local asyncio SMTP server that accepts the messages and refuses the recipients containing "refused";
+    with disconnect_at ("MAIL" or "DATA"), it drops the session at that command (after the content of the message
+    for DATA, before the reply).
+    """
+
+    def __init__(self, pipelining=True, disconnect_at=None):
+        self.pipelining = pipelining
+        self.disconnect_at = disconnect_at
+        self.messages = []
+        self.sessions = 0
+        self.port = None
+        self._started = threading.Event()
+
+    async def handle(self, reader, writer):
+        self.sessions += 1
+        writer.write(b"220 sink ESMTP\r\n")
+        recipients = []
+        while line := await reader.readline():
+            command = line.strip().decode()
+            verb = command[:4].upper()
+            if verb == "MAIL" and self.disconnect_at == "MAIL":
+                break
+            if verb == "EHLO":
+                writer.write(b"250-sink\r\n" + (b"250-PIPELINING\r\n" if self.pipelining else b"") + b"250 8BITMIME\r\n")
+            elif verb == "MAIL":
+                recipients = []
+                writer.write(b"250 2.1.0 Ok\r\n")
+            elif verb == "RCPT":
+                if "refused" in command:
+                    writer.write(b"550 5.1.1 User unknown\r\n")
+                else:
+                    recipients.append(command[9:-1])
+                    writer.write(b"250 2.1.5 Ok\r\n")
+            elif verb == "DATA":
+                if not recipients:
+                    writer.write(b"554 5.5.1 No valid recipients\r\n")
+                    continue
+                writer.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+                await writer.drain()
+                data = []
+                while (data_line := await reader.readline()) != b".\r\n":
+                    data.append(data_line)
+                self.messages.append((recipients, b"".join(data)))
+                if self.disconnect_at == "DATA":
+                    break
+                writer.write(f"250 2.0.0 Ok: queued as {len(self.messages)}\r\n".encode())
+            elif verb == "QUIT":
+                writer.write(b"221 Bye\r\n")
+                await writer.drain()
+                break
+            else:
+                writer.write(b"250 Ok\r\n")
+            await writer.drain()
+        writer.close()
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.port = server.sockets[0].getsockname()[1]
+        self._started.set()
+        async with server:
+            await server.serve_forever()
+
+    def start(self):
+        threading.Thread(target=lambda: asyncio.run(self.serve()), daemon=True).start()
+        self._started.wait(5)
+        return self
+
+
+@pytest.mark.parametrize("pipelining", [True, False], ids=["pipelining", "no-pipelining"])
+def test_async_sender_end_to_end(db, settings, pipelining):
+    # Arrange
+    sink = AsyncSmtpSink(pipelining=pipelining).start()
+    settings.EMAIL_HOST = "127.0.0.1"
+    settings.EMAIL_PORT = sink.port
+    settings.EMAIL_HOST_USER = ""
+    settings.EMAIL_HOST_PASSWORD = ""
+    settings.EMAIL_USE_TLS = False
+    settings.EMAIL_USE_SSL = False
+    settings.SHARED_STORE_REDIS_URL = None
+    local_send_guard.clear()
+
+    template = EmailTemplate.objects.create(name="Template", subject="Subject",
+                                            body="<p>Dear {{ subscriber.name }}</p>{{ content|safe }}")
+    newsletter = Newsletter.objects.create(name="Newsletter", short_name="NL", from_email="newsletter@example.com",
+                                           enabled=True, template=template, base_url="https://www.example.com/")
+    message = Message.objects.create(newsletter=newsletter, subject="Subject", message_content="<p>Content</p>")
+    emails = [f"subscriber{i}@example.com" for i in range(7)] + ["refused@example.com"]
+    for email in emails:
+        SubscriptionToNewsletter.objects.create(newsletter=newsletter, email=email, name="Name", surname="Surname",
+                                                ip_address="127.0.0.1", privacy_policy_accepted=True,
+                                                subscription_confirmed=True)
+    run_campaign(message, engine=Campaign.ASYNC)
+
+    # Act
+    sent, failed = async_to_sync(AsyncSender(sessions=3, batch_size=3, poll_interval=0.1).run)(until_idle=True)
+
+    # Assert
+    records = NewsletterDeliveryRecord.objects.filter(message=message)
+    assert (sent, failed) == (7, 1)
+    assert records.filter(status=NewsletterDeliveryRecord.SENT, smtp_code=250).count() == 7
+    assert records.get(status=NewsletterDeliveryRecord.FAILED).smtp_code == 550
+    assert DeadLetter.objects.get().recipient == "refused@example.com"
+    delivered = [recipient for recipients, _ in sink.messages for recipient in recipients if recipient in emails]
+    assert sorted(delivered) == sorted(emails[:7])
+    assert sink.sessions <= 3
+
+
+@pytest.mark.parametrize("claim_timeout", [0.3], ids=["rate-limit-slower-than-claim-timeout"])
+def test_async_sender_renews_its_claims(db, settings, claim_timeout):
+    # Arrange
+    sink = AsyncSmtpSink().start()
+    settings.EMAIL_HOST = "127.0.0.1"
+    settings.EMAIL_PORT = sink.port
+    settings.EMAIL_HOST_USER = ""
+    settings.EMAIL_HOST_PASSWORD = ""
+    settings.EMAIL_USE_TLS = False
+    settings.EMAIL_USE_SSL = False
+    settings.SHARED_STORE_REDIS_URL = None
+    # 6 emails at 5 per second: the last rows are sent long after the claim timeout
+    settings.EMAIL_DEFAULT_RATE_LIMIT = 5
+    settings.EMAIL_DEFAULT_RATE_LIMIT_BURST = 1
+    settings.ASYNC_SENDER_CLAIM_TIMEOUT_SECONDS = claim_timeout
+    local_send_guard.clear()
+
+    template = EmailTemplate.objects.create(name="Template", subject="Subject", body="{{ content|safe }}")
+    newsletter = Newsletter.objects.create(name="Newsletter", short_name="NL", from_email="newsletter@example.com",
+                                           enabled=True, template=template, base_url="https://www.example.com/")
+    message = Message.objects.create(newsletter=newsletter, subject="Subject", message_content="<p>Content</p>")
+    emails = [f"subscriber{i}@example.com" for i in range(6)]
+    for email in emails:
+        SubscriptionToNewsletter.objects.create(newsletter=newsletter, email=email, name="Name", surname="Surname",
+                                                ip_address="127.0.0.1", privacy_policy_accepted=True,
+                                                subscription_confirmed=True)
+    run_campaign(message, engine=Campaign.ASYNC)
+
+    async def run_senders():
+        # the second sender starts when the claims of the first one would be stale, and releases the stale claims
+        async def run_later(sender):
+            await asyncio.sleep(claim_timeout * 2)
+            return await sender.run(until_idle=True)
+
+        return await asyncio.gather(AsyncSender(sessions=2, batch_size=6, poll_interval=0.05).run(until_idle=True),
+                                    run_later(AsyncSender(sessions=2, batch_size=6, poll_interval=0.05)))
+
+    # Act
+    first, second = async_to_sync(run_senders)()
+
+    # Assert
+    # the rows held by the running sender are not released and sent again
+    delivered = [recipient for recipients, _ in sink.messages for recipient in recipients if recipient in emails]
+    assert sorted(delivered) == sorted(emails)
+    assert (first, second) == ((6, 0), (0, 0))
+    records = NewsletterDeliveryRecord.objects.filter(message=message)
+    assert all(record.status == NewsletterDeliveryRecord.SENT and record.attempts == 1 for record in records)
+
+
+@pytest.mark.parametrize("disconnect_at, status, sent_by_relays, reservation", [
+    ("MAIL", NewsletterDeliveryRecord.SENT, (0, 1), ALREADY_SENT),
+    ("DATA", NewsletterDeliveryRecord.FAILED, (1, 0), IN_PROGRESS),
+], ids=["before-data-fails-over", "after-data-not-sent-again"])
+def test_async_sender_failover(settings, monkeypatch, disconnect_at, status, sent_by_relays, reservation):
+    # Arrange
+    settings.SHARED_STORE_REDIS_URL = None
+    local_send_guard.clear()
+    monkeypatch.setattr(logic_async_sender, "order_relays", lambda relays: [relay[0] for relay in relays])
+    monkeypatch.setattr(logic_async_sender, "relay_health", RelayHealth())
+    failing = AsyncSmtpSink(disconnect_at=disconnect_at).start()
+    working = AsyncSmtpSink().start()
+    job = {
+        'record_id': 1, 'message_id': 1, 'subscriber_id': 1, 'recipient': "subscriber@example.com", 'attempts': 1,
+        'event_title': "newsletter NL", 'relays': [[1, 1], [2, 1]],
+        'relay_settings': {1: ({'host': "127.0.0.1", 'port': failing.port}, None),
+                           2: ({'host': "127.0.0.1", 'port': working.port}, None)},
+        'from_email': "newsletter@example.com", 'recipients': ["subscriber@example.com"],
+        'message_bytes': b"Subject: Subject\r\n\r\nContent\r\n",
+    }
+
+    async def send_job():
+        clients = {}
+        try:
+            return await AsyncSender(sessions=1).send_job(job, clients)
+        finally:
+            for client in clients.values():
+                await client.quit()
+
+    # Act
+    outcome = async_to_sync(send_job)()
+
+    # Assert
+    # after DATA the relay may have accepted the message: it is not sent through the other relay, and its
+    # reservation is kept, so that a retry waits for it to expire
+    assert outcome['status'] == status
+    assert (len(failing.messages), len(working.messages)) == sent_by_relays
+    assert reserve_send(get_newsletter_send_key(1, 1))[0] == reservation
+
+
+def test_claim_async_deliveries(db):
+    # Arrange
+    newsletter = Newsletter.objects.create(name="Newsletter", short_name="NL", from_email="newsletter@example.com")
+    message = Message.objects.create(newsletter=newsletter, subject="Subject", message_content="<p>Content</p>")
+    subscribers = [SubscriptionToNewsletter.objects.create(newsletter=newsletter, email=f"subscriber{i}@example.com",
+                                                           name="Name", surname="Surname", ip_address="127.0.0.1",
+                                                           privacy_policy_accepted=True, subscription_confirmed=True)
+                   for i in range(5)]
+    Campaign.objects.create(message=message, engine=Campaign.ASYNC)
+    register_message_deliveries(message.id, [subscriber.id for subscriber in subscribers])
+
+    # Act
+    with CaptureQueriesContext(connection) as queries:
+        first = claim_async_deliveries("sender-1", 3)
+    second = claim_async_deliveries("sender-2", 3)
+
+    # Assert
+    # the rows are locked only on the backends that can skip the locked ones (e.g. MySQL 8, PostgreSQL);
+    # on the others (e.g. SQLite in the tests) the conditional update alone prevents the double claims
+    locking = any("SKIP LOCKED" in query['sql'] for query in queries.captured_queries)
+    assert locking == connection.features.has_select_for_update_skip_locked
+    assert len(first) == 3 and len(second) == 2
+    assert not {record.id for record in first} & {record.id for record in second}
+    assert all(record.status == NewsletterDeliveryRecord.SENDING and record.attempts == 1
+               for record in first + second)
+    assert claim_async_deliveries("sender-3", 3) == []
@@ -0,0 +1,83 @@
+import pytest
+
+from core.business_logic import get_subscribers_pending_delivery, register_message_deliveries, \
+    record_delivery_outcomes
+from core.models import Newsletter, SubscriptionToNewsletter, Message, NewsletterDeliveryRecord
+
+
+def create_subscription(newsletter, email, subscribed=True, subscription_confirmed=True):
+    return SubscriptionToNewsletter.objects.create(newsletter=newsletter, email=email, name="Name", surname="Surname",
+                                                   ip_address="127.0.0.1", privacy_policy_accepted=True,
+                                                   subscribed=subscribed,
+                                                   subscription_confirmed=subscription_confirmed)
+
+
+# get_subscribers_pending_delivery Tests
+@pytest.mark.parametrize("subscribed, subscription_confirmed, already_delivered, expected_pending", [
+    (True, True, False, True),
+    (True, True, True, False),
+    (False, True, False, False),
+    (True, False, False, False),
+], ids=["happy-path-pending", "already-delivered", "unsubscribed", "not-confirmed"])
+def test_get_subscribers_pending_delivery(db, subscribed, subscription_confirmed, already_delivered,
+                                          expected_pending):
+    # Arrange
+    newsletter = Newsletter.objects.create(name="Newsletter", short_name="NL", from_email="newsletter@example.com")
+    message = Message.objects.create(newsletter=newsletter, subject="Subject", message_content="<p>Content</p>")
+    subscription = create_subscription(newsletter, "subscriber@example.com", subscribed, subscription_confirmed)
+    if already_delivered:
+        NewsletterDeliveryRecord.objects.create(message=message, subscriber=subscription)
+
+    # Act
+    pending = list(get_subscribers_pending_delivery(message))
+
+    # Assert
+    assert (subscription in pending) == expected_pending
+
+
+def test_get_subscribers_pending_delivery_deduplicates_emails(db, django_assert_num_queries):
+    # Arrange
+    newsletter = Newsletter.objects.create(name="Newsletter", short_name="NL", from_email="newsletter@example.com")
+    other_newsletter = Newsletter.objects.create(name="Other", short_name="OT", from_email="other@example.com")
+    message = Message.objects.create(newsletter=newsletter, subject="Subject", message_content="<p>Content</p>")
+    first = create_subscription(newsletter, "twice@example.com")
+    create_subscription(newsletter, "twice@example.com")
+    delivered = create_subscription(newsletter, "delivered@example.com")
+    create_subscription(newsletter, "delivered@example.com")
+    create_subscription(other_newsletter, "other@example.com")
+    NewsletterDeliveryRecord.objects.create(message=message, subscriber=delivered)
+
+    # Act
+    with django_assert_num_queries(1):
+        pending = list(get_subscribers_pending_delivery(message))
+
+    # Assert
+    assert pending == [first]
+
+
+# record_delivery_outcomes Tests
+@pytest.mark.parametrize("status, smtp_code, smtp_response", [
+    (NewsletterDeliveryRecord.SENT, 250, "2.0.0 Ok: queued as 4BC3F2"),
+    (NewsletterDeliveryRecord.FAILED, 550, "5.1.1 User unknown"),
+], ids=["sent", "failed"])
+def test_record_delivery_outcomes_updates_queued_record(db, django_assert_num_queries, status, smtp_code,
+                                                         smtp_response):
+    # Arrange
+    newsletter = Newsletter.objects.create(name="Newsletter", short_name="NL", from_email="newsletter@example.com")
+    message = Message.objects.create(newsletter=newsletter, subject="Subject", message_content="<p>Content</p>")
+    subscriptions = [create_subscription(newsletter, f"subscriber{i}@example.com") for i in range(3)]
+    register_message_deliveries(message.id, [subscription.id for subscription in subscriptions])
+
+    # Act
+    with django_assert_num_queries(1):
+        record_delivery_outcomes(message.id, [
+            {'subscriber_id': subscription.id, 'status': status, 'smtp_code': smtp_code, 'smtp_response': smtp_response}
+            for subscription in subscriptions
+        ])
+
+    # Assert
+    records = NewsletterDeliveryRecord.objects.filter(message=message)
+    assert records.count() == 3
+    assert all(record.status == status and record.smtp_code == smtp_code and record.smtp_response == smtp_response
+               for record in records)
+    assert all((record.sent_at is not None) == (status == NewsletterDeliveryRecord.SENT) for record in records)
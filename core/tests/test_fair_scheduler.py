@@ -0,0 +1,50 @@
+import pytest
+
+from core.business_logic import register_message_deliveries
+from core.fair_scheduler import allocate_fair_shares
+from core.logic_async_sender import plan_fair_claim
+from core.models import Newsletter, Message, SubscriptionToNewsletter, Campaign
+
+
+# allocate_fair_shares Tests
+@pytest.mark.parametrize("demands, weights, capacity, expected_allocation", [
+    ({1: 100000, 2: 2000}, {}, 500, {1: 250, 2: 250}),
+    ({1: 100000, 2: 2000}, {1: 3}, 500, {1: 375, 2: 125}),
+    ({1: 100000, 2: 40}, {}, 500, {1: 460, 2: 40}),
+    ({1: 100, 2: 50}, {}, 500, {1: 100, 2: 50}),
+    ({1: 100, 2: 0}, {}, 500, {1: 100, 2: 0}),
+    ({1: 10, 2: 10, 3: 10}, {}, 2, {1: 1, 2: 1, 3: 0}),
+], ids=["equal-shares", "weighted-shares", "unused-share-redistributed", "capacity-exceeds-demand",
+        "idle-campaign", "capacity-smaller-than-campaigns"])
+def test_allocate_fair_shares(demands, weights, capacity, expected_allocation):
+    # Act
+    allocation = allocate_fair_shares(demands, weights, capacity)
+
+    # Assert
+    assert allocation == expected_allocation
+
+
+# plan_fair_claim Tests
+@pytest.mark.parametrize("short_names", [
+    ("NL1", "NL2"),
+    ("NL", "NL"),
+], ids=["different-short-names", "same-short-name"])
+def test_plan_fair_claim(db, short_names):
+    # Arrange
+    message_ids = []
+    for index, (short_name, sending_share) in enumerate(zip(short_names, (3, 1))):
+        newsletter = Newsletter.objects.create(name=f"Newsletter {index}", short_name=short_name,
+                                               from_email="newsletter@example.com", sending_share=sending_share)
+        message = Message.objects.create(newsletter=newsletter, subject="Subject", message_content="<p>Content</p>")
+        subscriber_ids = [SubscriptionToNewsletter.objects.create(
+            newsletter=newsletter, email=f"subscriber{i}@example.com", name="Name", surname="Surname",
+            ip_address="127.0.0.1", privacy_policy_accepted=True, subscription_confirmed=True).id for i in range(10)]
+        Campaign.objects.create(message=message, engine=Campaign.ASYNC)
+        register_message_deliveries(message.id, subscriber_ids)
+        message_ids.append(message.id)
+
+    # Act
+    result = plan_fair_claim(8)
+
+    # Assert
+    assert [result[message_id] for message_id in message_ids] == [6, 2]
@@ -0,0 +1,74 @@
+import pytest
+
+from core.flow_control import EnqueueFlowControl
+
+
+class FakeQueue:
+    """Queue of the broker drained by the workers at a fixed rate, on a fake clock."""
+
+    def __init__(self, completion_rate):
+        self.completion_rate = completion_rate
+        self.now = 0.0
+        self.length = 0
+        self.measurements = 0
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+        self.length = max(self.length - int(self.completion_rate * seconds), 0)
+
+    def queue_length(self, queue):
+        self.measurements += 1
+        return self.length
+
+
+# EnqueueFlowControl Tests
+@pytest.mark.parametrize("tasks, completion_rate, expected_max_length, expected_throttled", [
+    (50, 100, 50, False),
+    (500, 100, 100, True),
+], ids=["queue-never-full", "producer-throttled"])
+def test_enqueue_flow_control(tasks, completion_rate, expected_max_length, expected_throttled):
+    # Arrange
+    fake_queue = FakeQueue(completion_rate)
+    flow_control = EnqueueFlowControl("core.tasks.send_newsletter_email_task", max_queued=100, poll_interval=0.1,
+                                      report_interval=1000, queue_length=fake_queue.queue_length,
+                                      clock=fake_queue.clock, sleep=fake_queue.sleep)
+    max_length = 0
+
+    # Act
+    for _ in range(tasks):
+        fake_queue.length += 1
+        max_length = max(max_length, fake_queue.length)
+        flow_control.enqueued()
+
+    # Assert
+    assert max_length == expected_max_length
+    assert (flow_control.waited > 0) == expected_throttled
+    assert fake_queue.measurements < tasks
+    if expected_throttled:
+        assert flow_control.completion_rate == pytest.approx(completion_rate, rel=0.2)
+
+
+@pytest.mark.parametrize("lease_kept, expected_stopped", [
+    (True, False),
+    (False, True),
+], ids=["lease-renewed-while-waiting", "lease-lost-while-waiting"])
+def test_enqueue_flow_control_heartbeat(lease_kept, expected_stopped):
+    # Arrange
+    fake_queue = FakeQueue(completion_rate=10)
+    heartbeats = []
+    flow_control = EnqueueFlowControl("core.tasks.send_newsletter_email_task", max_queued=100, poll_interval=1,
+                                      report_interval=2, heartbeat=lambda: heartbeats.append(1) or lease_kept,
+                                      queue_length=fake_queue.queue_length, clock=fake_queue.clock,
+                                      sleep=fake_queue.sleep)
+    fake_queue.length = 100
+
+    # Act
+    flow_control.enqueued(100, tasks=100)
+
+    # Assert
+    assert heartbeats
+    assert flow_control.stopped == expected_stopped
+    assert (fake_queue.length <= 50) != expected_stopped
@@ -0,0 +1,46 @@
+import pytest
+
+from core.html_utils import make_urls_absolute, rewrite_urls, rewritten_html_cache
+
+
+# make_urls_absolute Tests
+@pytest.mark.parametrize("html_content, set_a_target, expected", [
+    ('<p><a href="/home">Home</a></p><p><img alt="" src="/media/image.jpg" /></p>', None,
+     '<p><a href="https://www.example.com/home">Home</a></p>'
+     '<p><img alt="" src="https://www.example.com/media/image.jpg" /></p>'),
+    ('<a href="https://other.com/page">Other</a><img src="image.jpg">', None,
+     '<a href="https://other.com/page">Other</a><img src="image.jpg">'),
+    ('<a href="/home">Home</a><a class="b" href="#top" target="_self">Top</a><br/>', "_blank",
+     '<a href="https://www.example.com/home" target="_blank">Home</a>'
+     '<a class="b" href="#top" target="_blank">Top</a><br/>'),
+    ("<A HREF='/x?a=1&amp;b=2'>x</A><img src=/a.png>", None,
+     "<A HREF='https://www.example.com/x?a=1&amp;b=2'>x</A><img src=\"https://www.example.com/a.png\">"),
+    ('<!-- <a href="/comment"> --><script>var s = "<img src=\'/script.png\'>";</script>', None,
+     '<!-- <a href="/comment"> --><script>var s = "<img src=\'/script.png\'>";</script>'),
+    ('<div title="<a href=/attribute>"><abbr href="/abbr">x</abbr></div>', None,
+     '<div title="<a href=/attribute>"><abbr href="/abbr">x</abbr></div>'),
+], ids=["happy-path-href-and-src", "absolute-and-relative-urls-unchanged", "set-a-target", "case-and-quoting",
+        "comment-and-script-unchanged", "other-tags-unchanged"])
+def test_make_urls_absolute(html_content, set_a_target, expected):
+    # Act
+    updated_html = make_urls_absolute(html_content, "https://www.example.com/", set_a_target=set_a_target)
+
+    # Assert
+    assert updated_html == expected
+    assert rewrite_urls(html_content, "https://www.example.com", set_a_target=set_a_target) == expected
+
+
+@pytest.mark.parametrize("cache, expected_cached", [
+    (True, 1),
+    (False, 0),
+], ids=["happy-path-cached", "per-recipient-content-not-cached"])
+def test_make_urls_absolute_cache(cache, expected_cached):
+    # Arrange
+    rewritten_html_cache.clear()
+
+    # Act
+    updated_html = make_urls_absolute('<a href="/home">Home</a>', "https://www.example.com/", cache=cache)
+
+    # Assert
+    assert updated_html == '<a href="https://www.example.com/home">Home</a>'
+    assert len(rewritten_html_cache._documents) == expected_cached
@@ -0,0 +1,265 @@
+from datetime import timedelta
+
+import pytest
+from django.core.management import call_command
+from django.utils import timezone
+
+from core.logic_campaign import start_or_resume_campaign, iter_audience, advance_campaign, claim_campaign_shard, \
+    run_campaign, find_due_messages, claim_message_for_dispatch, dispatch_scheduled_messages, split_campaign_shards
+from core.models import EmailTemplate, Newsletter, SubscriptionToNewsletter, Message, Campaign, CampaignShard, \
+    NewsletterDeliveryRecord
+
+
+def create_subscription(newsletter, email):
+    return SubscriptionToNewsletter.objects.create(newsletter=newsletter, email=email, name="Name", surname="Surname",
+                                                   ip_address="127.0.0.1", privacy_policy_accepted=True,
+                                                   subscription_confirmed=True)
+
+
+# iter_audience Tests
+@pytest.mark.parametrize("chunk_size, processed, expected_chunk_lengths", [
+    (2, 0, [2, 2, 1]),
+    (10, 0, [5]),
+    (2, 3, [2]),
+], ids=["happy-path-chunks", "single-chunk", "resumed-from-cursor"])
+def test_iter_audience(db, chunk_size, processed, expected_chunk_lengths):
+    # Arrange
+    newsletter = Newsletter.objects.create(name="Newsletter", short_name="NL", from_email="newsletter@example.com")
+    message = Message.objects.create(newsletter=newsletter, subject="Subject", message_content="<p>Content</p>")
+    subscriptions = [create_subscription(newsletter, f"subscriber{i}@example.com") for i in range(5)]
+    campaign = start_or_resume_campaign(message)
+    if processed:
+        advance_campaign(campaign, subscriptions[processed - 1].id, processed)
+    # not part of the audience snapshot
+    create_subscription(newsletter, "late@example.com")
+
+    # Act
+    chunks = list(iter_audience(Campaign.objects.get(id=campaign.id), chunk_size=chunk_size, ids_only=True))
+
+    # Assert
+    assert [len(chunk) for chunk in chunks] == expected_chunk_lengths
+    assert sum(chunks, []) == [s.id for s in subscriptions[processed:]]
+
+
+# campaign shard lease Tests
+@pytest.mark.parametrize("lease_expired, expected_second_shard_index", [
+    (False, 1),
+    (True, 0),
+], ids=["concurrent-runs-split-shards", "expired-lease-taken-over"])
+def test_claim_campaign_shard(db, settings, lease_expired, expected_second_shard_index):
+    # Arrange
+    newsletter = Newsletter.objects.create(name="Newsletter", short_name="NL", from_email="newsletter@example.com")
+    message = Message.objects.create(newsletter=newsletter, subject="Subject", message_content="<p>Content</p>")
+    subscriptions = [create_subscription(newsletter, f"subscriber{i}@example.com") for i in range(5)]
+    # two shards: up to the third subscriber, and the last two
+    settings.CAMPAIGN_SHARD_SIZE = subscriptions[2].id
+    campaign = start_or_resume_campaign(message)
+    first_shard = claim_campaign_shard(campaign, "run-1")
+    if lease_expired:
+        CampaignShard.objects.filter(id=first_shard.id).update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+
+    # Act
+    second_shard = claim_campaign_shard(start_or_resume_campaign(message), "run-2")
+
+    # Assert
+    assert campaign.shards.count() == 2
+    assert first_shard.index == 0
+    assert second_shard.index == expected_second_shard_index
+    # the first run stops when it loses its lease
+    assert advance_campaign(campaign, subscriptions[0].id, 1, first_shard) != lease_expired
+
+
+# split_campaign_shards Tests
+@pytest.mark.parametrize("min_shards, expected_running_shards", [
+    (2, 2),
+    (4, 4),
+    (20, None),
+], ids=["enough-shards", "unleased-shard-split", "capped-by-the-audience"])
+def test_split_campaign_shards(db, settings, min_shards, expected_running_shards):
+    # Arrange
+    newsletter = Newsletter.objects.create(name="Newsletter", short_name="NL", from_email="newsletter@example.com")
+    message = Message.objects.create(newsletter=newsletter, subject="Subject", message_content="<p>Content</p>")
+    subscriptions = [create_subscription(newsletter, f"subscriber{i}@example.com") for i in range(8)]
+    # two shards: up to the fourth subscriber, and the last four
+    settings.CAMPAIGN_SHARD_SIZE = subscriptions[3].id
+    campaign = start_or_resume_campaign(message)
+    leased_shard = claim_campaign_shard(campaign, "run-1")
+
+    # Act
+    campaign = start_or_resume_campaign(message, min_shards=min_shards)
+    running_shards = split_campaign_shards(campaign, min_shards)
+
+    # Assert
+    shards = list(campaign.shards.order_by('start_subscriber_id'))
+    assert running_shards == len(shards)
+    if expected_running_shards:
+        assert len(shards) == expected_running_shards
+    else:
+        # the shards that are not leased cannot be split any further
+        assert all(shard.end_subscriber_id - shard.last_subscriber_id < 2 for shard in shards[1:])
+    # the leased shard is not changed, and the shards still cover the audience once
+    assert (shards[0].id, shards[0].end_subscriber_id) == (leased_shard.id, leased_shard.end_subscriber_id)
+    assert all(shard.end_subscriber_id == next_shard.start_subscriber_id for shard, next_shard in zip(shards, shards[1:]))
+    assert shards[-1].end_subscriber_id == campaign.audience_max_subscriber_id
+    assert sorted(shard.index for shard in shards) == list(range(len(shards)))
+
+
+# run_campaign partition Tests
+@pytest.mark.parametrize("nosave, expected_shards", [
+    (False, 3),
+    (True, 0),
+], ids=["leased-shards", "unsaved-campaign-id-ranges"])
+def test_run_campaign_partition(db, settings, nosave, expected_shards):
+    # Arrange
+    template = EmailTemplate.objects.create(name="Template", subject="Subject", body="{{ content|safe }}")
+    newsletter = Newsletter.objects.create(name="Newsletter", short_name="NL", from_email="newsletter@example.com",
+                                           enabled=True, template=template)
+    message = Message.objects.create(newsletter=newsletter, subject="Subject", message_content="<p>Content</p>")
+    subscriptions = [create_subscription(newsletter, f"subscriber{i}@example.com") for i in range(7)]
+
+    # Act
+    counters = [run_campaign(message, nosave=nosave, oksend=False, partition=(slot, 3)) for slot in range(3)]
+
+    # Assert
+    # each slot processes its own part of the audience, and together they process all of it once
+    assert sum(counters) == len(subscriptions) and all(counters)
+    assert CampaignShard.objects.count() == expected_shards
+    if not nosave:
+        assert NewsletterDeliveryRecord.objects.filter(message=message).count() == len(subscriptions)
+        assert Campaign.objects.get(message=message).status == Campaign.COMPLETED
+
+
+
+
+@pytest.mark.parametrize("number, expected_processed", [
+    (None, True),
+    (3, False),
+], ids=["happy-path-completed", "not-completed-stays-due"])
+def test_run_campaign_marks_message_processed(db, number, expected_processed):
+    # Arrange
+    template = EmailTemplate.objects.create(name="Template", subject="Subject", body="{{ content|safe }}")
+    newsletter = Newsletter.objects.create(name="Newsletter", short_name="NL", from_email="newsletter@example.com",
+                                           enabled=True, template=template)
+    message = Message.objects.create(newsletter=newsletter, subject="Subject", message_content="<p>Content</p>",
+                                     to_be_processed_at=timezone.now() - timedelta(hours=1))
+    for i in range(5):
+        create_subscription(newsletter, f"subscriber{i}@example.com")
+
+    # Act
+    run_campaign(message, number=number, oksend=False)
+
+    # Assert
+    # the dispatcher resumes the campaigns not completed (once they stop making progress)
+    assert Message.objects.get(id=message.id).processed == expected_processed
+    assert Campaign.objects.get(message=message).status == (Campaign.COMPLETED if expected_processed
+                                                            else Campaign.RUNNING)
+
+# requeue of the stale QUEUED deliveries Tests
+@pytest.mark.parametrize("batch_size", [None, 2], ids=["one-by-one", "in-batches"])
+def test_run_campaign_requeues_stale_deliveries(db, settings, monkeypatch, batch_size):
+    # Arrange
+    from core.tasks import send_newsletter_email_task, send_newsletter_batch_task
+    settings.CAMPAIGN_REQUEUE_AFTER_SECONDS = 3600
+    template = EmailTemplate.objects.create(name="Template", subject="Subject", body="{{ content|safe }}")
+    newsletter = Newsletter.objects.create(name="Newsletter", short_name="NL", from_email="newsletter@example.com",
+                                           enabled=True, template=template)
+    message = Message.objects.create(newsletter=newsletter, subject="Subject", message_content="<p>Content</p>")
+    subscriptions = [create_subscription(newsletter, f"subscriber{i}@example.com") for i in range(5)]
+    statuses = [NewsletterDeliveryRecord.QUEUED] * 3 + [NewsletterDeliveryRecord.SENT, NewsletterDeliveryRecord.QUEUED]
+    for subscription, status in zip(subscriptions, statuses):
+        NewsletterDeliveryRecord.objects.create(message=message, subscriber=subscription, status=status)
+    # the tasks of the first four rows have been lost (or never enqueued); the last row has just been queued
+    NewsletterDeliveryRecord.objects.filter(subscriber__in=subscriptions[:4]).update(
+        updated_at=timezone.now() - timedelta(hours=2))
+    enqueued = []
+    monkeypatch.setattr(send_newsletter_email_task, "delay",
+                        lambda message_id, subscriber_id, **kwargs: enqueued.append(subscriber_id))
+    monkeypatch.setattr(send_newsletter_batch_task, "delay",
+                        lambda message_id, subscriber_ids, **kwargs: enqueued.extend(subscriber_ids))
+
+    # Act
+    for _ in range(2):
+        run_campaign(message, batch_size=batch_size)
+
+    # Assert
+    # only the rows still QUEUED after CAMPAIGN_REQUEUE_AFTER_SECONDS, and only once within that time
+    assert enqueued == [subscription.id for subscription in subscriptions[:3]]
+
+# find_due_messages Tests
+@pytest.mark.parametrize("scheduled_in, dispatched_ago, enabled, campaign_updated_ago, expected_due", [
+    (-60, None, True, None, True),
+    (3600, None, True, None, False),
+    (-60, None, False, None, False),
+    (-60, 60, True, None, False),
+    (-3600, 3600, True, None, True),
+    (-3600, 3600, True, 60, False),
+    (-3600, 3600, True, 3600, True),
+], ids=["happy-path-due", "scheduled-in-the-future", "newsletter-disabled", "dispatched-recently",
+        "dispatch-lost", "campaign-progressing", "campaign-stalled"])
+def test_find_due_messages(db, settings, scheduled_in, dispatched_ago, enabled, campaign_updated_ago,
+                           expected_due):
+    # Arrange
+    settings.SCHEDULED_DISPATCH_TIMEOUT_SECONDS = 1800
+    now = timezone.now()
+    newsletter = Newsletter.objects.create(name="Newsletter", short_name="NL", from_email="newsletter@example.com",
+                                           enabled=enabled)
+    message = Message.objects.create(
+        newsletter=newsletter, subject="Subject", message_content="<p>Content</p>",
+        to_be_processed_at=now + timedelta(seconds=scheduled_in),
+        dispatched_at=now - timedelta(seconds=dispatched_ago) if dispatched_ago is not None else None)
+    if campaign_updated_ago is not None:
+        campaign = Campaign.objects.create(message=message)
+        Campaign.objects.filter(id=campaign.id).update(updated_at=now - timedelta(seconds=campaign_updated_ago))
+
+    # Act
+    due = find_due_messages(now)
+
+    # Assert
+    assert (message.id in [message_id for message_id, _ in due]) == expected_due
+
+
+# claim_message_for_dispatch Tests
+@pytest.mark.parametrize("dispatched, expected_claims", [
+    (False, [True, False]),
+    (True, [True, False]),
+], ids=["first-dispatch", "dispatched-again"])
+def test_claim_message_for_dispatch(db, dispatched, expected_claims):
+    # Arrange
+    newsletter = Newsletter.objects.create(name="Newsletter", short_name="NL", from_email="newsletter@example.com",
+                                           enabled=True)
+    dispatched_at = timezone.now() - timedelta(hours=1) if dispatched else None
+    message = Message.objects.create(newsletter=newsletter, subject="Subject", message_content="<p>Content</p>",
+                                     to_be_processed_at=timezone.now(), dispatched_at=dispatched_at)
+
+    # Act
+    # two dispatchers found the message due at the same time
+    claims = [claim_message_for_dispatch(message.id, dispatched_at) for _ in range(2)]
+
+    # Assert
+    assert claims == expected_claims
+
+
+# dispatch_scheduled_messages Tests
+@pytest.mark.parametrize("use_command", [False, True], ids=["function", "DispatchScheduledMessages-command"])
+def test_dispatch_scheduled_messages(db, monkeypatch, use_command):
+    # Arrange
+    from core.tasks import run_campaign_task
+    newsletter = Newsletter.objects.create(name="Newsletter", short_name="NL", from_email="newsletter@example.com",
+                                           enabled=True)
+    due_message = Message.objects.create(newsletter=newsletter, subject="Due", message_content="<p>Content</p>",
+                                         to_be_processed_at=timezone.now() - timedelta(minutes=1))
+    Message.objects.create(newsletter=newsletter, subject="Later", message_content="<p>Content</p>",
+                           to_be_processed_at=timezone.now() + timedelta(hours=1))
+    started = []
+    monkeypatch.setattr(run_campaign_task, "delay", lambda message_id, **kwargs: started.append(message_id))
+
+    # Act
+    for _ in range(2):
+        if use_command:
+            call_command("DispatchScheduledMessages")
+        else:
+            dispatch_scheduled_messages(run_campaign_task.delay)
+
+    # Assert
+    assert started == [due_message.id]
+    assert Message.objects.get(id=due_message.id).dispatched_at is not None
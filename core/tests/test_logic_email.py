@@ -0,0 +1,234 @@
+import smtplib
+
+import pytest
+
+from core.logic_email import classify_smtp_error, get_retry_countdown, TRANSIENT, THROTTLED, PERMANENT, \
+    email_connection_pool, EmailConnectionPool, DeliveryUncertainError, split_envelope_batches
+from core.models import Visitor, EventLog
+from core.tasks import send_visitor_emails_task
+from core.tests.test_async_sender import AsyncSmtpSink
+
+
+# classify_smtp_error Tests
+@pytest.mark.parametrize("exc, expected", [
+    (smtplib.SMTPDataError(451, b"Temporary local problem"), (TRANSIENT, 451)),
+    (smtplib.SMTPDataError(421, b"Service not available"), (THROTTLED, 421)),
+    (smtplib.SMTPSenderRefused(450, b"Too many messages, slow down", "from@example.com"), (THROTTLED, 450)),
+    (smtplib.SMTPDataError(450, b"4.7.1 Rate limit exceeded"), (THROTTLED, 450)),
+    (smtplib.SMTPDataError(451, b"Temporary failure to generate a separate copy, try again later"), (TRANSIENT, 451)),
+    (smtplib.SMTPDataError(554, b"Message rejected"), (PERMANENT, 554)),
+    (smtplib.SMTPRecipientsRefused({"to@example.com": (550, b"User unknown")}), (PERMANENT, 550)),
+    (smtplib.SMTPRecipientsRefused({"to@example.com": (452, b"Mailbox full")}), (TRANSIENT, 452)),
+    (smtplib.SMTPServerDisconnected("Connection unexpectedly closed"), (TRANSIENT, None)),
+    (ConnectionResetError(104, "Connection reset by peer"), (TRANSIENT, None)),
+    (ValueError("Invalid address"), (PERMANENT, None)),
+], ids=["4xx", "421", "4xx-too-many", "4xx-rate-limit", "4xx-try-again-later", "5xx", "recipient-refused-5xx", "recipient-refused-4xx",
+        "disconnected", "connection-reset", "not-smtp"])
+def test_classify_smtp_error(exc, expected):
+    # Act
+    result = classify_smtp_error(exc)
+
+    # Assert
+    assert result == expected
+
+
+@pytest.mark.parametrize("retries, error_class, minimum, maximum", [
+    (0, TRANSIENT, 0, 2),
+    (3, TRANSIENT, 0, 16),
+    (20, TRANSIENT, 0, 600),
+    (1, THROTTLED, 0, 60),
+], ids=["first-retry", "exponential", "capped", "throttled"])
+def test_get_retry_countdown(settings, retries, error_class, minimum, maximum):
+    # Arrange
+    settings.EMAIL_RETRY_BASE_SECONDS = 2
+    settings.EMAIL_RETRY_THROTTLED_BASE_SECONDS = 30
+    settings.EMAIL_RETRY_MAX_SECONDS = 600
+
+    # Act
+    countdowns = [get_retry_countdown(retries, error_class) for _ in range(50)]
+
+    # Assert
+    assert all(minimum <= countdown <= maximum for countdown in countdowns)
+    # the failures of a burst are not retried together
+    assert len(set(countdowns)) > 1
+
+
+class FakeSMTP:
+    """SMTP session of FakeBackend: drops the session at the commands listed in disconnect_at."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.data_commands = 0
+
+    def noop(self):
+        if not self.backend.alive:
+            raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+        return 250, b"OK"
+
+    def sendmail(self, message):
+        command = self.backend.disconnect_at.pop(0) if self.backend.disconnect_at else None
+        if command == "MAIL":
+            raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+        self.data_commands += 1
+        if command == "DATA":
+            raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+        self.backend.sent.append(message)
+
+
+class FakeBackend:
+    def __init__(self, disconnect_at=None, alive=True):
+        self.connection = None
+        self.opened = 0
+        self.sent = []
+        self.disconnect_at = list(disconnect_at or [])
+        self.alive = alive
+
+    def open(self):
+        self.connection = FakeSMTP(self)
+        self.opened += 1
+
+    def close(self):
+        self.connection = None
+
+    def send_messages(self, email_messages):
+        for message in email_messages:
+            self.connection.sendmail(message)
+        return len(email_messages)
+
+
+def create_fake_pool(monkeypatch, backend):
+    pool = EmailConnectionPool()
+    monkeypatch.setattr(pool, "_create_backend", lambda email_settings_id: backend)
+    return pool
+
+
+# EmailConnectionPool Tests
+def test_email_connection_pool_recycles_connection(settings, monkeypatch):
+    # Arrange
+    settings.EMAIL_POOL_MAX_MESSAGES_PER_CONNECTION = 2
+    backend = FakeBackend()
+    pool = create_fake_pool(monkeypatch, backend)
+
+    # Act
+    for message in range(5):
+        pool.send_messages([message], throttle=False)
+
+    # Assert
+    assert backend.sent == [0, 1, 2, 3, 4]
+    assert backend.opened == 3
+
+
+@pytest.mark.parametrize("alive, expected_opened", [
+    (True, 1),
+    (False, 2),
+], ids=["session-alive", "session-closed-by-relay"])
+def test_email_connection_pool_noop_health_check(settings, monkeypatch, alive, expected_opened):
+    # Arrange
+    settings.EMAIL_POOL_NOOP_AFTER_SECONDS = -1  # check the session before each use
+    backend = FakeBackend()
+    pool = create_fake_pool(monkeypatch, backend)
+    pool.send_messages(["first"], throttle=False)
+    backend.alive = alive
+
+    # Act
+    pool.send_messages(["second"], throttle=False)
+
+    # Assert
+    assert backend.sent == ["first", "second"]
+    assert backend.opened == expected_opened
+
+
+@pytest.mark.parametrize("disconnect_at, expected_sent, expected_opened, raises", [
+    (["MAIL"], ["first", "second"], 2, None),
+    (["MAIL", "MAIL"], [], 2, smtplib.SMTPServerDisconnected),
+    ([None, "DATA"], ["first"], 1, DeliveryUncertainError),
+    ([None, "MAIL"], ["first"], 1, DeliveryUncertainError),
+], ids=["before-first-message", "twice", "during-data", "after-first-message"])
+def test_email_connection_pool_disconnect_retry(monkeypatch, disconnect_at, expected_sent, expected_opened, raises):
+    # Arrange
+    backend = FakeBackend(disconnect_at)
+    pool = create_fake_pool(monkeypatch, backend)
+
+    # Act
+    if raises:
+        with pytest.raises(raises) as error:
+            pool.send_messages(["first", "second"], throttle=False)
+        assert type(error.value) is raises
+    else:
+        pool.send_messages(["first", "second"], throttle=False)
+
+    # Assert
+    # a message that may have been accepted by the relay is never sent again
+    assert backend.sent == expected_sent
+    assert backend.opened == expected_opened
+
+
+@pytest.mark.parametrize("disconnect_at, expected_results, raises", [
+    ([None, "DATA"], [None, DeliveryUncertainError], DeliveryUncertainError),
+    ([None, "MAIL"], [None], smtplib.SMTPServerDisconnected),
+], ids=["during-data", "before-data"])
+def test_email_connection_pool_disconnect_with_results(monkeypatch, disconnect_at, expected_results, raises):
+    # Arrange
+    backend = FakeBackend(disconnect_at)
+    pool = create_fake_pool(monkeypatch, backend)
+    results = []
+
+    # Act
+    with pytest.raises(raises) as error:
+        pool.send_messages(["first", "second", "third"], throttle=False, results=results)
+
+    # Assert
+    # only the message in flight during DATA is uncertain: the messages without a result have not been transmitted
+    assert type(error.value) is raises
+    assert [result if result is None else type(result) for result in results] == expected_results
+    assert backend.sent == ["first"]
+
+
+
+# split_envelope_batches Tests
+@pytest.mark.parametrize("recipients, reserved, expected_batches", [
+    (7, 0, [3, 3, 1]),
+    (7, 2, [1, 3, 3]),
+    (2, 5, [1, 1]),
+    (0, 2, []),
+], ids=["happy-path", "first-batch-with-bcc", "more-bcc-than-max-recipients", "no-recipients"])
+def test_split_envelope_batches(recipients, reserved, expected_batches):
+    # Act
+    batches = split_envelope_batches(range(recipients), max_recipients=3, reserved=reserved)
+
+    # Assert
+    # the BCC recipients added to the first envelope count in its RCPT commands
+    assert [len(batch) for batch in batches] == expected_batches
+    assert sum(batches, []) == list(range(recipients))
+
+def test_send_visitor_emails_with_one_envelope(db, settings):
+    # Arrange
+    sink = AsyncSmtpSink().start()
+    settings.EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
+    settings.EMAIL_HOST = "127.0.0.1"
+    settings.EMAIL_PORT = sink.port
+    settings.EMAIL_HOST_USER = ""
+    settings.EMAIL_HOST_PASSWORD = ""
+    settings.EMAIL_USE_TLS = False
+    settings.EMAIL_USE_SSL = False
+    email_connection_pool.close_all()
+
+    emails = ["visitor1@example.com", "refused@example.com", "visitor2@example.com"]
+    visitors = [Visitor.objects.create(company_name="Company", last_name="Last", first_name="First",
+                                       job_position="Position", email_address=email) for email in emails]
+
+    # Act
+    sent = send_visitor_emails_task.apply(args=("sender@example.com", [visitor.id for visitor in visitors],
+                                                "Subject", "<p>Content</p>"), kwargs={"template": "T"}).get()
+    email_connection_pool.close_all()
+
+    # Assert
+    assert sent == 2
+    assert len(sink.messages) == 1
+    recipients, data = sink.messages[0]
+    assert recipients == ["visitor1@example.com", "visitor2@example.com"]
+    assert b"To: undisclosed-recipients:;" in data and b"visitor1@example.com" not in data
+    assert set(Visitor.objects.filter(email_sent=True).values_list("email_address", flat=True)) == \
+           {"visitor1@example.com", "visitor2@example.com"}
+    assert EventLog.objects.get(event_type="EMAIL_FAILED").event_target == "refused@example.com"
+    assert EventLog.objects.filter(event_type="EMAIL_SENT").count() == 2
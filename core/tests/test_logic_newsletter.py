@@ -0,0 +1,141 @@
+import pytest
+
+from core import logic_newsletter
+from core.logic_email import email_connection_pool
+from core.logic_newsletter import NewsletterSkeleton, NewsletterSkeletonCache, render_newsletter_email, \
+    get_message_for_sending, send_newsletter_batch
+from core.models import EmailTemplate, Newsletter, SubscriptionToNewsletter, Message, NewsletterDeliveryRecord, \
+    DeadLetter
+from core.send_guard import local_send_guard, get_newsletter_send_key
+from core.tasks import send_newsletter_batch_task
+from core.tests.test_async_sender import AsyncSmtpSink
+
+
+def create_message(template_body):
+    template = EmailTemplate.objects.create(name="Template", subject="Subject", body=template_body)
+    newsletter = Newsletter.objects.create(name="Newsletter", short_name="NL", from_email="newsletter@example.com",
+                                           enabled=True, template=template, base_url="https://www.example.com/")
+    return Message.objects.create(newsletter=newsletter, subject="Subject",
+                                  message_content='<p><a href="/home">Home</a></p>')
+
+
+# NewsletterSkeleton Tests
+@pytest.mark.parametrize("template_body, expected_static", [
+    ('<p>Dear {{ subscriber.name }} {{ subscriber.surname }}</p>{{ content|safe }}'
+     '<a href="{{ unsubscribe_link }}">unsubscribe</a><img src="/media/{{ message.id }}/{{ rnd_str }}/image.jpg">',
+     True),
+    ('<p>{% if subscriber.honorific %}Dear {{ subscriber.honorific }}{% endif %}</p>', False),
+    ('<p>Dear {{ subscriber.name|upper }}</p>', False),
+], ids=["happy-path-slots", "tag-uses-subscriber", "filter-on-subscriber"])
+def test_newsletter_skeleton_render(db, monkeypatch, template_body, expected_static):
+    # Arrange
+    monkeypatch.setattr(logic_newsletter, "get_rnd_str", lambda: "abcd1234")
+    message = create_message(template_body)
+    subscriber = SubscriptionToNewsletter.objects.create(newsletter=message.newsletter, email="john@example.com",
+                                                         name="John <Johnny>", surname="Doe", honorific="Mr",
+                                                         ip_address="127.0.0.1", privacy_policy_accepted=True)
+
+    # Act
+    skeleton = NewsletterSkeleton(message)
+    html_content = skeleton.render(subscriber)
+
+    # Assert
+    assert skeleton.is_static == expected_static
+    assert html_content == render_newsletter_email(message, subscriber)
+
+
+# NewsletterSkeletonCache Tests
+@pytest.mark.parametrize("update_template, expected_same_skeleton", [
+    (False, True),
+    (True, False),
+], ids=["cache-hit", "template-updated"])
+def test_newsletter_skeleton_cache(db, update_template, expected_same_skeleton):
+    # Arrange
+    cache = NewsletterSkeletonCache()
+    message = create_message('<p>Dear {{ subscriber.name }}</p>{{ content|safe }}')
+    skeleton = cache.get(get_message_for_sending(message.id))
+    if update_template:
+        template = message.newsletter.template
+        template.body = '<p>Hello {{ subscriber.name }}</p>{{ content|safe }}'
+        template.save()
+
+    # Act
+    result = cache.get(get_message_for_sending(message.id))
+
+    # Assert
+    assert (result is skeleton) == expected_same_skeleton
+
+
+# send_newsletter_batch Tests
+@pytest.mark.parametrize("reservation, expected_result", [
+    (None, {'already_sent': 2, 'in_progress': 0}),
+    ("another-worker", {'already_sent': 1, 'in_progress': 1}),
+], ids=["redelivered-task", "email-in-progress-elsewhere"])
+def test_send_newsletter_batch_redelivered(db, settings, mailoutbox, reservation, expected_result):
+    # Arrange
+    settings.SHARED_STORE_REDIS_URL = None
+    local_send_guard.clear()
+    message = create_message('<p>Dear {{ subscriber.name }}</p>{{ content|safe }}')
+    subscribers = [SubscriptionToNewsletter.objects.create(newsletter=message.newsletter, email=email, name="Name",
+                                                           surname="Surname", ip_address="127.0.0.1",
+                                                           privacy_policy_accepted=True, subscription_confirmed=True)
+                   for email in ["first@example.com", "second@example.com"]]
+    subscriber_ids = [subscriber.id for subscriber in subscribers]
+    if reservation:
+        local_send_guard.reserve(get_newsletter_send_key(message.id, subscriber_ids[1]), reservation, 600)
+    send_newsletter_batch(message.id, subscriber_ids)
+    sent_emails = len(mailoutbox)
+
+    # Act
+    result = send_newsletter_batch(message.id, subscriber_ids)
+
+    # Assert
+    assert len(mailoutbox) == sent_emails
+    assert result['sent'] == {} and result['failed'] == {}
+    assert {key: len(result[key]) for key in expected_result} == expected_result
+
+
+# send_newsletter_batch_task Tests
+@pytest.mark.parametrize("emails, expected_sent, expected_failed, expected_domain_slots", [
+    (["first@example.com", "second@example.com", "third@example.org"],
+     ["first@example.com", "second@example.com", "third@example.org"], [], {"example.com": 2, "example.org": 1}),
+    (["first@example.com", "refused@example.com", "second@example.com"],
+     ["first@example.com", "second@example.com"], ["refused@example.com"], {"example.com": 3}),
+], ids=["happy-path-one-transaction-per-email", "refused-recipient-does-not-stop-the-chunk"])
+def test_send_newsletter_batch_task(db, settings, monkeypatch, emails, expected_sent, expected_failed,
+                                    expected_domain_slots):
+    # Arrange
+    sink = AsyncSmtpSink().start()
+    settings.EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
+    settings.EMAIL_HOST = "127.0.0.1"
+    settings.EMAIL_PORT = sink.port
+    settings.EMAIL_HOST_USER = ""
+    settings.EMAIL_HOST_PASSWORD = ""
+    settings.EMAIL_USE_TLS = False
+    settings.EMAIL_USE_SSL = False
+    settings.SHARED_STORE_REDIS_URL = None
+    local_send_guard.clear()
+    email_connection_pool.close_all()
+    domain_slots = {}
+    monkeypatch.setattr(logic_newsletter, "acquire_domain_slot",
+                        lambda domain, messages=1: domain_slots.__setitem__(domain, messages))
+    message = create_message('<p>Dear {{ subscriber.name }}</p>{{ content|safe }}')
+    subscribers = [SubscriptionToNewsletter.objects.create(newsletter=message.newsletter, email=email, name="Name",
+                                                           surname="Surname", ip_address="127.0.0.1",
+                                                           privacy_policy_accepted=True, subscription_confirmed=True)
+                   for email in emails]
+
+    # Act
+    result = send_newsletter_batch_task.apply(args=(message.id, [subscriber.id for subscriber in subscribers])).get()
+    email_connection_pool.close_all()
+
+    # Assert
+    assert sink.sessions == 1
+    assert sorted(recipients[0] for recipients, _ in sink.messages) == sorted(expected_sent)
+    assert domain_slots == expected_domain_slots
+    assert sorted(failure['recipient'] for failure in result['failed'].values()) == expected_failed
+    records = NewsletterDeliveryRecord.objects.filter(message=message)
+    assert sorted(records.filter(status=NewsletterDeliveryRecord.SENT).values_list("subscriber__email", flat=True)) \
+           == sorted(expected_sent)
+    assert all(record.smtp_code == 250 for record in records.filter(status=NewsletterDeliveryRecord.SENT))
+    assert list(DeadLetter.objects.values_list("recipient", flat=True)) == expected_failed
@@ -0,0 +1,51 @@
+from datetime import timedelta
+
+import pytest
+from django.core import mail
+from django.utils import timezone
+
+from core import logic_notifications
+from core.logic_notifications import send_campaign_digests
+from core.models import EmailTemplate, Newsletter, SubscriptionToNewsletter, Message, NewsletterDeliveryRecord, \
+    Campaign
+
+
+# send_campaign_digests Tests
+@pytest.mark.parametrize("status, last_digest_minutes_ago, pending, expected_subject", [
+    (Campaign.RUNNING, None, True, "[progress]"),
+    (Campaign.RUNNING, 10, True, None),
+    (Campaign.RUNNING, 120, True, "[progress]"),
+    (Campaign.COMPLETED, 10, True, None),
+    (Campaign.COMPLETED, 10, False, "[completed]"),
+], ids=["first-digest", "interval-not-elapsed", "interval-elapsed", "completed-with-pending-emails",
+        "completed"])
+def test_send_campaign_digests(db, settings, monkeypatch, status, last_digest_minutes_ago, pending,
+                               expected_subject):
+    # Arrange
+    settings.SHARED_STORE_REDIS_URL = None
+    settings.CAMPAIGN_NOTIFICATION_MODE = 'digest'
+    settings.CAMPAIGN_DIGEST_INTERVAL_SECONDS = 3600
+    monkeypatch.setattr(logic_notifications, "NOTIFICATION_BCC_RECIPIENTS", ["admin@example.com"])
+
+    template = EmailTemplate.objects.create(name="Template", subject="Subject", body="{{ content|safe }}")
+    newsletter = Newsletter.objects.create(name="Newsletter", short_name="NL", from_email="newsletter@example.com",
+                                           enabled=True, template=template)
+    message = Message.objects.create(newsletter=newsletter, subject="Subject", message_content="<p>Content</p>")
+    subscription = SubscriptionToNewsletter.objects.create(newsletter=newsletter, email="subscriber@example.com",
+                                                           name="Name", surname="Surname", ip_address="127.0.0.1",
+                                                           privacy_policy_accepted=True)
+    NewsletterDeliveryRecord.objects.create(
+        message=message, subscriber=subscription,
+        status=NewsletterDeliveryRecord.QUEUED if pending else NewsletterDeliveryRecord.SENT)
+    now = timezone.now()
+    campaign = Campaign.objects.create(
+        message=message, status=status,
+        last_digest_at=now - timedelta(minutes=last_digest_minutes_ago) if last_digest_minutes_ago else None)
+
+    # Act
+    sent = send_campaign_digests(now=now)
+
+    # Assert
+    assert sent == ([campaign.id] if expected_subject else [])
+    assert [email.subject.split()[0] for email in mail.outbox] == ([expected_subject] if expected_subject else [])
+    assert [email.to for email in mail.outbox] == ([["admin@example.com"]] if expected_subject else [])
@@ -0,0 +1,38 @@
+import re
+
+import pytest
+from django.core.mail import EmailMessage
+
+from core.mime_utils import MimeSkeleton, PreEncodedEmailMessage, EncodedMessage
+
+# headers that are different in each message
+VOLATILE_HEADERS_RE = re.compile(rb'^(Date|Message-ID): .*$', re.MULTILINE)
+
+
+@pytest.mark.parametrize(
+    "static_parts, values, pre_encoded",
+    [
+        (["<p>Dear ", "</p>\n<p>Content</p>"], ["Name"], True),
+        (["<p>Dear ", "</p>\r\n<p>Contènt</p>\n"], ["Nàme €"], True),
+        (["x" * 990, "y" * 5], ["zzzz"], False),
+        (["<p>", "</p>\n" + "x" * 1000], ["Name"], False),
+        (["<p>Static only</p>"], [], True),
+    ],
+    ids=["ascii", "utf-8", "long-line-across-value", "long-static-line", "no-values"]
+)
+def test_pre_encoded_message_same_as_django(static_parts, values, pre_encoded):
+    # Arrange
+    mime_skeleton = MimeSkeleton("Subject è", "Newsletter <newsletter@example.com>", static_parts)
+    email = PreEncodedEmailMessage(mime_skeleton, values, ["subscriber@example.com"], bcc=["bcc@example.com"])
+    expected_email = EmailMessage("Subject è", mime_skeleton.join(values), "Newsletter <newsletter@example.com>",
+                                  ["subscriber@example.com"], bcc=["bcc@example.com"])
+    expected_email.content_subtype = "html"
+
+    # Act
+    message = email.message()
+
+    # Assert
+    assert isinstance(message, EncodedMessage) == pre_encoded
+    assert email.recipients() == expected_email.recipients()
+    assert (VOLATILE_HEADERS_RE.sub(b'', message.as_bytes(linesep='\r\n')) ==
+            VOLATILE_HEADERS_RE.sub(b'', expected_email.message().as_bytes(linesep='\r\n')))
@@ -0,0 +1,80 @@
+import pytest
+
+from core import rate_limit, shared_store
+from core.rate_limit import LocalTokenBucket, RedisTokenBucket, acquire
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+# LocalTokenBucket Tests
+@pytest.mark.parametrize("rate, burst, requests, elapsed, expected_wait", [
+    (2.0, 5, 5, 0.0, 0),
+    (2.0, 5, 6, 0.0, 0.5),
+    (2.0, 5, 6, 1.0, 0),
+    (2.0, 5, 7, 100.0, 0.5),
+], ids=["happy-path-burst", "bucket-empty", "refilled", "refill-capped-at-burst"])
+def test_local_token_bucket(rate, burst, requests, elapsed, expected_wait):
+    # Arrange
+    clock = FakeClock()
+    token_bucket = LocalTokenBucket(clock=clock)
+    token_bucket.try_acquire("relay", rate, burst, tokens=1)
+    clock.now += elapsed
+
+    # Act
+    waits = [token_bucket.try_acquire("relay", rate, burst, tokens=1) for _ in range(requests - 1)]
+
+    # Assert
+    assert waits[-1] == pytest.approx(expected_wait)
+
+
+# acquire Tests
+@pytest.mark.parametrize("retry_seconds, expected_redis_calls", [
+    (30, 1),
+    (0, 3),
+], ids=["failure-cached", "retry-at-each-call"])
+def test_acquire_when_redis_is_not_reachable(settings, monkeypatch, retry_seconds, expected_redis_calls):
+    # Arrange
+    settings.SHARED_STORE_REDIS_URL = "redis://127.0.0.1:1/15"
+    settings.SHARED_STORE_RETRY_SECONDS = retry_seconds
+    monkeypatch.setattr(shared_store, "_unavailable_until", {})
+    monkeypatch.setattr(rate_limit, "local_token_bucket", LocalTokenBucket())
+    redis_calls = []
+
+    def unreachable(self, key, rate, burst, tokens=1):
+        redis_calls.append(key)
+        raise ConnectionError("Connection refused")
+
+    monkeypatch.setattr(RedisTokenBucket, "try_acquire", unreachable)
+
+    # Act
+    waits = [acquire("relay", 100, 10) for _ in range(3)]
+
+    # Assert
+    # the local bucket is used, without trying redis again until SHARED_STORE_RETRY_SECONDS have passed
+    assert waits == [0, 0, 0]
+    assert len(redis_calls) == expected_redis_calls
+
+
+@pytest.mark.parametrize("tokens, expected_waited", [
+    (8, 0),
+    (40, 2.0),
+], ids=["happy-path-burst", "more-tokens-than-burst"])
+def test_acquire_takes_all_the_tokens(settings, monkeypatch, tokens, expected_waited):
+    # Arrange
+    settings.SHARED_STORE_REDIS_URL = None
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limit, "local_token_bucket", LocalTokenBucket(clock=clock))
+    monkeypatch.setattr(rate_limit.time, "sleep", lambda seconds: setattr(clock, "now", clock.now + seconds))
+
+    # Act
+    waited = acquire("relay", 16, 8, tokens)
+
+    # Assert
+    # e.g. an envelope email to 40 recipients takes 40 tokens, not only the burst
+    assert waited == pytest.approx(expected_waited)
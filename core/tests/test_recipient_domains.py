@@ -0,0 +1,34 @@
+import pytest
+
+from core.recipient_domains import plan_domain_batches, interleave_by_domain, get_email_domain
+
+
+@pytest.mark.parametrize(
+    "recipients, batch_size, expected",
+    [
+        ([(1, "a@gmail.com"), (2, "b@gmail.com"), (3, "c@yahoo.com"), (4, "d@gmail.com"), (5, "e@yahoo.com")], 2,
+         [[1, 2], [3, 5], [4]]),
+        ([(1, "a@x.org"), (2, "b@y.org"), (3, "c@z.org")], 2, [[1, 2], [3]]),
+        ([(1, "a@GMAIL.com"), (2, "b@gmail.com"), (3, "c@x.org")], 5, [[1, 2, 3]]),
+        ([], 5, []),
+    ],
+    ids=["domain-batches-interleaved", "mixed-small-domains", "domain-case-insensitive", "empty"]
+)
+def test_plan_domain_batches(recipients, batch_size, expected):
+    # Act
+    batches = plan_domain_batches(recipients, batch_size)
+
+    # Assert
+    assert batches == expected
+
+
+def test_interleave_by_domain():
+    # Arrange
+    emails = ["a@gmail.com", "b@gmail.com", "c@gmail.com", "d@yahoo.com", "e@yahoo.com", "f@x.org"]
+
+    # Act
+    interleaved = interleave_by_domain(emails, lambda email: email)
+
+    # Assert
+    assert interleaved == ["a@gmail.com", "d@yahoo.com", "f@x.org", "b@gmail.com", "e@yahoo.com", "c@gmail.com"]
+    assert [get_email_domain(email) for email in interleaved[:3]] == ["gmail.com", "yahoo.com", "x.org"]
@@ -0,0 +1,132 @@
+import smtplib
+
+import pytest
+from django.core.mail import EmailMessage
+
+from core import relays
+from core.logic_email import DeliveryUncertainError
+from core.relays import RelayHealth, send_with_failover
+
+
+class FakePool:
+    """Pool whose failing relays drop the session before DATA or (after_data) during the DATA of the first message."""
+
+    def __init__(self, failing, after_data=False):
+        self.failing = failing
+        self.after_data = after_data
+        self.sent = []
+        self.messages = []
+
+    def throttle(self, email_settings_id, messages=1):
+        return 0
+
+    def send_messages(self, email_messages, email_settings_id=None, throttle=True, results=None):
+        if email_settings_id in self.failing:
+            if not self.after_data:
+                raise smtplib.SMTPServerDisconnected("connection unexpectedly closed")
+            error = DeliveryUncertainError("the relay has failed after DATA")
+            if results is not None:
+                results.append(error)
+            raise error
+        self.sent.append(email_settings_id)
+        self.messages.extend(email_messages)
+        if results is not None:
+            results.extend([None] * len(email_messages))
+        return len(email_messages)
+
+
+# send_with_failover Tests
+@pytest.mark.parametrize("failing, expected_relays", [
+    (set(), {1, 2}),
+    ({1}, {2}),
+    ({2}, {1}),
+], ids=["happy-path-sharded-by-weight", "failover-from-1", "failover-from-2"])
+def test_send_with_failover(settings, monkeypatch, failing, expected_relays):
+    # Arrange
+    settings.SHARED_STORE_REDIS_URL = None
+    settings.EMAIL_RELAY_MAX_FAILURES = 3
+    fake_pool = FakePool(failing)
+    monkeypatch.setattr(relays, "email_connection_pool", fake_pool)
+    monkeypatch.setattr(relays, "relay_health", RelayHealth())
+
+    # Act
+    used = {send_with_failover([EmailMessage(to=["to@example.com"])], [[1, 1], [2, 3]]) for _ in range(50)}
+
+    # Assert
+    assert used == expected_relays
+    assert set(fake_pool.sent) == expected_relays
+
+
+@pytest.mark.parametrize("with_results, expected_results, expected_recipients", [
+    (True, [DeliveryUncertainError, None], ["second@example.com"]),
+    (False, None, []),
+], ids=["with-results-only-not-transmitted-fail-over", "without-results-uncertain"])
+def test_send_with_failover_after_data(settings, monkeypatch, with_results, expected_results, expected_recipients):
+    # Arrange
+    settings.SHARED_STORE_REDIS_URL = None
+    fake_pool = FakePool({1}, after_data=True)
+    monkeypatch.setattr(relays, "email_connection_pool", fake_pool)
+    monkeypatch.setattr(relays, "relay_health", RelayHealth())
+    monkeypatch.setattr(relays, "order_relays", lambda newsletter_relays: [relay[0] for relay in newsletter_relays])
+    email_messages = [EmailMessage(to=["first@example.com"]), EmailMessage(to=["second@example.com"])]
+    results = [] if with_results else None
+
+    # Act
+    if with_results:
+        send_with_failover(email_messages, [[1, 1], [2, 1]], results)
+    else:
+        with pytest.raises(DeliveryUncertainError):
+            send_with_failover(email_messages, [[1, 1], [2, 1]])
+
+    # Assert
+    # the message that may have been accepted by relay 1 is not sent through relay 2
+    assert results is None or [result if result is None else type(result) for result in results] == expected_results
+    assert [message.to[0] for message in fake_pool.messages] == expected_recipients
+
+
+def test_failing_relay_is_put_in_cooldown(settings, monkeypatch):
+    # Arrange
+    settings.SHARED_STORE_REDIS_URL = None
+    settings.EMAIL_RELAY_MAX_FAILURES = 2
+    fake_pool = FakePool({1})
+    monkeypatch.setattr(relays, "email_connection_pool", fake_pool)
+    monkeypatch.setattr(relays, "relay_health", RelayHealth())
+
+    # Act
+    for _ in range(10):
+        send_with_failover([EmailMessage(to=["to@example.com"])], [[1, 100], [2, 1]])
+
+    # Assert
+    assert not relays.relay_health.is_healthy(1)
+    assert relays.relay_health.is_healthy(2)
+    assert relays.order_relays([[1, 100], [2, 1]]) == [2, 1]
+
+
+class FakeRedis:
+    def __init__(self, keys):
+        self.keys = keys
+        self.mget_calls = 0
+
+    def mget(self, keys):
+        self.mget_calls += 1
+        return [b"cooldown" if key in self.keys else None for key in keys]
+
+
+@pytest.mark.parametrize("cache_seconds, expected_mget_calls", [
+    (5, 1),
+    (0, 10),
+], ids=["happy-path-cached", "not-cached"])
+def test_order_relays_reads_shared_cooldowns(settings, monkeypatch, cache_seconds, expected_mget_calls):
+    # Arrange
+    settings.EMAIL_RELAY_HEALTH_CACHE_SECONDS = cache_seconds
+    fake_redis = FakeRedis({RelayHealth._redis_key(1)})
+    monkeypatch.setattr(relays, "get_redis_client", lambda: fake_redis)
+    monkeypatch.setattr(relays, "relay_health", RelayHealth())
+
+    # Act
+    orders = [relays.order_relays([[1, 100], [2, 1], [3, 1]]) for _ in range(10)]
+
+    # Assert
+    # one MGET for all the relays, read again only when the cache has expired
+    assert fake_redis.mget_calls == expected_mget_calls
+    assert all(order[-1] == 1 for order in orders)
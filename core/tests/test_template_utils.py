@@ -0,0 +1,54 @@
+import pytest
+
+from core.models import EmailTemplate
+from core.template_utils import render_email_template, compiled_template_cache, CompiledTemplateCache
+
+
+# render_email_template Tests
+@pytest.mark.parametrize("body, context, expected", [
+    ("Hello {{ name }}", {"name": "John"}, "Hello John"),
+    ("Hello {{ name }}", {"name": "<b>"}, "Hello &lt;b&gt;"),
+    ("Hello", None, "Hello"),
+], ids=["happy-path-variable", "autoescape", "no-context"])
+def test_render_email_template(db, body, context, expected):
+    # Arrange
+    email_template = EmailTemplate.objects.create(name="Template", subject="Subject", body=body)
+
+    # Act
+    html_content = render_email_template(email_template, context)
+
+    # Assert
+    assert html_content == expected
+
+
+def test_compiled_template_is_invalidated_on_save(db):
+    # Arrange
+    email_template = EmailTemplate.objects.create(name="Template", subject="Subject", body="first {{ name }}")
+    first = compiled_template_cache.get(email_template)
+
+    # Act
+    email_template.body = "second {{ name }}"
+    email_template.save()
+
+    # Assert
+    assert compiled_template_cache.get(email_template) is compiled_template_cache.get(email_template)
+    assert compiled_template_cache.get(email_template) is not first
+    assert render_email_template(email_template, {"name": "John"}) == "second John"
+
+
+def test_compiled_template_cache_lru_eviction(db):
+    # Arrange
+    cache = CompiledTemplateCache(max_size=2)
+    templates = [EmailTemplate.objects.create(name=f"Template {i}", subject="Subject", body=f"body {i}")
+                 for i in range(3)]
+    first = cache.get(templates[0])
+    cache.get(templates[1])
+
+    # Act
+    cache.get(templates[0])  # most recently used
+    cache.get(templates[2])  # evicts templates[1]
+
+    # Assert
+    assert cache.get(templates[0]) is first
+    assert len(cache._templates) == 2
+    assert (templates[1].id, templates[1].updated_at) not in cache._templates
@@ -5,16 +5,16 @@ from django.core.exceptions import ValidationError
 from django.http import HttpResponse, Http404
 from django.shortcuts import render, redirect, get_object_or_404
 from django.utils import timezone
-from django.urls import reverse
 
 from simple_newsletter import settings
 from .business_logic import create_event_log
 from .forms import SubscriptionForm, VisitSurveyForm
 from .html_utils import make_urls_absolute
+from .logic_newsletter import generate_unsubscribe_link, generate_message_web_view
 from .models import Newsletter, SubscriptionToNewsletter, Visitor, Message
 from .tasks import send_custom_email_task, process_subscription_task, register_static_access_log, \
     register_static_access_log_inc_email_view_counter
-from .template_utils import render_template_from_string
+from .template_utils import render_email_template
 
 
 def home(request):
@@ -97,18 +97,9 @@ def confirm_subscription(request, token):
     return render(request, 'subscriptions/subscription_confirmed_by_user.html', context=context)
 
 
-def generate_unsubscribe_link(subscriber):
-    # Use Django's reverse to create the URL for the unsubscribe view
-    return reverse('unsubscribe', args=[str(subscriber.unsubscribe_token)])
-
-
-def generate_message_web_view(message):
-    return reverse('view_message', args=[str(message.view_token)])
-
-
 def message_web_view(request, token):
     """This view is used to view the message in the browser, without opening the email client."""
-    message = get_object_or_404(Message, view_token=token)
+    message = get_object_or_404(Message.objects.select_related('newsletter__template_for_web_view'), view_token=token)
 
     message_content = make_urls_absolute(message.message_content, message.newsletter.base_url)
 
@@ -125,8 +116,7 @@ def message_web_view(request, token):
     template_for_web_view = message.newsletter.template_for_web_view
 
     if template_for_web_view:
-        template_content = template_for_web_view.body
-        html_content = render_template_from_string(template_content, context=context)
+        html_content = render_email_template(template_for_web_view, context=context)
 
         return HttpResponse(html_content)
     else:
@@ -119,12 +119,153 @@ CELERY_RESULT_SERIALIZER = 'json'
 
 CELERY_BROKER_CONNECTION_RETRY_ON_STARTUP = True
 
+# a task not acknowledged within visibility_timeout is delivered again to another worker by the redis broker:
+# it must be longer than the longest task acknowledged late, and than the longest countdown of a retry
+# (EMAIL_RETRY_MAX_SECONDS, SEND_GUARD_RESERVATION_SECONDS), since the tasks waiting for their ETA are not acknowledged
+CELERY_BROKER_TRANSPORT_OPTIONS = {'visibility_timeout': 3 * 3600}
+
+# transactional emails (e.g. the confirmation of the subscription) have their own queue and workers,
+# so that they are not delayed by the newsletter campaigns, which go to the bulk queue;
+# the other tasks use the default queue (celery). See celery.service in systemd-integration.txt
+CELERY_TASK_ROUTES = {
+    'core.tasks.process_subscription_task': {'queue': 'transactional'},
+    'core.tasks.send_custom_email_task': {'queue': 'bulk'},
+    'core.tasks.send_visitor_emails_task': {'queue': 'bulk'},
+    'core.tasks.send_newsletter_email_task': {'queue': 'bulk'},
+    'core.tasks.send_newsletter_batch_task': {'queue': 'bulk'},
+}
+
+# each worker process reserves only the task it is running: a bulk worker does not hold thousands of
+# prefetched emails, and the tasks are shared evenly among the workers
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+
+# the tasks that send emails guarded by idempotency keys (see core/send_guard.py) are acknowledged after they
+# have run (acks_late in core/tasks.py): a task whose worker dies is delivered again, and the emails already
+# sent are not sent twice. Each email is reserved for SEND_GUARD_RESERVATION_SECONDS before sending, and its key
+# is kept SEND_GUARD_TTL_SECONDS after sending. The other tasks (e.g. run_campaign_task, which runs for hours)
+# are acknowledged when they start.
+SEND_GUARD_RESERVATION_SECONDS = 600
+SEND_GUARD_TTL_SECONDS = 7 * 24 * 3600
+
+# periodic tasks, run by celery beat (see systemd-integration.txt)
+CELERY_BEAT_SCHEDULE = {
+    # start the campaigns of the messages whose to_be_processed_at is due
+    'dispatch-scheduled-messages': {
+        'task': 'core.tasks.dispatch_scheduled_messages_task',
+        'schedule': 60.0,
+    },
+    # delivery digest of the campaigns, for NOTIFICATION_BCC_RECIPIENTS
+    'send-campaign-digests': {
+        'task': 'core.tasks.send_campaign_digests_task',
+        'schedule': 300.0,
+    },
+}
+
+# recipients of each celery task in the campaigns started by the scheduled dispatcher
+SCHEDULED_CAMPAIGN_BATCH_SIZE = 100
+# a dispatched message whose campaign has made no progress for this time (e.g. run_campaign_task lost by the
+# broker) is dispatched again; it must be longer than CAMPAIGN_LEASE_SECONDS
+SCHEDULED_DISPATCH_TIMEOUT_SECONDS = 1800
+
+# SMTP connections kept open by each celery worker process (see EmailConnectionPool in core/logic_email.py)
+EMAIL_POOL_MAX_MESSAGES_PER_CONNECTION = 100  # recycle the SMTP session after this number of messages
+EMAIL_POOL_NOOP_AFTER_SECONDS = 30  # health check (NOOP) a session that has been idle for this time
+EMAIL_POOL_SETTINGS_TTL_SECONDS = 300  # reload EmailSettings from the database after this time
+
+# emails that are the same for all the recipients (e.g. SendEmailToVisitors --envelope) are sent with
+# a single SMTP transaction to up to this number of recipients (RCPT TO commands accepted by the relay);
+# each recipient takes a token of the rate limit of the relay
+EMAIL_ENVELOPE_MAX_RECIPIENTS = 50
+
+# number of subscribers read from the database at once by SendNewsletter (see core/logic_campaign.py)
+CAMPAIGN_AUDIENCE_CHUNK_SIZE = 1000
+
+# the audience of a campaign is split in shards of this number of subscriber ids; each SendNewsletter run
+# leases a shard at a time, so that concurrent runs share the campaign instead of sending the same emails.
+# The lease is renewed at each chunk of subscribers, and taken over by another run CAMPAIGN_LEASE_SECONDS
+# after the last renewal
+CAMPAIGN_SHARD_SIZE = 50000
+CAMPAIGN_LEASE_SECONDS = 300
+
+# emails still QUEUED in the delivery ledger this number of seconds after their row was written (the task was
+# never enqueued, or has been lost by the broker) are enqueued again when the campaign of the message is run;
+# it must be longer than the visibility_timeout of the broker (the tasks of the retries keep the rows QUEUED)
+CAMPAIGN_REQUEUE_AFTER_SECONDS = 3 * 3600
+
+# backpressure of SendNewsletter (celery engine, see core/flow_control.py): at most this number of tasks wait
+# in the queue of the broker; when it is full, the producer waits until the workers drain it to half
+ENQUEUE_MAX_QUEUED_TASKS = 2000
+ENQUEUE_POLL_SECONDS = 0.5  # check the length of the queue every this number of seconds while waiting
+ENQUEUE_REPORT_SECONDS = 10  # print the enqueue rate and the completion rate of the workers
+
+# redis used to share state between the processes (e.g. the rate limits of the relays, see core/rate_limit.py);
+# if None, each process uses a local fallback
+SHARED_STORE_REDIS_URL = 'redis://localhost:6379/1'
+# seconds during which the local fallback is used, without trying redis again, after a redis error
+SHARED_STORE_RETRY_SECONDS = 30
+
+# health of the relays of a newsletter (see core/relays.py): a relay is put in cooldown, and its traffic
+# goes to the other relays, after EMAIL_RELAY_MAX_FAILURES consecutive errors or when sending is too slow
+EMAIL_RELAY_MAX_FAILURES = 3
+EMAIL_RELAY_SLOW_SECONDS = 10  # average seconds to send an email
+EMAIL_RELAY_COOLDOWN_SECONDS = 300
+# seconds during which each process keeps the cooldowns read from the shared store, instead of reading them for
+# each email
+EMAIL_RELAY_HEALTH_CACHE_SECONDS = 5
+
+# limits for each recipient domain (see core/recipient_domains.py): the campaigns are grouped by domain and
+# the domains are interleaved; rate (emails per second, shared by the workers, None = no limit), burst and
+# concurrency (sessions of the async engine sending to the domain at the same time, None = no limit)
+EMAIL_DOMAIN_DEFAULT_LIMITS = {'rate': None, 'burst': 10, 'concurrency': 10}
+EMAIL_DOMAIN_LIMITS = {
+    # 'gmail.com': {'rate': 20, 'burst': 20, 'concurrency': 5},
+}
+
+# retries of the emails that could not be sent (see core/tasks.py): transient errors (4xx replies, connection errors)
+# are retried with exponential backoff and jitter, a longer one when the relay is throttling (421, "too many ...");
+# permanent errors and the emails still failing after EMAIL_RETRY_MAX_ATTEMPTS go to the DeadLetter store
+EMAIL_RETRY_MAX_ATTEMPTS = 5
+EMAIL_RETRY_BASE_SECONDS = 2
+EMAIL_RETRY_THROTTLED_BASE_SECONDS = 30
+EMAIL_RETRY_MAX_SECONDS = 600
+
+# rate limit of the default email connection (EMAIL_HOST), used when a newsletter has no EmailSettings;
+# the rate limit of each EmailSettings is configured in the admin
+EMAIL_DEFAULT_RATE_LIMIT = None  # emails per second, None = no limit
+EMAIL_DEFAULT_RATE_LIMIT_BURST = 10
+
+# asyncio delivery engine (RunAsyncSender command, see core/logic_async_sender.py)
+ASYNC_SENDER_SESSIONS = 50  # concurrent SMTP sessions of each process
+ASYNC_SENDER_BATCH_SIZE = 500  # rows of the delivery ledger claimed at once
+ASYNC_SENDER_POLL_SECONDS = 2  # check for new rows, and write the outcomes, every this number of seconds
+# rows claimed by a sender that stopped are sent again after this time; a running sender renews its claims
+# every ASYNC_SENDER_POLL_SECONDS
+ASYNC_SENDER_CLAIM_TIMEOUT_SECONDS = 600
+
+# number of compiled EmailTemplate instances kept in memory by each process (see core/template_utils.py)
+EMAIL_TEMPLATE_CACHE_SIZE = 64
+
+# number of pre-rendered messages (see NewsletterSkeletonCache in core/logic_newsletter.py) kept by each process
+NEWSLETTER_SKELETON_CACHE_SIZE = 16
+
+# number of documents with absolute URLs kept in memory by each process (see make_urls_absolute in core/html_utils.py)
+HTML_URL_REWRITE_CACHE_SIZE = 128
+
 
 if NOTIFICATION_BCC_RECIPIENTS := env('NOTIFICATION_BCC_RECIPIENTS'):
     NOTIFICATION_BCC_RECIPIENTS = [email.strip() for email in NOTIFICATION_BCC_RECIPIENTS.split(',')]
 else:
     NOTIFICATION_BCC_RECIPIENTS = None
 
+# how NOTIFICATION_BCC_RECIPIENTS are notified of the newsletter campaigns (see core/logic_notifications.py):
+# 'digest': a sample copy of the message at the start of the campaign, and a digest of the delivery counts
+#           and failures every CAMPAIGN_DIGEST_INTERVAL_SECONDS (and when the campaign is completed)
+# 'bcc': in BCC of every email of the campaign (each email is sent to 1 + len(NOTIFICATION_BCC_RECIPIENTS) addresses)
+# transactional emails (e.g. the confirmation of the subscription) always have them in BCC
+CAMPAIGN_NOTIFICATION_MODE = 'digest'
+CAMPAIGN_DIGEST_INTERVAL_SECONDS = 3600
+CAMPAIGN_DIGEST_MAX_FAILURES = 50  # failures listed in each digest
+
 
 # Application definition
 